@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# times model switches, loading straight from the model dir (as txt2img used to) and
+# from the fp16 safetensors model cache, each cold and warm.
+#
+# "cold" drops the model's files from the page cache first, with
+# posix_fadvise(DONTNEED). that needs no root, but is best effort: pages that are
+# mapped or dirty stay cached. "warm" loads again right after.
+#
+# usage:
+#   bench-model-load.py <model_dir> [<model_dir> ...] [--runs N]
+import argparse
+import os
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+from modelcache import ModelCache
+
+def drop_page_cache(path: Path):
+    for dirpath, _dirnames, filenames in os.walk(path, followlinks=True):
+        for filename in filenames:
+            try:
+                fd = os.open(Path(dirpath, filename), os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+# seconds to load a pipeline and move it to the gpu.
+def time_load(load_fun: Callable[[], StableDiffusionPipeline]) -> float:
+    time_start = time.perf_counter()
+    pipeline = load_fun().to("cuda")
+    torch.cuda.synchronize()
+    res = time.perf_counter() - time_start
+    del pipeline
+    torch.cuda.empty_cache()
+    return res
+
+def bench(model_dir: str, cache: ModelCache, runs: int) -> List[List]:
+    def load_source():
+        return StableDiffusionPipeline.from_pretrained(model_dir, revision="fp16", torch_dtype=torch.float16, safety_checker=None)
+
+    time_start = time.perf_counter()
+    cache_dir = cache.path(model_dir)
+    time_cache = time.perf_counter() - time_start
+
+    def load_cached():
+        return StableDiffusionPipeline.from_pretrained(cache.path(model_dir), torch_dtype=torch.float16, safety_checker=None)
+
+    rows = [["cache lookup/build", time_cache]]
+    for name, load_fun, path in [("source", load_source, model_dir), ("cached", load_cached, cache_dir)]:
+        cold = list()
+        warm = list()
+        for _ in range(runs):
+            drop_page_cache(Path(path))
+            cold.append(time_load(load_fun))
+            warm.append(time_load(load_fun))
+        rows.append([f"{name} cold", min(cold)])
+        rows.append([f"{name} warm", min(warm)])
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time model loads with and without the fp16 safetensors model cache")
+    parser.add_argument("model_dirs", nargs='+')
+    parser.add_argument("--runs", type=int, default=2, help="best of this many runs")
+    args = parser.parse_args()
+
+    cache = ModelCache()
+    for model_dir in args.model_dirs:
+        print(f"\033[1m{model_dir}\033[0m")
+        for name, seconds in bench(model_dir, cache, args.runs):
+            print(f"  {name:20} {seconds:7.2f}s")
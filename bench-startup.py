@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# how long gen-many.py takes to get to a plan. runs "gen-many.py --help" and a
+# --dry-run over a throwaway output dir a few times each, and checks with
+# "python -X importtime" that neither imported torch or diffusers.
+#
+# exits nonzero if a median time is over --max_seconds or if torch got imported, so
+# it can be used as a check after touching gen-many's imports.
+import sys
+import subprocess
+import argparse
+import tempfile
+import time
+import statistics
+from pathlib import Path
+from typing import List, Set
+
+GEN_MANY = str(Path(__file__).parent / "gen-many.py")
+HEAVY_MODULES = ["torch", "diffusers", "transformers"]
+
+def run(args: List[str]) -> float:
+    time_start = time.perf_counter()
+    subprocess.run([sys.executable, GEN_MANY] + args, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - time_start
+
+# top level packages imported while running gen-many with args.
+def imported_packages(args: List[str]) -> Set[str]:
+    proc = subprocess.run([sys.executable, "-X", "importtime", GEN_MANY] + args,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    res: Set[str] = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or line.endswith("imported package"):
+            continue
+        name = line.split("|")[-1].strip()
+        res.add(name.split(".")[0])
+    return res
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time gen-many.py startup and planning")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--max_seconds", type=float, default=1.0, help="fail if a median time is over this")
+    parser.add_argument("-m", "--model", default="models/bench", help="model dir for the dry run; doesn't need to exist")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as output_dir:
+        dry_run = ["-p", "a photo of a cat", "a photo of a dog", "-m", args.model, "-o", output_dir,
+                   "-s", "dpm++1:20", "euler_a:30", "--cfg", "5", "7", "--dry-run"]
+        for name, gen_args in [("help", ["--help"]), ("dry-run", dry_run)]:
+            times = [run(gen_args) for _ in range(args.runs)]
+            median = statistics.median(times)
+            print(f"{name:8}: median {median:.3f}s, min {min(times):.3f}s, max {max(times):.3f}s over {args.runs} runs")
+            if median > args.max_seconds:
+                print(f"  \033[1;31mover {args.max_seconds:.3f}s\033[0m")
+                failed = True
+
+            heavy = [module for module in HEAVY_MODULES if module in imported_packages(gen_args)]
+            if heavy:
+                print(f"  \033[1;31mimported {', '.join(heavy)}\033[0m")
+                failed = True
+
+    sys.exit(1 if failed else 0)
@@ -1,44 +1,214 @@
 #!/usr/bin/env python3
 
-import torch
-import safetensors, safetensors.torch
+# convert diffusers model dirs (<model> -> <model>.safetensors) and .ckpt files
+# (<name>.ckpt -> <name>.safetensors) to safetensors.
+#
+# directories without a model_index.json are searched for model dirs and .ckpt
+# files, so a whole models dir with its checkpoint-N folders can be converted in
+# one go. files are converted by a pool of worker processes, across models. each
+# output file is written to a temp file and renamed, so a conversion that died
+# halfway is resumed by running again: files that exist are skipped, and temp files
+# left by runs that were killed are removed. .bin weights get the names diffusers
+# and transformers look for (pytorch_model.bin -> model.safetensors).
+#
+# the workers together only load up to --max_gb of weights at a time (a file
+# bigger than that is loaded on its own). .bin files are loaded with mmap when
+# torch supports it.
+#
+# usage:
+#   convert_to_safetensors.py [--workers N] [--fp16] [--verify] [--max_gb G] <path> [<path> ...]
+import argparse
+import os
+import shutil
 import sys
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import torch
+import safetensors, safetensors.torch
+
+import tensordelta
 
-for arg in sys.argv[1:]:
-    path = Path(arg)
-    if path.is_dir() and path.suffix != ".safetensors":
-        if not Path(path, "model_index.json").exists():
-            print(f"skipping {path}, no model index")
+# kind is 'bin' or 'ckpt' (converted) or 'copy'.
+Task = namedtuple("Task", ["kind", "src", "dst"])
+
+def _model_tasks(path: Path) -> Iterable[Task]:
+    newpath = path.with_suffix(".safetensors")
+    model_index = json.load(open(Path(path, "model_index.json"), "r"))
+    for child in sorted(path.iterdir()):
+        if child.is_file():
+            yield Task("copy", child, Path(newpath, child.name))
+        elif child.is_dir() and child.name in model_index:
+            # only the pipeline's components; checkpoint-N dirs and logs are left.
+            for subpath in sorted(child.iterdir()):
+                if not subpath.is_file():
+                    continue
+                if subpath.suffix == ".bin":
+                    yield Task("bin", subpath, Path(newpath, child.name, _safetensors_name(subpath.name)))
+                else:
+                    yield Task("copy", subpath, Path(newpath, child.name, subpath.name))
+
+def _safetensors_name(bin_name: str) -> str:
+    if bin_name in tensordelta.WEIGHTS_NAMES:
+        return tensordelta.safetensors_name(bin_name)
+    return str(Path(bin_name).with_suffix(".safetensors"))
+
+# temp files of task left by runs that were killed: those of processes that no
+# longer exist.
+def _stale_tmps(task: Task) -> Iterable[Path]:
+    for path in task.dst.parent.glob(f".{task.dst.name}.*.tmp"):
+        pid = path.name[len(task.dst.name) + 2:-len(".tmp")]
+        if not pid.isdigit():
             continue
-        newpath = path.with_suffix(".safetensors")
-        if newpath.exists():
-            print(f"skip {newpath}, already exists")
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            yield path
+        except PermissionError:
+            pass
+
+# conversions to do under path, which is a model dir, a .ckpt, or a dir to search.
+def find_tasks(path: Path) -> Iterable[Task]:
+    if path.is_file():
+        if path.suffix == ".ckpt":
+            yield Task("ckpt", path, path.with_suffix(".safetensors"))
+        return
+
+    if not path.is_dir() or path.suffix == ".safetensors":
+        return
+    if Path(path, "model_index.json").exists():
+        yield from _model_tasks(path)
+    for child in sorted(path.iterdir()):
+        if child.is_symlink() or child.name.startswith("."):
             continue
-        newpath.mkdir(exist_ok=True)
-        for subdir in path.iterdir():
-            newsubdir = Path(newpath, subdir.name)
-            if subdir.is_dir():
-                newsubdir.mkdir(exist_ok=True, parents=True)
-                for subpath in subdir.iterdir():
-                    if subpath.suffix == ".bin":
-                        newfile = Path(newsubdir, subpath.name).with_suffix(".safetensors")
-                        weights = torch.load(subpath)
-                        safetensors.torch.save_file(weights, newfile)
-                        print(f"wrote {newfile}")
-                    else:
-                        newfile = Path(newsubdir, subpath.name)
-                        with open(newfile, "w") as out:
-                            out.write(open(subpath, "r").read())
-                        print(f"write {newfile}")
-            else:
-                with open(newsubdir, "wb") as out:
-                    out.write(open(subdir, "rb").read())
-                print(f"write {newsubdir}")
-
-
-    elif path.suffix == ".ckpt":
-        newpath = path.with_suffix(".safetensors")
-        weights = torch.load(path)
-        safetensors.torch.save_file(weights['state_dict'], newpath)
-        print(f"wrote {newpath}")
+        if child.is_dir() or child.suffix == ".ckpt":
+            yield from find_tasks(child)
+
+def _load(task: Task) -> Dict[str, torch.Tensor]:
+    try:
+        weights = torch.load(task.src, map_location="cpu", mmap=True, weights_only=True)
+    except Exception:
+        # older torch, or a checkpoint in the old (non-zip) format, or one with
+        # more than tensors in it. torch >= 2.6 defaults to weights_only, so ask
+        # for the full unpickler; only convert checkpoints you trust.
+        weights = torch.load(task.src, map_location="cpu", weights_only=False)
+    if task.kind == "ckpt" and 'state_dict' in weights:
+        weights = weights['state_dict']
+    return {key: value for key, value in weights.items() if isinstance(value, torch.Tensor)}
+
+def _prepare(weights: Dict[str, torch.Tensor], fp16: bool) -> Dict[str, torch.Tensor]:
+    res: Dict[str, torch.Tensor] = dict()
+    seen = set()
+    for key, value in weights.items():
+        if fp16 and value.is_floating_point():
+            value = value.half()
+        value = value.contiguous()
+        # safetensors won't save tensors that share memory, e.g. tied weights.
+        ptr = value.untyped_storage().data_ptr() if value.numel() > 0 else None
+        if ptr is not None and ptr in seen:
+            value = value.clone()
+        seen.add(ptr)
+        res[key] = value
+    return res
+
+def _verify(expected: Dict[str, torch.Tensor], filename: Path) -> List[str]:
+    errors: List[str] = []
+    with safetensors.safe_open(str(filename), framework="pt") as file:
+        keys = set(file.keys())
+        if keys != set(expected.keys()):
+            errors.append(f"keys differ: missing {sorted(set(expected.keys()) - keys)[:5]}, extra {sorted(keys - set(expected.keys()))[:5]}")
+        for key in sorted(keys & set(expected.keys())):
+            if not torch.equal(file.get_tensor(key), expected[key]):
+                errors.append(f"{key} differs")
+    return errors
+
+# runs in a worker. returns (task, message), and raises if verification fails.
+def run_task(task: Task, fp16: bool, verify: bool) -> Tuple[Task, str]:
+    time_start = time.perf_counter()
+    task.dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = task.dst.with_name(f".{task.dst.name}.{os.getpid()}.tmp")
+    try:
+        if task.kind == "copy":
+            shutil.copyfile(task.src, tmp)
+            os.replace(tmp, task.dst)
+            return task, "copied"
+
+        weights = _prepare(_load(task), fp16)
+        safetensors.torch.save_file(weights, str(tmp), metadata={'format': 'pt'})
+        if verify:
+            errors = _verify(weights, tmp)
+            if errors:
+                raise Exception(f"verify failed: {'; '.join(errors[:5])}")
+        os.replace(tmp, task.dst)
+        return task, f"converted {len(weights)} tensors in {time.perf_counter() - time_start:.1f}s" + (", verified" if verify else "")
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+def _task_bytes(task: Task, fp16: bool) -> int:
+    if task.kind == "copy":
+        return 0
+    # the loaded weights plus the copy that's written (which is smaller with fp16).
+    size = task.src.stat().st_size
+    return size + (size // 2 if fp16 else size)
+
+def convert(tasks: List[Task], workers: int, max_bytes: int, fp16: bool, verify: bool) -> int:
+    num_failed = 0
+    in_flight: Dict[Future, Tuple[Task, int]] = dict()
+    pending = list(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending or in_flight:
+            # start as much as fits in the memory budget, but always at least one.
+            while pending and len(in_flight) < workers:
+                task_bytes = _task_bytes(pending[0], fp16)
+                if in_flight and sum(num_bytes for _task, num_bytes in in_flight.values()) + task_bytes > max_bytes:
+                    break
+                task = pending.pop(0)
+                in_flight[pool.submit(run_task, task, fp16, verify)] = (task, task_bytes)
+
+            done, _not_done = wait(list(in_flight.keys()), return_when=FIRST_COMPLETED)
+            for future in done:
+                task, _num_bytes = in_flight.pop(future)
+                try:
+                    _task, message = future.result()
+                    print(f"{task.dst}: {message}")
+                except Exception as e:
+                    print(f"\033[1;31m{task.src}: {e}\033[0m")
+                    num_failed += 1
+    return num_failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert diffusers model dirs and .ckpt files to safetensors")
+    parser.add_argument("paths", nargs='+', help="model dirs, .ckpt files, or dirs to search for them")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument("--max_gb", type=float, default=16, help="max Gb of weights the workers hold in memory at once")
+    parser.add_argument("--fp16", default=False, action='store_true', help="store floating point tensors as fp16")
+    parser.add_argument("--verify", default=False, action='store_true', help="read back each written file and compare every tensor")
+    args = parser.parse_args()
+
+    tasks: List[Task] = []
+    num_skipped = 0
+    for arg in args.paths:
+        path_tasks = list(find_tasks(Path(arg)))
+        if len(path_tasks) == 0:
+            print(f"skipping {arg}, no model dirs or .ckpt files")
+            continue
+        for task in path_tasks:
+            if task.dst.parent.is_dir():
+                for tmp in _stale_tmps(task):
+                    print(f"removing {tmp}, left by a killed run")
+                    tmp.unlink()
+            if task.dst.exists():
+                num_skipped += 1
+                continue
+            tasks.append(task)
+
+    print(f"{len(tasks)} files to convert or copy, {num_skipped} already done")
+    num_failed = convert(tasks, args.workers, int(args.max_gb * 1024 * 1024 * 1024), args.fp16, args.verify)
+    if num_failed:
+        print(f"\033[1;31m{num_failed} failed\033[0m")
+        sys.exit(1)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# decode the latents that gen-many.py --latents writes into PNGs, in large batches.
+# runs on cuda or cpu, and can decode with a different VAE than the one the images
+# were generated with, e.g., sd-vae-ft-mse.
+import argparse
+import json
+import os
+import sys
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Tuple
+import torch
+from safetensors import safe_open
+from diffusers import AutoencoderKL
+
+import txt2img
+import tensordelta
+
+SUFFIX = ".latents.safetensors"
+
+class LatentsFile:
+    path: Path
+    png_path: Path
+    texts: Dict[str, str]
+    shape: Tuple[int]
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.png_path = Path(str(path)[:-len(SUFFIX)] + ".png")
+        with safe_open(path, framework="pt") as file:
+            self.texts = file.metadata() or {}
+            self.shape = tuple(file.get_slice('latents').get_shape())
+
+    def load(self) -> torch.Tensor:
+        with safe_open(self.path, framework="pt") as file:
+            return file.get_tensor('latents')
+
+def find_latents(paths: List[Path]) -> List[Path]:
+    res: List[Path] = list()
+    for path in paths:
+        if path.is_dir():
+            res.extend(sorted(path.rglob("*" + SUFFIX)))
+        elif path.name.endswith(SUFFIX):
+            res.append(path)
+    return res
+
+def load_vae(vae_path: str, device: str, dtype: torch.dtype) -> AutoencoderKL:
+    # accepts either a model directory or a VAE directory.
+    subfolder = "vae" if Path(vae_path, "vae").is_dir() else None
+    print(f"load VAE {vae_path}")
+    delta = tensordelta.read_delta(vae_path) if subfolder is not None else None
+    if delta is not None and "vae" in delta['components']:
+        # packed by tensordelta.py: the base's VAE, with the tensors that differ.
+        vae = AutoencoderKL.from_pretrained(delta['base'], subfolder="vae", torch_dtype=dtype)
+        tensordelta.apply_delta(vae, vae_path, "vae")
+    else:
+        vae = AutoencoderKL.from_pretrained(vae_path, subfolder=subfolder, torch_dtype=dtype)
+    return vae.to(device)
+
+# decode 'latents' with and without tiling, and exit with an error if the mean
+# difference (in 0..255 pixel levels) is above 'tolerance'.
+def check_tiled(vae: AutoencoderKL, latents: torch.Tensor, tolerance: float):
+    full = np.stack([np.asarray(image, dtype=np.float32) for image in txt2img.decode_latents(vae, latents, "full")])
+    tiled = np.stack([np.asarray(image, dtype=np.float32) for image in txt2img.decode_latents(vae, latents, "tiled")])
+    diff = np.abs(full - tiled)
+    print(f"tiled vs full: mean abs diff {diff.mean():.3f}, max abs diff {diff.max():.0f}, tolerance {tolerance}")
+    sys.exit(0 if diff.mean() <= tolerance else 1)
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="decode latents saved by gen-many.py --latents")
+    parser.add_argument("paths", nargs='+', type=Path, help="latents files or directories to search")
+    parser.add_argument("--vae", default=None, help="VAE or model directory to decode with, default is each image's model")
+    parser.add_argument("--batch", dest="batch_size", type=int, default=16, help="latents to decode at once")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--decode", dest="decode_mode", choices=txt2img.DECODE_MODES, default="auto", help="how to run the VAE decode; auto picks by resolution and free memory")
+    parser.add_argument("--tiled", dest="decode_mode", action='store_const', const="tiled", help="same as --decode tiled")
+    parser.add_argument("--check_tiled", default=False, action='store_true', help="compare tiled against untiled output on the first batch, then exit")
+    parser.add_argument("--tolerance", type=float, default=2.0, help="max mean abs pixel difference for --check_tiled")
+    parser.add_argument("--force", default=False, action='store_true', help="decode even if the PNG already exists")
+    parser.add_argument("--delete", default=False, action='store_true', help="delete latents after decoding them")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    config = parse_args()
+    dtype = torch.float16 if config.device.startswith("cuda") else torch.float32
+
+    # group by VAE and latents shape, so every batch is a single decode.
+    groups: Dict[Tuple[str, Tuple[int]], List[LatentsFile]] = dict()
+    num_skipped = 0
+    for path in find_latents(config.paths):
+        one = LatentsFile(path)
+        if one.png_path.exists() and not config.force:
+            num_skipped += 1
+            continue
+        vae_path = config.vae or json.loads(one.texts['json'])['model_dir']
+        groups.setdefault((vae_path, one.shape), []).append(one)
+
+    num_todo = sum(len(files) for files in groups.values())
+    print(f"{num_todo} to decode, {num_skipped} already decoded")
+
+    vaes: Dict[str, AutoencoderKL] = dict()
+    num_done = 0
+    for (vae_path, shape), files in sorted(groups.items(), key=lambda item: item[0][0]):
+        if vae_path not in vaes:
+            vaes.clear()
+            vaes[vae_path] = load_vae(vae_path, config.device, dtype)
+        vae = vaes[vae_path]
+
+        for start in range(0, len(files), config.batch_size):
+            batch = files[start:start + config.batch_size]
+            latents = torch.cat([one.load() for one in batch]).to(config.device, dtype=dtype)
+            if config.check_tiled:
+                check_tiled(vae, latents, config.tolerance)
+
+            images = txt2img.decode_latents(vae, latents, config.decode_mode)
+            for one, image in zip(batch, images):
+                texts = dict(one.texts)
+                if config.vae:
+                    info = json.loads(texts['json'])
+                    info['vae'] = config.vae
+                    texts['json'] = json.dumps(info)
+                txt2img.save_png(str(one.png_path), image, txt2img.png_metadata(texts))
+                if config.delete:
+                    os.unlink(one.path)
+            num_done += len(batch)
+            print(f"{num_done}/{num_todo}: {batch[-1].png_path}")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# extract a LoRA from a fully fine-tuned model (a dreambooth or kohya output dir, or
+# a checkpoint-N dir in one), against the base model it was trained from.
+#
+# either model may also be a .ckpt or .safetensors checkpoint in the original stable
+# diffusion layout, as kohya saves them. those are first converted to diffusers, in
+# fp32, into a temp dir next to the output that's removed afterwards; unlike the
+# extraction itself, the conversion loads the whole model.
+#
+# for each linear layer lora_diffusion patches (those in the unet's attention and
+# GEGLU blocks, and in the text encoder's attention blocks), the difference between
+# the tuned and base weights is approximated by up @ down, from a truncated SVD.
+# the rank is --rank, or with --energy, the smallest rank that keeps that fraction
+# of the difference's energy (sum of squared singular values), up to --rank.
+#
+# layers are read a few at a time (tensors are read lazily from safetensors, and
+# from packed dirs, see tensordelta.py), and layers of the same shape are stacked
+# and decomposed in one batched svd_lowrank, on the gpu if there is one. only the
+# up/down factors are kept around. each layer's reconstruction error, the
+# relative frobenius norm of what the LoRA leaves out, is printed.
+#
+# the output is a lora_diffusion .safetensors file, for patch_pipe, like
+# lora/lora-gen-grid-weights.py uses. it's only meaningful on a pipeline of the same
+# base model.
+#
+# usage:
+#   extract-lora.py <base_model> <model> [--rank R] [--energy E] [-o out.safetensors]
+import os
+import json
+import time
+import shutil
+import argparse
+from pathlib import Path
+from typing import Dict, List, Mapping, Set, Tuple
+
+import torch
+import safetensors, safetensors.torch
+
+import tensordelta
+from modelcache import input_dir, is_single_file
+
+# module classes lora_diffusion patches the linear layers of, per component.
+TARGETS = {
+    "unet": {"CrossAttention", "Attention", "GEGLU"},
+    "text_encoder": {"CLIPAttention"},
+}
+
+# one layer's LoRA: up @ down approximates its weight difference.
+class LayerLora:
+    up: torch.Tensor
+    down: torch.Tensor
+    error: float
+
+    def __init__(self, up: torch.Tensor, down: torch.Tensor, error: float):
+        self.up = up
+        self.down = down
+        self.error = error
+
+# the names and weight shapes of the layers lora_diffusion patches in component
+# name, in the order it patches them, which is the order of the layers in its
+# files. the model is built on the meta device from its config, so no weights are
+# loaded.
+def lora_layers(model_dir: Path, name: str) -> List[Tuple[str, Tuple[int, int]]]:
+    from accelerate import init_empty_weights
+    with init_empty_weights():
+        if name == "unet":
+            from diffusers import UNet2DConditionModel
+            model = UNet2DConditionModel.from_config(UNet2DConditionModel.load_config(str(Path(model_dir, name))))
+        else:
+            from transformers import CLIPTextConfig, CLIPTextModel
+            model = CLIPTextModel(CLIPTextConfig.from_pretrained(str(Path(model_dir, name))))
+
+    res: List[Tuple[str, Tuple[int, int]]] = []
+    for ancestor_name, ancestor in model.named_modules():
+        if ancestor.__class__.__name__ not in TARGETS[name]:
+            continue
+        for layer_name, module in ancestor.named_modules():
+            if isinstance(module, torch.nn.Linear):
+                res.append((f"{ancestor_name}.{layer_name}", tuple(module.weight.shape)))
+    return res
+
+# tensors that are the same in tuned and base without reading them: those a packed
+# dir took from base.
+def _unchanged_keys(tuned: Mapping, model_dir: Path, base_dir: Path) -> Set[str]:
+    delta = tensordelta.read_delta(model_dir)
+    if delta is None or os.path.realpath(delta['base']) != os.path.realpath(base_dir):
+        return set()
+    if not isinstance(tuned, tensordelta.LazyStateDict):
+        return set()
+    return tuned.key_set - tuned.delta_keys
+
+def _zero_lora(shape: Tuple[int, int]) -> LayerLora:
+    return LayerLora(torch.zeros((shape[0], 1)), torch.zeros((1, shape[1])), 0.0)
+
+# LoRAs for a batch of weight differences of the same shape: rank max_rank, or the
+# smallest that keeps that fraction of each one's energy.
+def _decompose(batch: torch.Tensor, max_rank: int, energy: float, niter: int) -> List[LayerLora]:
+    q = min(max_rank + 8, batch.shape[-2], batch.shape[-1])
+    U, S, V = torch.svd_lowrank(batch, q=q, niter=niter)
+    totals = batch.pow(2).sum(dim=(-2, -1))
+    kept = S.pow(2).cumsum(dim=-1)
+
+    res: List[LayerLora] = []
+    for idx in range(batch.shape[0]):
+        total = totals[idx].item()
+        if total == 0:
+            res.append(_zero_lora(batch.shape[1:]))
+            continue
+        rank = min(max_rank, q)
+        if energy is not None:
+            reached = (kept[idx] >= energy * total).nonzero()
+            if len(reached) > 0:
+                rank = min(rank, reached[0].item() + 1)
+        # the LoRA is the projection of the difference onto the top singular
+        # vectors, so what it leaves out is exactly total - kept.
+        error = (max(total - kept[idx, rank - 1].item(), 0) / total) ** 0.5
+        # split the singular values between up and down, so neither gets very
+        # large or small values, which matters in fp16.
+        scale = S[idx, :rank].sqrt()
+        up = (U[idx, :, :rank] * scale).cpu().contiguous()
+        down = (V[idx, :, :rank] * scale).T.cpu().contiguous()
+        res.append(LayerLora(up, down, error))
+    return res
+
+def extract(base_dir: Path, model_dir: Path, name: str, max_rank: int, energy: float,
+            batch_size: int, device: str, niter: int) -> List[LayerLora]:
+    layers = lora_layers(base_dir, name)
+    base = tensordelta.component_state_dict(str(base_dir), name)
+    tuned = tensordelta.component_state_dict(str(model_dir), name)
+    unchanged = _unchanged_keys(tuned, model_dir, base_dir)
+
+    # layers of the same shape, in order, so each batch stacks into one tensor.
+    by_shape: Dict[Tuple[int, int], List[int]] = dict()
+    for idx, (layer, shape) in enumerate(layers):
+        key = f"{layer}.weight"
+        if key not in tuned or key not in base:
+            raise Exception(f"{model_dir}/{name} or {base_dir}/{name} has no {key}; are they models of the same kind?")
+        by_shape.setdefault(shape, []).append(idx)
+
+    res: List[LayerLora] = [None] * len(layers)
+    for shape, indices in by_shape.items():
+        for idx in indices:
+            if f"{layers[idx][0]}.weight" in unchanged:
+                res[idx] = _zero_lora(shape)
+        indices = [idx for idx in indices if res[idx] is None]
+
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            diffs = list()
+            for idx in chunk:
+                key = f"{layers[idx][0]}.weight"
+                diffs.append(tuned[key].to(device, torch.float32) - base[key].to(device, torch.float32))
+            batch = torch.stack(diffs)
+            del diffs
+            for idx, lora in zip(chunk, _decompose(batch, max_rank, energy, niter)):
+                res[idx] = lora
+            del batch
+
+    for (layer, shape), lora in zip(layers, res):
+        print(f"  {layer:64} {str(list(shape)):13} rank {lora.down.shape[0]:3}  error {lora.error:.4f}")
+    return res
+
+def save_lora(path: Path, loras: Dict[str, List[LayerLora]], dtype: torch.dtype, metadata: Dict[str, str]):
+    weights: Dict[str, torch.Tensor] = dict()
+    metadata = dict(metadata)
+    # the lora_diffusion format: <component>:<layer index>:up/down, and the target
+    # module classes and each layer's rank in the metadata.
+    for name, layers in loras.items():
+        metadata[name] = json.dumps(sorted(TARGETS[name]))
+        for idx, layer in enumerate(layers):
+            metadata[f"{name}:{idx}:rank"] = str(layer.down.shape[0])
+            weights[f"{name}:{idx}:up"] = layer.up.to(dtype)
+            weights[f"{name}:{idx}:down"] = layer.down.to(dtype)
+
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    safetensors.torch.save_file(weights, str(tmp_path), metadata=metadata)
+    os.replace(tmp_path, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extract a LoRA from a fine-tuned model, against its base model",
+                                     epilog="either model may be a .ckpt or .safetensors checkpoint; it's converted to diffusers first, which loads the whole model.")
+    parser.add_argument("base_model", type=Path, help="model the fine-tuned one was trained from, e.g. /home/tim/models/f222v")
+    parser.add_argument("model", type=Path, help="fine-tuned model dir or checkpoint")
+    parser.add_argument("-o", "--output", type=Path, default=None,
+                        help="default: <model>/lora-r<rank>.safetensors, or for a checkpoint, <model>-lora-r<rank>.safetensors next to it")
+    parser.add_argument("-r", "--rank", type=int, default=16, help="rank of each layer, or with --energy, the highest rank")
+    parser.add_argument("--energy", type=float, default=None, help="use the smallest rank that keeps this fraction (0-1) of each layer's energy")
+    parser.add_argument("--components", nargs='+', default=["unet", "text_encoder"], choices=list(TARGETS.keys()))
+    parser.add_argument("--batch", type=int, default=8, help="layers of the same shape to decompose at once")
+    parser.add_argument("--niter", type=int, default=4, help="power iterations for svd_lowrank; more is more accurate")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--fp32", default=False, action='store_true', help="save as fp32 instead of fp16")
+    args = parser.parse_args()
+
+    if args.energy is not None and not (0 < args.energy <= 1):
+        parser.error("--energy must be between 0 and 1")
+    if args.output is None:
+        suffix = f"-e{args.energy}" if args.energy is not None else ""
+        if is_single_file(str(args.model)):
+            args.output = args.model.with_name(f"{args.model.stem}-lora-r{args.rank}{suffix}.safetensors")
+        else:
+            args.output = Path(args.model, f"lora-r{args.rank}{suffix}.safetensors")
+
+    time_start = time.perf_counter()
+    loras: Dict[str, List[LayerLora]] = dict()
+    inputs_dir = args.output.with_name(f".{args.output.name}.{os.getpid()}.inputs")
+    try:
+        base_dir = Path(input_dir(str(args.base_model), Path(inputs_dir, "base"), torch.float32))
+        model_dir = Path(input_dir(str(args.model), Path(inputs_dir, "model"), torch.float32))
+        with torch.no_grad():
+            for name in args.components:
+                if not Path(model_dir, name).is_dir():
+                    print(f"{args.model} has no {name}, skipping it")
+                    continue
+                print(f"{name}:")
+                layers = extract(base_dir, model_dir, name, args.rank, args.energy, args.batch, args.device, args.niter)
+                if all(layer.up.count_nonzero() == 0 for layer in layers):
+                    # not fine-tuned; leave it out, rather than patch in a no-op.
+                    print(f"  {name} is the same as the base's, leaving it out")
+                    continue
+                errors = [layer.error for layer in layers]
+                ranks = [layer.down.shape[0] for layer in layers]
+                print(f"  {len(layers)} layers, mean rank {sum(ranks) / len(ranks):.1f}, "
+                      f"error mean {sum(errors) / len(errors):.4f} max {max(errors):.4f}")
+                loras[name] = layers
+    finally:
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+
+    if len(loras) == 0:
+        print(f"{args.model} is the same as {args.base_model}, nothing to write")
+    else:
+        metadata = {'base_model': os.path.realpath(args.base_model), 'model': os.path.realpath(args.model)}
+        save_lora(args.output, loras, torch.float32 if args.fp32 else torch.float16, metadata)
+        print(f"wrote {args.output}, {args.output.stat().st_size / 1024 / 1024:.1f}Mb, "
+              f"{time.perf_counter() - time_start:.1f}s")
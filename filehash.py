@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# sha256 of (big) files, remembered in ~/.cache/sd-scripts/file-hashes.json so each
+# file is only read once. a remembered hash is used as long as the file's size,
+# mtime and inode haven't changed. files are read in chunks, and hashed on a thread
+# pool by sha256_files; hashlib releases the GIL while hashing.
+#
+# usage:
+#   filehash.py <file> [<file> ...]
+import sys
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+CACHE_PATH = Path.home() / ".cache" / "sd-scripts" / "file-hashes.json"
+CHUNK_SIZE = 16 * 1024 * 1024
+PARTIAL_SIZE = 1024 * 1024
+
+def _stat_key(st: os.stat_result) -> List[int]:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def sha256_file(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# hash of the first and last PARTIAL_SIZE bytes and the size: cheap to compute, and
+# files with different partial hashes can't be the same.
+def partial_sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        sha.update(str(size).encode())
+        sha.update(file.read(PARTIAL_SIZE))
+        if size > PARTIAL_SIZE:
+            file.seek(max(PARTIAL_SIZE, size - PARTIAL_SIZE))
+            sha.update(file.read(PARTIAL_SIZE))
+    return sha.hexdigest()
+
+# the hash in path's .sha256 sidecar (from share-model-components.py), unless the
+# sidecar is missing or older than the file.
+def sidecar_sha256(path: Path) -> str:
+    sha_file = Path(path).with_name(Path(path).name + ".sha256")
+    try:
+        if sha_file.stat().st_mtime_ns < os.stat(path).st_mtime_ns:
+            return None
+        return sha_file.read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+# total size of the files under path.
+def dir_bytes(path: Path) -> int:
+    return sum(child.stat().st_size for child in Path(path).rglob("*") if child.is_file())
+
+class HashCache:
+    path: Path
+
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        # realpath -> [size, mtime_ns, inode, sha256]
+        self.entries: Dict[str, List] = dict()
+        self.dirty = False
+        if path.exists():
+            try:
+                self.entries = json.load(open(path, "r"))
+            except json.JSONDecodeError:
+                self.entries = dict()
+
+    # the remembered hash of path, or None if it's unknown or the file has changed.
+    def get(self, path: Path) -> str:
+        realpath = os.path.realpath(path)
+        entry = self.entries.get(realpath)
+        if entry is None or entry[:3] != _stat_key(os.stat(realpath)):
+            return None
+        return entry[3]
+
+    def put(self, path: Path, st: os.stat_result, sha: str):
+        with self.lock:
+            self.entries[os.path.realpath(path)] = _stat_key(st) + [sha]
+            self.dirty = True
+
+    # the hash of path if it's known without reading it: remembered, or from a
+    # sidecar that's newer than the file.
+    def known(self, path: Path) -> str:
+        sha = self.get(path)
+        if sha is None:
+            sha = sidecar_sha256(path)
+            if sha is not None:
+                self.put(path, os.stat(path), sha)
+        return sha
+
+    def sha256(self, path: Path) -> str:
+        sha = self.get(path)
+        if sha is None:
+            st = os.stat(path)
+            sha = sha256_file(path)
+            # don't remember a hash of a file that changed while it was read.
+            if _stat_key(os.stat(path)) == _stat_key(st):
+                self.put(path, st, sha)
+        return sha
+
+    # hashes of paths, num_threads at a time.
+    def sha256_files(self, paths: Iterable[Path], num_threads: int = 4) -> Dict[Path, str]:
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            return dict(zip(paths, pool.map(self.sha256, paths)))
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            # other processes may have remembered files since this cache was loaded.
+            if self.path.exists():
+                try:
+                    entries = json.load(open(self.path, "r"))
+                    entries.update(self.entries)
+                    self.entries = entries
+                except json.JSONDecodeError:
+                    pass
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "w") as file:
+                json.dump(self.entries, file)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"usage: {sys.argv[0]} <file> [<file> ...]")
+        sys.exit(1)
+
+    cache = HashCache()
+    for filename in sys.argv[1:]:
+        print(f"{cache.sha256(Path(filename))}  {filename}")
+    cache.save()
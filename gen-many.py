@@ -1,18 +1,29 @@
+from __future__ import annotations
 import sys
 import os
 import os.path
-import re
-import subprocess
 import argparse
 import shlex
 import time
 import datetime
-import json
-from collections import namedtuple, deque
-from typing import List
+import itertools
+from collections import deque
+from typing import Dict, List, Tuple
 
-import txt2img
-from txt2img import ImageSet
+import gendaemon
+import runlog
+import imageset
+import workclaim
+from imageset import ImageSet
+
+# txt2img pulls in torch and diffusers, which take seconds to import. planning only
+# needs imageset, so txt2img is imported once there's something to generate.
+txt2img = None
+
+def import_txt2img():
+    global txt2img
+    if txt2img is None:
+        import txt2img
 
 # ddim, k_dpm_2_a, k_dpm_2, k_euler_a, k_euler, k_heun, k_lms, plms
 
@@ -36,61 +47,381 @@ def gen_renders(config: argparse.Namespace):
                                     width=config.width, height=config.height)
                     yield one
 
-def gen(image_gen: txt2img.ImageGenerator, config: argparse.Namespace):
-    for one in gen_renders(config):
+# relative cost of switching between consecutive ImageSets.
+COST_MODEL = 100
+COST_SAMPLER = 10
+COST_RESOLUTION = 1
+
+def transition_cost(prev: ImageSet, one: ImageSet) -> int:
+    if prev is None or prev.model_dir != one.model_dir:
+        return COST_MODEL
+    if prev.sampler_name != one.sampler_name:
+        return COST_SAMPLER
+    if (prev.width, prev.height) != (one.width, one.height):
+        return COST_RESOLUTION
+    return 0
+
+def plan_cost(image_sets: List[ImageSet]) -> int:
+    return sum(transition_cost(prev, one) for prev, one in zip([None] + image_sets[:-1], image_sets))
+
+# materialise all renders, drop the ones that are already complete, and order the
+# rest so that each model is loaded once, each sampler is set up once per model,
+# and so on. ties keep the order from the command line.
+def plan_renders(config: argparse.Namespace) -> List[ImageSet]:
+    all_sets = list(gen_renders(config))
+    imageset.DIR_LISTING.clear()
+    num_needed = {one.output_dir: len(imageset.needed_indices(one, latents=config.latents)) for one in all_sets}
+    image_sets = [one for one in all_sets if num_needed[one.output_dir] > 0]
+
+    def first_seen(values: List) -> Dict:
+        res: Dict = dict()
+        for value in values:
+            res.setdefault(value, len(res))
+        return res
+
+    model_order = first_seen([one.model_dir for one in image_sets])
+    sampler_order = first_seen([one.sampler_name for one in image_sets])
+    res_order = first_seen([(one.width, one.height) for one in image_sets])
+    steps_order = first_seen([one.sampler_steps for one in image_sets])
+    planned = sorted(image_sets, key=lambda one: (model_order[one.model_dir],
+                                                  sampler_order[one.sampler_name],
+                                                  res_order[(one.width, one.height)],
+                                                  steps_order[one.sampler_steps]))
+
+    print(f"plan: {len(planned)} of {len(all_sets)} image sets need {sum(num_needed.values())} images")
+    for one in planned:
+        print(f"  {num_needed[one.output_dir]:3}/{one.num_images} {one.model_str} {one.sampler_name}:{one.sampler_steps} {one.width}x{one.height}: {one.output_dir}")
+    print(f"plan: estimated switch cost {plan_cost(planned)}, unplanned {plan_cost(image_sets)}"
+          f" (model load {COST_MODEL}, sampler {COST_SAMPLER}, resolution {COST_RESOLUTION})")
+    print()
+    return planned
+
+# pixels for an ImageSet resolution; 0 means the model's default, taken as 512.
+def num_pixels(width: int, height: int) -> int:
+    return (width or 512) * (height or 512)
+
+# predicts how long image_sets will take from the stats logged under the output root.
+# exact history for (model, sampler, steps, resolution, batch size) is used as is.
+# otherwise the time per image per step is taken from the closest history: same
+# model, sampler and resolution, then same model and resolution, then same
+# resolution, and last any history at all, scaled by pixel count.
+def estimate(config: argparse.Namespace, image_sets: List[ImageSet]):
+    index = runlog.RunIndex(config.output_dir)
+    index.update()
+    stats = index.stats()
+
+    # fallback levels: name, key function on a stats key, key function on an ImageSet.
+    levels = [
+        ("sampler", lambda key: (key[0], key[1], key[3], key[4]), lambda one: (one.model_dir, one.sampler_name, one.width, one.height)),
+        ("model", lambda key: (key[0], key[3], key[4]), lambda one: (one.model_dir, one.width, one.height)),
+        ("resolution", lambda key: (key[3], key[4]), lambda one: (one.width, one.height)),
+    ]
+    # [images * steps, seconds] per level key, and [images * steps * pixels, seconds] overall.
+    level_totals: List[Dict[Tuple, List]] = [dict() for _ in levels]
+    pixel_total = [0, 0.0]
+    # [loads, seconds] per model, and overall.
+    loads: Dict[str, List] = dict()
+    loads_total = [0, 0.0]
+    for key, (images, seconds, num_loads, load_seconds) in stats.items():
+        for (_name, stats_fun, _set_fun), totals in zip(levels, level_totals):
+            one = totals.setdefault(stats_fun(key), [0, 0.0])
+            one[0] += images * key[2]
+            one[1] += seconds
+        pixel_total[0] += images * key[2] * num_pixels(key[3], key[4])
+        pixel_total[1] += seconds
+        model_loads = loads.setdefault(key[0], [0, 0.0])
+        model_loads[0] += num_loads
+        model_loads[1] += load_seconds
+        loads_total[0] += num_loads
+        loads_total[1] += load_seconds
+
+    def per_image(one: ImageSet) -> Tuple[float, str]:
+        exact = stats.get((one.model_dir, one.sampler_name, one.sampler_steps, one.width, one.height, config.batch_size))
+        if exact is not None and exact[0] > 0:
+            return exact[1] / exact[0], "exact"
+        for (name, _stats_fun, set_fun), totals in zip(levels, level_totals):
+            image_steps, seconds = totals.get(set_fun(one), [0, 0.0])
+            if image_steps > 0:
+                return seconds / image_steps * one.sampler_steps, name
+        if pixel_total[0] > 0:
+            return pixel_total[1] / pixel_total[0] * one.sampler_steps * num_pixels(one.width, one.height), "pixels"
+        return None, "none"
+
+    def load_time(model_dir: str) -> float:
+        num_loads, seconds = loads.get(model_dir, [0, 0.0])
+        if num_loads > 0:
+            return seconds / num_loads
+        return loads_total[1] / loads_total[0] if loads_total[0] > 0 else 0.0
+
+    def fmt(seconds: float) -> str:
+        return str(datetime.timedelta(seconds=round(seconds)))
+
+    time_total = 0.0
+    num_images = 0
+    num_unknown = 0
+    by_source: Dict[str, int] = dict()
+    print(f"estimate: from {len(index.dirs)} logged output dirs under {config.output_dir}, batch size {config.batch_size or 'auto'}")
+    for prev, one in zip([None] + image_sets[:-1], image_sets):
+        if prev is None or prev.model_dir != one.model_dir:
+            load_seconds = load_time(one.model_dir)
+            time_total += load_seconds
+            print(f"  {fmt(load_seconds):>9}  load {one.model_str}")
+
+        num_needed = len(imageset.needed_indices(one, latents=config.latents))
+        seconds, source = per_image(one)
+        by_source[source] = by_source.get(source, 0) + num_needed
+        if seconds is None:
+            num_unknown += num_needed
+            print(f"  {'?':>9}  {num_needed:3} images, no history: {one.output_dir}")
+            continue
+        time_total += seconds * num_needed
+        num_images += num_needed
+        print(f"  {fmt(seconds * num_needed):>9}  {num_needed:3} images x {seconds:.2f}s ({source}): {one.output_dir}")
+
+    sources = ", ".join(f"{count} {source}" for source, count in by_source.items())
+    print(f"estimate: {fmt(time_total)} for {num_images} images ({sources})")
+    if num_unknown > 0:
+        print(f"estimate: no history to estimate {num_unknown} images from")
+    print()
+
+def gen(image_gen: txt2img.ImageGenerator, config: argparse.Namespace, image_sets: List[ImageSet],
+        claims: workclaim.Claims = None):
+    gen_image_sets(image_gen, image_sets, config.pack, sys.argv, config.config_args,
+                   claims=claims, latents=config.latents)
+
+# render the first pack group of the plan, --check_packed images per set, packed and
+# then set by set, as latents into a temp dir under the output dir, and compare them.
+# each image's initial latents come from its own seed either way, but batched cuda
+# kernels don't promise the same bits for a row at different batch sizes, so packed
+# output matches within a tolerance rather than exactly. prints the largest
+# difference and the images/s of both, and exits 1 if the difference is over
+# --pack_tolerance.
+def check_packed(image_gen: txt2img.ImageGenerator, config: argparse.Namespace, image_sets: List[ImageSet]):
+    import shutil
+    import torch
+    import safetensors.torch
+
+    group = list(next(itertools.groupby(image_sets, key=imageset.pack_key))[1])
+    check_dir = os.path.join(config.output_dir, f".check-packed.{os.getpid()}")
+    def copies(name: str) -> List[ImageSet]:
+        res = list()
+        for one in group:
+            kwargs = one.to_dict()
+            kwargs.update(root_output_dir=os.path.join(check_dir, name), num_images=min(config.check_packed, one.num_images))
+            res.append(ImageSet(**kwargs))
+        return res
+
+    # seconds spent generating sets, not counting model loads.
+    def timed(sets_list: List[List[ImageSet]]) -> float:
         time_start = time.perf_counter()
-        num_generated = image_gen.gen_images(one)
-        time_end = time.perf_counter()
-
-        if num_generated > 0:
-            filename = f"{one.output_dir}/gen-many.json"
-            if os.path.exists(filename):
-                stats_root = json.load(open(filename, "r"))
-            else:
-                stats_root = {}
-
-            if 'runs' not in stats_root:
-                stats_root['runs'] = []
-            
-            stats_array = stats_root['runs']
-            with open(filename, "w") as file:
-                stats = {}
-                stats['timestamp'] = datetime.datetime.now().ctime()
-                stats['argv'] = sys.argv
-                stats['config_args'] = config.config_args
-                stats['num_generated'] = num_generated
-                stats['image_set'] = {
-                    'output_dir': one.output_dir,
-                    'prompt': one.prompt,
-                    'negative_prompt': one.negative_prompt,
-                    'model_dir': one.model_dir,
-                    'sampler_name': one.sampler_name,
-                    'sampler_steps': one.sampler_steps,
-                    'guidance_scale': one.guidance_scale,
-                    'base_seed': config.base_seed,
-                    'width': config.width,
-                    'height': config.height,
-                }
-                stats['timing'] = {
-                    'total': (time_end - time_start),
-                    'per_image': (time_end - time_start) / num_generated,
-                }
-                stats_array.append(stats)
-                json.dump(stats_root, file, indent=2)
+        for sets in sets_list:
+            image_gen.gen_images_packed(sets)
+        image_gen.flush()
+        seconds = time.perf_counter() - time_start
+        return seconds - sum(image_gen.timings.pop(one)['model_load'] for sets in sets_list for one in sets)
+
+    defaults = (image_gen.num_parallel, image_gen.output_latents, image_gen.decode_mode)
+    image_gen.set_options(defaults[0], True, defaults[2])
+    try:
+        packed, single = copies("packed"), copies("single")
+        single_seconds = timed([[one] for one in single])
+        packed_seconds = timed([packed])
+
+        max_diff = 0.0
+        num_images = 0
+        for packed_one, single_one in zip(packed, single):
+            for idx in range(packed_one.num_images):
+                paths = [imageset.latents_filename(imageset.image_filename(one, idx)) for one in [packed_one, single_one]]
+                latents = [safetensors.torch.load_file(path)['latents'].float() for path in paths]
+                max_diff = max(max_diff, (latents[0] - latents[1]).abs().max().item())
+                num_images += 1
+    finally:
+        image_gen.set_options(*defaults)
+        shutil.rmtree(check_dir, ignore_errors=True)
+
+    print(f"check packed: {len(group)} sets, {num_images} images, max abs latents diff {max_diff:.6f}, tolerance {config.pack_tolerance}")
+    print(f"  packed {num_images / packed_seconds:.2f} images/s, set by set {num_images / single_seconds:.2f} images/s")
+    sys.exit(0 if max_diff <= config.pack_tolerance else 1)
+
+# generate image_sets in order, and log stats for each one. when run for a daemon job,
+# updates its progress and stops early if it's cancelled.
+#
+# images are saved in the background while the next group is generated, so a set's
+# stats are written once its saves are done, and include their time. only the end
+# of the plan waits for all saves.
+#
+# with claims, other workers may be running the same plan: image_gen's claim_fun
+# only hands out what this worker has claimed. a group is run until there's nothing
+# left in it to claim, and once the plan is through, images claimed by other workers
+# are waited for (and taken over if their worker dies) until all exist. claims are
+# released only once their images are saved, so a group's saves are waited for then.
+def gen_image_sets(image_gen: txt2img.ImageGenerator, image_sets: List[ImageSet], pack: bool,
+                   argv: List[str], config_args: List[str], job: gendaemon.Job = None,
+                   claims: workclaim.Claims = None, latents: bool = False):
+    run_log = runlog.RunLog()
+    # (image set, images generated, generation seconds) whose stats aren't written yet.
+    unlogged: List[Tuple[ImageSet, int, float]] = list()
+
+    def write_saved(wait: bool):
+        if wait:
+            image_gen.flush()
+        for entry in list(unlogged):
+            one, one_generated, seconds = entry
+            if not image_gen.saver.is_saving(one):
+                write_stats(run_log, one, argv, config_args, image_gen, one_generated, seconds)
+                unlogged.remove(entry)
+
+    while len(image_sets) > 0:
+        if pack:
+            # the plan keeps sets with the same pack key next to each other.
+            groups = [list(group) for _key, group in itertools.groupby(image_sets, key=imageset.pack_key)]
+        else:
+            groups = [[one] for one in image_sets]
+
+        for group in groups:
+            if job is not None and job.cancelled:
+                break
+
+            while True:
+                time_start = time.perf_counter()
+                num_generated = image_gen.gen_images_packed(group)
+                time_end = time.perf_counter()
+
+                # time is shared by the whole group, so split it by image count.
+                total_generated = sum(num_generated)
+                for one, one_generated in zip(group, num_generated):
+                    if one_generated > 0:
+                        unlogged.append((one, one_generated, (time_end - time_start) * one_generated / total_generated))
+                write_saved(wait=claims is not None)
+                if claims is not None:
+                    claims.release_all()
+
+                if job is not None:
+                    job.num_generated += total_generated
+                if claims is None or total_generated == 0:
+                    break
+
+            if job is not None:
+                job.sets_done += len(group)
+
+        if claims is None or (job is not None and job.cancelled):
+            break
+
+        imageset.DIR_LISTING.clear()
+        image_sets = [one for one in image_sets if len(imageset.needed_indices(one, latents=latents)) > 0]
+        if len(image_sets) > 0:
+            print(f"waiting on other workers for {len(image_sets)} image sets")
+            time.sleep(claims.heartbeat)
+
+    try:
+        write_saved(wait=True)
+    finally:
+        run_log.close()
+
+def write_stats(run_log: runlog.RunLog, one: ImageSet, argv: List[str], config_args: List[str], image_gen: txt2img.ImageGenerator, num_generated: int, time_total: float):
+    stats = {}
+    stats['timestamp'] = datetime.datetime.now().ctime()
+    stats['argv'] = argv
+    stats['config_args'] = config_args
+    stats['num_generated'] = num_generated
+    stats['batch_size'] = image_gen.num_parallel
+    stats['image_set'] = {
+        'output_dir': one.output_dir,
+        'prompt': one.prompt,
+        'negative_prompt': one.negative_prompt,
+        'model_dir': one.model_dir,
+        'sampler_name': one.sampler_name,
+        'sampler_steps': one.sampler_steps,
+        'guidance_scale': one.guidance_scale,
+        'base_seed': one.seed,
+        'width': one.width,
+        'height': one.height,
+    }
+    stats['timing'] = {
+        'total': time_total,
+        'per_image': time_total / num_generated,
+        'phases': image_gen.timings.pop(one),
+    }
+    # cumulative for this gen-many process.
+    stats['text_cache'] = {
+        'hits': image_gen.text_cache.hits,
+        'misses': image_gen.text_cache.misses,
+    }
+    run_log.append(one.output_dir, stats)
+
+# run as a daemon: keep image_gen and its loaded models around, and generate the
+# ImageSets that "gen-many.py --submit" sends.
+def serve(image_gen: txt2img.ImageGenerator, config: argparse.Namespace):
+    def run_job(job: gendaemon.Job):
+        image_sets = [ImageSet(**kwargs) for kwargs in job.request['image_sets']]
+        # files may have changed since the last job.
+        imageset.DIR_LISTING.clear()
+        # the submitting gen-many's settings, for this job only.
+        defaults = (image_gen.num_parallel, image_gen.output_latents, image_gen.decode_mode)
+        image_gen.set_options(job.request.get('batch_size', defaults[0]), job.request.get('latents', defaults[1]),
+                              job.request.get('decode_mode', defaults[2]))
+        try:
+            gen_image_sets(image_gen, image_sets, job.request.get('pack', False),
+                           job.request.get('argv', []), job.request.get('config_args', []), job)
+        finally:
+            image_gen.set_options(*defaults)
+
+    gendaemon.serve(run_job, config.port)
+
+# hand the ImageSets that need images to the daemon.
+def submit(config: argparse.Namespace, image_sets: List[ImageSet]):
+    image_set_dicts = [one.to_dict() for one in image_sets]
+    # the daemon has its own working dir.
+    for one in image_set_dicts:
+        one['root_output_dir'] = os.path.abspath(one['root_output_dir'])
+        if os.path.exists(one['model_dir']):
+            one['model_dir'] = os.path.abspath(one['model_dir'])
+    request = {
+        'image_sets': image_set_dicts,
+        'pack': config.pack,
+        'batch_size': config.batch_size,
+        'latents': config.latents,
+        'decode_mode': config.decode_mode,
+        'priority': config.priority,
+        'argv': sys.argv,
+        'config_args': config.config_args,
+    }
+    job = gendaemon.submit(request, config.port)
+    print(f"submitted job {job['id']}: {job['num_sets']} image sets, priority {job['priority']}")
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="gen many sample images")
-    parser.add_argument("-p", "--prompt", dest='prompts', nargs='+', action='append', required=True)
+    parser.add_argument("-p", "--prompt", dest='prompts', nargs='+', action='append')
     parser.add_argument("-N", "--negative_prompt", "--neg", dest='negative_prompts', nargs='+', action='append')
-    parser.add_argument("-m", "--model", dest='models', nargs='+', action='append', required=True)
-    parser.add_argument("-o", "--output", dest='output_dir', required=True, help="output directory")
+    parser.add_argument("-m", "--model", dest='models', nargs='+', action='append')
+    parser.add_argument("-o", "--output", dest='output_dir', help="output directory")
     parser.add_argument("-s", "--sampler", dest='samplers', nargs='+', action='append')
     parser.add_argument("-n", "--num", dest='num_images', type=int, default=10, help="num images")
     parser.add_argument("--seed", dest='base_seed', type=int, default=0)
     parser.add_argument("--cfg", dest='cfgs', nargs='+', action='append', help="guidance scale")
-    parser.add_argument("--batch", dest='batch_size', type=int, default=1, help="num images to generate in parallel")
+    parser.add_argument("--batch", dest='batch_size', type=lambda arg: 0 if arg == "auto" else int(arg), default=1,
+                        help="num images to generate in parallel, or 'auto' to find the largest batch that fits")
+    parser.add_argument("--pack", default=False, action='store_true', help="pack images from different prompts/cfgs into the same batch")
+    parser.add_argument("--check_packed", type=int, default=0, help="render this many images of each set in the plan's first pack group packed and set by set, compare their latents and speed, then exit")
+    parser.add_argument("--pack_tolerance", type=float, default=0.05, help="max abs latents difference for --check_packed")
+    parser.add_argument("--text_cache", dest="text_cache_size", type=int, default=256, help="max prompt embeddings to keep cached, 0 to disable")
+    parser.add_argument("--pool_gb", type=float, default=0, help="keep loaded models around up to this many Gb of weights")
+    parser.add_argument("--no_model_cache", dest="model_cache", default=True, action='store_false', help="load models from their own dirs instead of the fp16 safetensors cache (see modelcache.py)")
+    parser.add_argument("--model_cache_gb", type=float, default=40, help="keep the fp16 model cache under this many Gb, removing the least recently used models")
+    parser.add_argument("--save_threads", type=int, default=2, help="threads for saving images in the background, 0 to save inline")
+    parser.add_argument("--latents", default=False, action='store_true', help="save final latents instead of images; decode them later with decode-latents.py")
+    parser.add_argument("--decode", dest="decode_mode", choices=imageset.DECODE_MODES, default="auto", help="how to run the VAE decode; auto picks by resolution and free memory")
     parser.add_argument("--width", dest="width", type=int, default=0)
     parser.add_argument("--height", dest="height", type=int, default=0)
+    parser.add_argument("--serve", default=False, action='store_true', help="run as a daemon that generates jobs sent with --submit")
+    parser.add_argument("--submit", default=False, action='store_true', help="send the planned renders to a --serve daemon instead of generating them")
+    parser.add_argument("--priority", type=int, default=0, help="with --submit: higher priority jobs run first")
+    parser.add_argument("--dry-run", dest="dry_run", default=False, action='store_true', help="print the plan and how many images each image set needs, then exit")
+    parser.add_argument("--estimate", default=False, action='store_true', help="print the plan with a runtime estimate from earlier runs' stats, then exit")
+    parser.add_argument("--claim", choices=["set", "image"], help="share the plan with other gen-many processes using the same output dir, claiming whole image sets or single images")
+    parser.add_argument("--claim_timeout", type=float, default=120, help="with --claim: seconds without a heartbeat before a worker's claims are taken over")
+    parser.add_argument("--claim_chunk", type=int, default=0, help="with --claim image: images to claim at a time, default the batch size")
+    parser.add_argument("--port", type=int, default=gendaemon.DEFAULT_PORT, help="localhost port for --serve and --submit")
     parser.add_argument("-f", dest="filename", help="read command line arguments from file") # dummy so the help shows this argument
 
     # support loading from a file with "-f filename". using parser.add_argument for
@@ -108,6 +439,15 @@ def parse_args() -> argparse.Namespace:
         config_args.append(arg)
 
     config = parser.parse_args(config_args)
+    # save this for the logfile.
+    config.config_args = config_args
+    if config.serve:
+        return config
+
+    for name, value in [("-p/--prompt", config.prompts), ("-m/--model", config.models), ("-o/--output", config.output_dir)]:
+        if value is None:
+            parser.error(f"the following arguments are required: {name}")
+
     if config.negative_prompts is None:
         config.negative_prompts = [[]]
     if config.cfgs is None:
@@ -124,11 +464,41 @@ def parse_args() -> argparse.Namespace:
     if len(config.negative_prompts) > 1 and len(config.negative_prompts) != len(config.prompts):
         raise Exception(f"got {len(config.prompts)} and {len(config.negative_prompts)}. negative must be 0, 1, or the same length as prompts")
 
-    # save this for the logfile.
-    config.config_args = config_args
     return config
 
 if __name__ == "__main__":
     config = parse_args()
-    image_gen = txt2img.ImageGenerator(config.batch_size)
-    gen(image_gen, config)
+    if not config.serve:
+        image_sets = plan_renders(config)
+        if config.estimate:
+            estimate(config, image_sets)
+        if config.dry_run or config.estimate or len(image_sets) == 0:
+            sys.exit(0)
+        if config.submit:
+            submit(config, image_sets)
+            sys.exit(0)
+
+    claims = None
+    claim_fun = None
+    if config.claim and not config.serve:
+        claims = workclaim.Claims(timeout=config.claim_timeout)
+        chunk = config.claim_chunk or config.batch_size or 8
+        def claim_fun(image_set: ImageSet, needed: List[int]) -> List[int]:
+            return workclaim.claim_indices(claims, image_set, needed, per_set=(config.claim == "set"),
+                                           chunk=0 if config.claim == "set" else chunk, latents=config.latents)
+
+    import_txt2img()
+    image_gen = txt2img.ImageGenerator(config.batch_size, text_cache_size=config.text_cache_size,
+                                       pool_bytes=int(config.pool_gb * 1024 * 1024 * 1024),
+                                       save_threads=config.save_threads,
+                                       output_latents=config.latents,
+                                       decode_mode=config.decode_mode,
+                                       claim_fun=claim_fun,
+                                       model_cache=config.model_cache,
+                                       model_cache_bytes=int(config.model_cache_gb * 1024 * 1024 * 1024))
+    if config.serve:
+        serve(image_gen, config)
+    elif config.check_packed > 0:
+        check_packed(image_gen, config, image_sets)
+    else:
+        gen(image_gen, config, image_sets, claims)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# job queue and localhost HTTP API for a long-lived generation process, started with
+# "gen-many.py --serve". the server keeps its ImageGenerator (and loaded models)
+# between jobs; "gen-many.py --submit" plans as usual and sends the ImageSets here.
+#
+# API, all json:
+#   POST   /jobs       {"image_sets": [...], "pack": bool, "priority": int, ...} -> job status
+#   GET    /jobs       -> [job status, ...]
+#   GET    /jobs/<id>  -> job status
+#   DELETE /jobs/<id>  -> job status. queued jobs are dropped, running jobs stop after
+#                         the ImageSet (or packed group) they're on.
+#
+# jobs with higher priority run first, same priority in submission order.
+#
+# usage:
+#   gendaemon.py status [<id>] [--port N]
+#   gendaemon.py cancel <id> [--port N]
+import json
+import heapq
+import threading
+import argparse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_PORT = 7870
+
+class Job:
+    id: int
+    priority: int
+    request: Dict
+    state: str
+    num_sets: int
+    sets_done: int = 0
+    num_generated: int = 0
+    cancelled: bool = False
+    error: str = None
+
+    def __init__(self, id: int, request: Dict):
+        self.id = id
+        self.request = request
+        self.priority = int(request.get('priority', 0))
+        self.num_sets = len(request.get('image_sets', []))
+        self.state = "queued"
+
+    def status(self) -> Dict:
+        return {
+            'id': self.id,
+            'state': self.state,
+            'priority': self.priority,
+            'num_sets': self.num_sets,
+            'sets_done': self.sets_done,
+            'num_generated': self.num_generated,
+            'error': self.error,
+        }
+
+class JobQueue:
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.heap: List[Tuple[int, int, Job]] = list()
+        self.jobs: Dict[int, Job] = dict()
+        self.next_id = 1
+
+    def submit(self, request: Dict) -> Job:
+        with self.lock:
+            job = Job(self.next_id, request)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            heapq.heappush(self.heap, (-job.priority, job.id, job))
+            self.lock.notify()
+            return job
+
+    # blocks until there's a job to run.
+    def next(self) -> Job:
+        with self.lock:
+            while True:
+                while len(self.heap) == 0:
+                    self.lock.wait()
+                _priority, _id, job = heapq.heappop(self.heap)
+                if job.state == "queued":
+                    job.state = "running"
+                    return job
+
+    # statuses of all jobs, or of job id (None if there's no such job). the http
+    # threads read jobs through this, as submit and cancel change them.
+    def snapshot(self, id: int = None):
+        with self.lock:
+            if id is None:
+                return [job.status() for job in self.jobs.values()]
+            job = self.jobs.get(id)
+            return job.status() if job is not None else None
+
+    def cancel(self, id: int) -> Job:
+        with self.lock:
+            job = self.jobs.get(id)
+            if job is None:
+                return None
+            job.cancelled = True
+            if job.state == "queued":
+                job.state = "cancelled"
+            return job
+
+def _handler_class(jobs: JobQueue):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _job_id(self) -> int:
+            parts = self.path.strip("/").split("/")
+            if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+                return int(parts[1])
+            return None
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/jobs":
+                self._reply(200, jobs.snapshot())
+                return
+            status = jobs.snapshot(self._job_id()) if self._job_id() is not None else None
+            if status is None:
+                self._reply(404, {'error': f"no job {self.path}"})
+                return
+            self._reply(200, status)
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self._reply(404, {'error': f"unknown path {self.path}"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            job = jobs.submit(request)
+            self._reply(200, job.status())
+
+        def do_DELETE(self):
+            job = jobs.cancel(self._job_id())
+            if job is None:
+                self._reply(404, {'error': f"no job {self.path}"})
+                return
+            self._reply(200, job.status())
+
+        def log_message(self, format: str, *args):
+            pass
+
+    return Handler
+
+# serve the API on a background thread and run jobs, one at a time, on this one.
+# run_job should check job.cancelled between units of work.
+def serve(run_job: Callable[[Job], None], port: int = DEFAULT_PORT):
+    jobs = JobQueue()
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler_class(jobs))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"\033[1mlistening on 127.0.0.1:{port}\033[0m")
+
+    while True:
+        job = jobs.next()
+        print(f"\033[1mjob {job.id}: {job.num_sets} image sets, priority {job.priority}\033[0m")
+        try:
+            run_job(job)
+            job.state = "cancelled" if job.cancelled else "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+            print(f"\033[1;31mjob {job.id} failed: {e}\033[0m")
+        print(f"\033[1mjob {job.id}: {job.state}, {job.num_generated} images\033[0m")
+
+def _request(method: str, path: str, port: int, body: Dict = None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data, method=method,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+def submit(request: Dict, port: int = DEFAULT_PORT) -> Dict:
+    return _request("POST", "/jobs", port, request)
+
+def status(id: int = None, port: int = DEFAULT_PORT):
+    return _request("GET", "/jobs" if id is None else f"/jobs/{id}", port)
+
+def cancel(id: int, port: int = DEFAULT_PORT) -> Dict:
+    return _request("DELETE", f"/jobs/{id}", port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="query or cancel jobs on a gen-many.py --serve daemon")
+    parser.add_argument("command", choices=["status", "cancel"])
+    parser.add_argument("id", type=int, nargs='?')
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    if args.command == "status":
+        res = status(args.id, args.port)
+        for one in (res if isinstance(res, list) else [res]):
+            print(f"{one['id']:4}  {one['state']:10} priority {one['priority']:3}  "
+                  f"{one['sets_done']}/{one['num_sets']} sets, {one['num_generated']} images"
+                  + (f"  {one['error']}" if one['error'] else ""))
+    else:
+        if args.id is None:
+            parser.error("cancel needs a job id")
+        print(cancel(args.id, args.port))
@@ -0,0 +1,162 @@
+# ImageSet and the parts of planning that don't need torch or diffusers, so that
+# gen-many.py can parse arguments, plan, and check for existing images without
+# importing them. txt2img re-exports everything here.
+import os
+from typing import Dict, List, Set, Tuple
+
+# samplers txt2img.SCHEDULERS knows how to build.
+SAMPLER_NAMES = ['ddim', 'euler', 'euler_a', 'dpm', 'dpm1', 'dpm2', 'dpm++1', 'dpm++2']
+
+class ImageSet:
+    model_dir: str
+    model_str: str
+    # model_name: str
+    # model_steps: int
+    # model_seed: int
+    root_output_dir: str
+    output_dir: str
+    sampler_name: str
+    sampler_steps: int
+    guidance_scale: float
+    prompt: str
+    negative_prompt: str
+    num_images: int
+    seed: int
+    width: int
+    height: int
+
+    def __init__(self,
+                 prompt: str, model_dir: str, 
+                 negative_prompt: str = None,
+                 model_str: str = "",
+                 root_output_dir: str = ".", 
+                 sampler_str: str = "dpm++1:20",
+                 guidance_scale: float = 7, num_images: int = 1, seed: int = 0,
+                 width: int = 0, height: int = 0):
+        self.model_dir = model_dir
+
+        if not model_str and model_dir:
+            path_components = model_dir.split("/")
+            last_component = path_components[-1].replace("checkpoint-", "").replace("save-", "").replace("epoch-", "")
+            if len(path_components) >= 2 and all([c.isdigit() for c in last_component]):
+                model_steps = last_component
+                model_name = path_components[-2]
+                model_str = f"{model_name}_{model_steps}"
+            else:
+                model_str = last_component
+
+        self.model_str = model_str
+        self.root_output_dir = root_output_dir
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+
+        self.sampler_name, self.sampler_steps = sampler_str.split(":")
+        self.sampler_steps = int(self.sampler_steps)
+        self.guidance_scale = guidance_scale
+        self.num_images = num_images
+        self.seed = seed
+
+        self.width = width
+        self.height = height
+
+        prompt_str = self.prompt
+        if self.negative_prompt:
+            prompt_str += f" || {negative_prompt}"
+
+        self.output_dir = f"{root_output_dir}/{self.model_str}--{prompt_str}--{self.sampler_name}_{self.sampler_steps},c{self.guidance_scale:02}"
+        if self.width:
+            self.output_dir += f",width{self.width}"
+        if self.height:
+            self.output_dir += f",height{self.height}"
+
+        if self.sampler_name not in SAMPLER_NAMES:
+            raise Exception(f"unknown scheduler '{self.sampler_name}'")
+
+    # constructor arguments, for sending ImageSets to gen-many.py --serve.
+    def to_dict(self) -> Dict:
+        return {
+            'prompt': self.prompt,
+            'model_dir': self.model_dir,
+            'negative_prompt': self.negative_prompt,
+            'model_str': self.model_str,
+            'root_output_dir': self.root_output_dir,
+            'sampler_str': f"{self.sampler_name}:{self.sampler_steps}",
+            'guidance_scale': self.guidance_scale,
+            'num_images': self.num_images,
+            'seed': self.seed,
+            'width': self.width,
+            'height': self.height,
+        }
+
+# ImageSets with the same pack key can share a UNet batch.
+def pack_key(image_set: ImageSet) -> Tuple:
+    return (image_set.model_dir, image_set.sampler_name, image_set.sampler_steps, image_set.width, image_set.height)
+
+# VAE decode modes: 'full' decodes the whole batch at once, 'sliced' one sample at a
+# time, and 'tiled' each sample in overlapping tiles that are blended together.
+# 'auto' picks the first one that fits in free memory.
+DECODE_MODES = ["auto", "full", "sliced", "tiled"]
+
+def image_filename(image_set: ImageSet, idx: int) -> str:
+    return f"{image_set.output_dir}/{idx + 1:02}.{image_set.seed + idx:010}.png"
+
+# where the final latents for an image go in latents mode. decode-latents.py turns
+# them into the PNG later.
+def latents_filename(filename: str) -> str:
+    return os.path.splitext(filename)[0] + ".latents.safetensors"
+
+# caches one listing per directory, so checking which images exist costs a listdir
+# per output dir instead of a stat per image. an output dir that's missing from its
+# (cached) parent listing isn't listed at all, so output dirs under one root cost a
+# single listdir of the root. listings live until clear(), which gen-many calls at
+# the start of every run, so files deleted by hand are always noticed.
+class DirListing:
+    def __init__(self):
+        self.listings: Dict[str, Set[str]] = dict()
+
+    def names(self, dirname: str) -> Set[str]:
+        if dirname not in self.listings:
+            parent, name = os.path.split(dirname)
+            if name and name not in self._listdir(parent or "."):
+                self.listings[dirname] = set()
+            else:
+                self._listdir(dirname)
+        return self.listings[dirname]
+
+    def exists(self, filename: str) -> bool:
+        dirname, name = os.path.split(filename)
+        return name in self.names(dirname or ".")
+
+    def add(self, filename: str):
+        dirname, name = os.path.split(filename)
+        dirname = dirname or "."
+        if dirname in self.listings:
+            self.listings[dirname].add(name)
+
+    def makedirs(self, dirname: str):
+        os.makedirs(dirname, exist_ok=True)
+        self.add(dirname)
+        self.listings.setdefault(dirname, set())
+
+    def clear(self):
+        self.listings.clear()
+
+    def _listdir(self, dirname: str) -> Set[str]:
+        if dirname not in self.listings:
+            try:
+                self.listings[dirname] = set(os.listdir(dirname))
+            except (FileNotFoundError, NotADirectoryError):
+                self.listings[dirname] = set()
+        return self.listings[dirname]
+
+DIR_LISTING = DirListing()
+
+# indices of the images in image_set that don't exist on disk yet. with latents=True,
+# images whose latents have been saved count as existing too.
+def needed_indices(image_set: ImageSet, latents: bool = False) -> List[int]:
+    names = DIR_LISTING.names(image_set.output_dir)
+    def exists(filename: str) -> bool:
+        if os.path.basename(filename) in names:
+            return True
+        return latents and os.path.basename(latents_filename(filename)) in names
+    return [idx for idx in range(image_set.num_images) if not exists(image_filename(image_set, idx))]
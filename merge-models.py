@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# merge models: a weighted sum, (1 - alpha) * A + alpha * B, or an add difference,
+# A + alpha * (B - C), which adds to A what training changed in C to get B (e.g. a
+# dreambooth output and the base model it was trained from).
+#
+# inputs are diffusers dirs (packed ones too, see tensordelta.py), or .ckpt or
+# .safetensors checkpoints in the original stable diffusion layout. those are first
+# converted to diffusers at --dtype, into a temp dir next to the output that's
+# removed afterwards; unlike the merge itself, the conversion loads the whole model.
+# the output is a diffusers dir with safetensors weights, that txt2img loads like
+# any other model. components not merged (see --components) are A's.
+#
+# merging goes a tensor at a time. input tensors are read from mmap'd safetensors
+# as they're needed, and the output file's header is written first, so each merged
+# tensor is written straight to its place in it by the worker that made it. so
+# only about --workers tensors of each input are in memory at once. the inputs must
+# have the same tensor names and shapes. each output file is then opened with
+# safetensors and its tensor names and shapes checked against those of the
+# component's model class, built from its config.
+#
+# usage:
+#   merge-models.py <A> <B> [--alpha 0.5] -o <out_dir>
+#   merge-models.py <A> <B> <C> --add_diff [--alpha 1.0] -o <out_dir>
+import os
+import json
+import math
+import time
+import shutil
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Mapping, Tuple
+
+import torch
+import safetensors
+
+import tensordelta
+from modelcache import input_dir
+
+MERGE_NAME = "merge.json"
+DTYPE_SIZES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+FLOAT_DTYPES = ["F64", "F32", "F16", "BF16"]
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+# writes a safetensors file whose tensors are known up front, a tensor at a time and
+# in any order, from any thread.
+class SafetensorsWriter:
+    path: Path
+    header: Dict[str, Dict]
+
+    def __init__(self, path: Path, infos: Dict[str, Tuple[str, List[int]]], metadata: Dict[str, str]):
+        self.path = path
+        self.header = dict()
+        offset = 0
+        for key in sorted(infos.keys()):
+            dtype, shape = infos[key]
+            size = DTYPE_SIZES[dtype] * math.prod(shape)
+            self.header[key] = {'dtype': dtype, 'shape': list(shape), 'data_offsets': [offset, offset + size]}
+            offset += size
+
+        header_bytes = json.dumps({'__metadata__': metadata, **self.header}, separators=(",", ":")).encode()
+        header_bytes += b" " * (-len(header_bytes) % 8)
+        self.data_start = 8 + len(header_bytes)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, struct.pack("<Q", len(header_bytes)) + header_bytes)
+        os.ftruncate(self.fd, self.data_start + offset)
+
+    def write(self, key: str, tensor: torch.Tensor):
+        start, end = self.header[key]['data_offsets']
+        data = memoryview(tensor.contiguous().view(-1).view(torch.uint8).numpy())
+        if len(data) != end - start:
+            raise Exception(f"{self.path}: {key} is {len(data)} bytes, expected {end - start}")
+        pos = self.data_start + start
+        while len(data) > 0:
+            num_written = os.pwrite(self.fd, data, pos)
+            data = data[num_written:]
+            pos += num_written
+
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+
+def _has_weights(model_dir: str, name: str) -> bool:
+    delta = tensordelta.read_delta(model_dir)
+    if delta is not None and name in delta['components']:
+        return True
+    return tensordelta.weights_file(Path(model_dir, name)) is not None
+
+def _info(state_dict: Mapping, key: str) -> Tuple[str, List[int]]:
+    if isinstance(state_dict, tensordelta.LazyStateDict):
+        return state_dict.tensor_info(key)
+    value = state_dict[key]
+    return tensordelta.DTYPE_NAMES[value.dtype], list(value.shape)
+
+# (dtype, shape) of each output tensor: A's shape, and dtype for float tensors.
+# raises if the inputs' tensors don't have the same names and shapes.
+def _output_infos(name: str, paths: List[str], inputs: List[Mapping], dtype: torch.dtype) -> Dict[str, Tuple[str, List[int]]]:
+    keys = set(inputs[0].keys())
+    for path, state_dict in zip(paths[1:], inputs[1:]):
+        other_keys = set(state_dict.keys())
+        if other_keys != keys:
+            missing = sorted(keys - other_keys)[:5]
+            extra = sorted(other_keys - keys)[:5]
+            raise Exception(f"{path}/{name} doesn't have the same tensors as {paths[0]}/{name}: missing {missing}, extra {extra}")
+
+    res: Dict[str, Tuple[str, List[int]]] = dict()
+    for key in keys:
+        infos = [_info(state_dict, key) for state_dict in inputs]
+        for path, (_other_dtype, other_shape) in zip(paths[1:], infos[1:]):
+            if list(other_shape) != list(infos[0][1]):
+                raise Exception(f"{name}.{key} is {other_shape} in {path}, {infos[0][1]} in {paths[0]}")
+        a_dtype, shape = infos[0]
+        res[key] = (tensordelta.DTYPE_NAMES[dtype] if a_dtype in FLOAT_DTYPES else a_dtype, shape)
+    return res
+
+def _merge_tensor(inputs: List[Mapping], key: str, alpha: float, add_diff: bool, dtype: torch.dtype) -> torch.Tensor:
+    tensor = inputs[0][key]
+    if not tensor.is_floating_point():
+        return tensor
+    if len(inputs) == 1:
+        return tensor.to(dtype)
+    # in fp32, so the differences of fp16 inputs don't lose precision.
+    tensor = tensor.to(torch.float32, copy=True)
+    other = inputs[1][key].to(torch.float32, copy=True)
+    if add_diff:
+        other -= inputs[2][key].to(torch.float32)
+        tensor.add_(other, alpha=alpha)
+    else:
+        tensor.lerp_(other, alpha)
+    return tensor.to(dtype)
+
+# write component name to out_dir: merged from inputs, or A's alone.
+def merge_component(name: str, paths: List[str], out_dir: Path, alpha: float, add_diff: bool,
+                    dtype: torch.dtype, num_workers: int) -> int:
+    inputs = [tensordelta.component_state_dict(path, name) for path in paths]
+    infos = _output_infos(name, paths, inputs, dtype)
+
+    component_dir = Path(paths[0], name)
+    component_out = Path(out_dir, name)
+    component_out.mkdir()
+    weights_name = None
+    for child in sorted(component_dir.iterdir()):
+        if child.name in tensordelta.WEIGHTS_NAMES or child.name == tensordelta.DELTA_WEIGHTS_NAME:
+            weights_name = weights_name or child.name
+        elif child.is_file() and not child.name.endswith(".sha256"):
+            shutil.copy2(child, Path(component_out, child.name))
+    if weights_name == tensordelta.DELTA_WEIGHTS_NAME or weights_name is None:
+        delta = tensordelta.read_delta(paths[0])
+        weights_name = Path(delta['components'][name]['base_file']).name
+    out_path = Path(component_out, tensordelta.safetensors_name(weights_name))
+
+    writer = SafetensorsWriter(out_path, infos, {'format': 'pt'})
+    def merge_one(key: str):
+        writer.write(key, _merge_tensor(inputs, key, alpha, add_diff, dtype))
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            # list() to raise the first exception a worker had.
+            list(pool.map(merge_one, sorted(infos.keys())))
+    finally:
+        writer.close()
+
+    _verify(out_dir, name, out_path)
+    return out_path.stat().st_size
+
+# check that the written file loads, and has the tensors the component's class
+# expects. position_ids is saved by some transformers versions and not others.
+def _verify(out_dir: Path, name: str, out_path: Path):
+    expected = {key: list(value.shape) for key, value in tensordelta.meta_model(str(out_dir), name).state_dict().items()}
+    with safetensors.safe_open(str(out_path), framework="pt") as file:
+        written = {key: file.get_slice(key).get_shape() for key in file.keys()}
+    missing = sorted(key for key in expected.keys() - written.keys() if not key.endswith("position_ids"))
+    extra = sorted(key for key in written.keys() - expected.keys() if not key.endswith("position_ids"))
+    if missing or extra:
+        raise Exception(f"{out_path}: missing {missing[:5]}, unexpected {extra[:5]} for {name}'s model class")
+    wrong = [key for key in expected.keys() & written.keys() if list(written[key]) != expected[key]]
+    if wrong:
+        raise Exception(f"{out_path}: {wrong[0]} is {written[wrong[0]]}, {name}'s model class has {expected[wrong[0]]}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="merge models by weighted sum or add difference, a tensor at a time")
+    parser.add_argument("models", nargs='+', help="A B for a weighted sum, A B C for --add_diff; diffusers dirs, or .ckpt/.safetensors "
+                        "files, which are converted at --dtype first (loading the whole model)")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="diffusers dir to write")
+    parser.add_argument("--alpha", type=float, default=None, help="weight of B (default 0.5), or with --add_diff, of B - C (default 1.0)")
+    parser.add_argument("--add_diff", default=False, action='store_true', help="A + alpha * (B - C) instead of (1 - alpha) * A + alpha * B")
+    parser.add_argument("--components", nargs='+', default=None, help="components to merge (default: all with weights); others are A's")
+    parser.add_argument("--dtype", choices=list(DTYPES.keys()), default="fp16")
+    parser.add_argument("--workers", type=int, default=4, help="tensors to merge at once")
+    args = parser.parse_args()
+
+    num_models = 3 if args.add_diff else 2
+    if len(args.models) != num_models:
+        parser.error(f"{'--add_diff' if args.add_diff else 'a weighted sum'} needs {num_models} models")
+    if args.alpha is None:
+        args.alpha = 1.0 if args.add_diff else 0.5
+    if args.output.exists():
+        parser.error(f"{args.output} already exists")
+
+    time_start = time.perf_counter()
+    dtype = DTYPES[args.dtype]
+    tmp_dir = args.output.with_name(f".{args.output.name}.{os.getpid()}.tmp")
+    inputs_dir = args.output.with_name(f".{args.output.name}.{os.getpid()}.inputs")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    try:
+        paths = [input_dir(path, Path(inputs_dir, str(idx)), dtype) for idx, path in enumerate(args.models)]
+        model_index = json.load(open(Path(paths[0], "model_index.json"), "r"))
+        shutil.copy2(Path(paths[0], "model_index.json"), Path(tmp_dir, "model_index.json"))
+        for name in sorted(model_index.keys()):
+            if name.startswith("_") or not Path(paths[0], name).is_dir():
+                continue
+            if not _has_weights(paths[0], name):
+                shutil.copytree(Path(paths[0], name), Path(tmp_dir, name))
+                continue
+
+            merge = all(_has_weights(path, name) for path in paths) and (args.components is None or name in args.components)
+            component_start = time.perf_counter()
+            size = merge_component(name, paths if merge else paths[:1], tmp_dir, args.alpha, args.add_diff, dtype, args.workers)
+            print(f"{name}: {'merged' if merge else 'copied from A'}, {size / 1024 / 1024:.1f}Mb, "
+                  f"{time.perf_counter() - component_start:.1f}s")
+
+        info = {'models': [os.path.realpath(path) for path in args.models], 'mode': "add_diff" if args.add_diff else "weighted",
+                'alpha': args.alpha, 'components': args.components, 'dtype': args.dtype}
+        json.dump(info, open(Path(tmp_dir, MERGE_NAME), "w"), indent=2)
+        os.rename(tmp_dir, args.output)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(inputs_dir, ignore_errors=True)
+    print(f"wrote {args.output} in {time.perf_counter() - time_start:.1f}s")
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# local cache of diffusers models as fp16 safetensors, for fast model switches.
+#
+# model dirs often still hold .bin pickles, which from_pretrained unpickles, copies
+# and casts to fp16 on every load. the cache stores each model once, already in
+# fp16, as safetensors files that are loaded straight from an mmap. entries are
+# keyed by a hash of the model's contents, so they're rebuilt when the model
+# changes; the entry for the old contents is removed then.
+#
+# the key hashes the files of the components listed in model_index.json. weights
+# are identified by their .sha256 (from share-model-components.py) when it's newer
+# than the file, otherwise by a hash remembered by filehash.HashCache.
+#
+# single-file checkpoints (.ckpt, or .safetensors in the original stable diffusion
+# layout) are cached too, converted to diffusers; their key is the file's hash.
+#
+# each entry holds a whole model, so the cache is kept under max_bytes: after an
+# entry is built, the least recently used ones (by the entry dir's mtime, which is
+# touched on every use) are removed until it fits. the new entry always stays.
+#
+# usage:
+#   modelcache.py build <model_dir or checkpoint> [...]
+#   modelcache.py list
+#   modelcache.py clean [<max_gb>]
+import sys
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+import safetensors.torch
+from diffusers import DiffusionPipeline, StableDiffusionPipeline
+
+from filehash import HashCache, dir_bytes
+
+CACHE_DIR = Path.home() / ".cache" / "sd-scripts" / "models"
+SOURCES_NAME = "sources.json"
+INFO_NAME = "source.json"
+SINGLE_FILE_SUFFIXES = [".ckpt", ".safetensors"]
+MAX_BYTES = 40 * 1024 * 1024 * 1024
+
+def is_single_file(path: str) -> bool:
+    return Path(path).is_file() and Path(path).suffix in SINGLE_FILE_SUFFIXES
+
+# files of the components named in model_dir's model_index.json, relative to it.
+def source_files(model_dir: Path) -> List[Path]:
+    model_index = json.load(open(Path(model_dir, "model_index.json"), "r"))
+    res = [Path("model_index.json")]
+    for name in sorted(model_index.keys()):
+        component_dir = Path(model_dir, name)
+        if name.startswith("_") or not component_dir.is_dir():
+            continue
+        for dirpath, dirnames, filenames in os.walk(component_dir, followlinks=True):
+            dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith("."))
+            for filename in sorted(filenames):
+                if filename.endswith(".sha256") or filename.startswith("."):
+                    continue
+                res.append(Path(dirpath, filename).relative_to(model_dir))
+    return res
+
+def source_hash(model_dir: Path, hashes: HashCache) -> str:
+    sha = hashlib.sha256()
+    for relpath in source_files(model_dir):
+        path = Path(model_dir, relpath)
+        ident = hashes.known(path) or hashes.sha256(path)
+        sha.update(f"{relpath}\0{ident}\n".encode())
+    hashes.save()
+    return sha.hexdigest()
+
+# a pipeline from a checkpoint in the original stable diffusion layout, with
+# whichever converter this diffusers has. this loads the whole model.
+def load_single_file(path: Path, pipeline_class=StableDiffusionPipeline, torch_dtype: torch.dtype = torch.float16) -> DiffusionPipeline:
+    if hasattr(pipeline_class, "from_single_file"):
+        return pipeline_class.from_single_file(str(path), torch_dtype=torch_dtype, load_safety_checker=False)
+    from diffusers.pipelines.stable_diffusion import convert_from_ckpt
+    convert = getattr(convert_from_ckpt, "download_from_original_stable_diffusion_ckpt", None) \
+        or getattr(convert_from_ckpt, "load_pipeline_from_original_stable_diffusion_ckpt")
+    pipeline = convert(str(path), from_safetensors=Path(path).suffix == ".safetensors", load_safety_checker=False)
+    for component in pipeline.components.values():
+        if isinstance(component, torch.nn.Module):
+            component.to(torch_dtype)
+    return pipeline
+
+# write a single-file checkpoint as a diffusers dir with safetensors weights, in
+# torch_dtype, for tools that need diffusers dirs at a given precision (the cache's
+# entries are always fp16).
+def convert_single_file(path: Path, out_dir: Path, torch_dtype: torch.dtype = torch.float16):
+    pipeline = load_single_file(path, StableDiffusionPipeline, torch_dtype)
+    pipeline.save_pretrained(out_dir, safe_serialization=True)
+    del pipeline
+    _convert_bins(Path(out_dir))
+
+# a diffusers dir for path, for tools that take either: path itself, or for a
+# single-file checkpoint, its conversion into convert_dir, in dtype.
+def input_dir(path: str, convert_dir: Path, dtype: torch.dtype) -> str:
+    if is_single_file(path):
+        print(f"converting {path} to diffusers (this loads the whole model)")
+        convert_single_file(Path(path), convert_dir, dtype)
+        return str(convert_dir)
+    if not Path(path, "model_index.json").exists():
+        raise Exception(f"{path} is not a diffusers model dir or a checkpoint file")
+    return path
+
+# save_pretrained writes .bin for models whose library can't write safetensors yet.
+def _convert_bins(model_dir: Path):
+    for path in list(model_dir.rglob("*.bin")):
+        state_dict = torch.load(path, map_location="cpu")
+        state_dict = {key: value.contiguous() for key, value in state_dict.items()}
+        name = "model.safetensors" if path.name == "pytorch_model.bin" else path.with_suffix(".safetensors").name
+        safetensors.torch.save_file(state_dict, path.with_name(name), metadata={'format': 'pt'})
+        path.unlink()
+
+class ModelCache:
+    root: Path
+    max_bytes: int
+
+    def __init__(self, root: Path = CACHE_DIR, max_bytes: int = MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hashes = HashCache()
+
+    # the directory to load model_dir from: its cache entry, built first if needed.
+    # models that aren't local diffusers directories or checkpoint files (hub ids)
+    # are loaded as is.
+    def path(self, model_dir: str, pipeline_class=StableDiffusionPipeline) -> str:
+        if is_single_file(model_dir):
+            key = self.hashes.known(model_dir) or self.hashes.sha256(model_dir)
+            self.hashes.save()
+        elif Path(model_dir, "model_index.json").exists():
+            key = source_hash(Path(model_dir), self.hashes)
+        else:
+            return model_dir
+
+        entry = self.root / key
+        built = not entry.exists()
+        if built:
+            self._build(model_dir, pipeline_class, entry, key)
+        else:
+            # mark it used, for trim.
+            os.utime(entry)
+        self._record(model_dir, key)
+        if built:
+            self.trim(keep=key)
+        return str(entry)
+
+    def _build(self, model_dir: str, pipeline_class, entry: Path, key: str):
+        print(f"\033[1mcaching {model_dir} as fp16 safetensors\033[0m")
+        time_start = time.perf_counter()
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_dir = self.root / f".{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            if is_single_file(model_dir):
+                pipeline = load_single_file(Path(model_dir), pipeline_class)
+            else:
+                pipeline = pipeline_class.from_pretrained(model_dir, torch_dtype=torch.float16, safety_checker=None)
+            pipeline.save_pretrained(tmp_dir, safe_serialization=True)
+            del pipeline
+            _convert_bins(tmp_dir)
+            info = {'model_dir': os.path.realpath(model_dir), 'key': key, 'created': time.time()}
+            json.dump(info, open(tmp_dir / INFO_NAME, "w"), indent=2)
+            # another process may have built the same entry meanwhile; keep theirs.
+            try:
+                os.rename(tmp_dir, entry)
+            except OSError:
+                if not entry.exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        print(f"  {time.perf_counter() - time_start:.1f}s, {entry}")
+
+    # remember which entry model_dir uses now, and remove its previous entry unless
+    # another model dir has the same contents.
+    def _record(self, model_dir: str, key: str):
+        sources = self.sources()
+        realpath = os.path.realpath(model_dir)
+        old_key = sources.get(realpath)
+        if old_key == key:
+            return
+        sources[realpath] = key
+        self._save_sources(sources)
+        if old_key is not None and old_key not in sources.values():
+            print(f"{model_dir} changed, removing its old cache entry {old_key}")
+            self._remove(old_key)
+
+    def sources(self) -> Dict[str, str]:
+        path = self.root / SOURCES_NAME
+        if not path.exists():
+            return dict()
+        try:
+            return json.load(open(path, "r"))
+        except json.JSONDecodeError:
+            return dict()
+
+    def _save_sources(self, sources: Dict[str, str]):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.root / f".{SOURCES_NAME}.{os.getpid()}.tmp"
+        json.dump(sources, open(tmp_path, "w"), indent=2)
+        os.replace(tmp_path, self.root / SOURCES_NAME)
+
+    # rename first, so the entry disappears at once rather than file by file.
+    def _remove(self, key: str):
+        entry = self.root / key
+        tmp_dir = self.root / f".{key}.{os.getpid()}.removing"
+        try:
+            os.rename(entry, tmp_dir)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def entries(self) -> List[Path]:
+        if not self.root.exists():
+            return []
+        return sorted(path for path in self.root.iterdir() if path.is_dir() and not path.name.startswith("."))
+
+    # remove entries no model dir maps to, and model dirs that no longer exist.
+    def clean(self) -> int:
+        sources = {realpath: key for realpath, key in self.sources().items() if Path(realpath).exists()}
+        self._save_sources(sources)
+        num_removed = 0
+        for entry in self.entries():
+            if entry.name not in sources.values():
+                print(f"remove {entry}")
+                self._remove(entry.name)
+                num_removed += 1
+        return num_removed + self.trim()
+
+    # remove the least recently used entries, other than keep, until the cache takes
+    # at most max_bytes.
+    def trim(self, max_bytes: int = None, keep: str = None) -> int:
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry.name: dir_bytes(entry) for entry in entries}
+        total = sum(sizes.values())
+        num_removed = 0
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            print(f"model cache over {max_bytes / 1024 / 1024 / 1024:.1f}Gb, removing {entry}")
+            self._remove(entry.name)
+            total -= sizes[entry.name]
+            num_removed += 1
+        if num_removed > 0:
+            existing = {entry.name for entry in self.entries()}
+            self._save_sources({realpath: key for realpath, key in self.sources().items() if key in existing})
+        return num_removed
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ["build", "list", "clean"]:
+        print(f"usage: {sys.argv[0]} build <model_dir> [<model_dir> ...] | list | clean [<max_gb>]")
+        sys.exit(1)
+
+    cache = ModelCache()
+    if sys.argv[1] == "clean" and len(sys.argv) > 2:
+        cache.max_bytes = int(float(sys.argv[2]) * 1024 * 1024 * 1024)
+    if sys.argv[1] == "build":
+        for model_dir in sys.argv[2:]:
+            print(f"{model_dir}: {cache.path(model_dir, DiffusionPipeline)}")
+    elif sys.argv[1] == "list":
+        by_key: Dict[str, List[str]] = dict()
+        for realpath, key in cache.sources().items():
+            by_key.setdefault(key, []).append(realpath)
+        for entry in cache.entries():
+            size_gb = dir_bytes(entry) / 1024 / 1024 / 1024
+            print(f"{entry.name[:16]}  {size_gb:5.2f}Gb  {', '.join(by_key.get(entry.name, ['(unused)']))}")
+    else:
+        print(f"removed {cache.clean()} entries")
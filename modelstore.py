@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+# content-addressed store for model component files (unet, vae, text_encoder
+# weights, ...). each distinct file is kept once, as store/blobs/<sha[:2]>/<sha>,
+# and the files in model dirs become hardlinks to their blob. where a hardlink
+# isn't possible (the store is on another filesystem) a reflink is tried, and last
+# a symlink.
+#
+# every ingested dir gets a ref in store/refs, listing the blob of each of its
+# files. "gc" drops refs whose files are gone or have changed, then deletes the
+# blobs no ref uses.
+#
+# ingest is crash-safe, and safe to run while gc or other ingests run, so training
+# scripts can ingest each checkpoint-N dir right after saving it:
+#   - blobs are created with link() (or a copy renamed into place), so a blob
+#     either exists whole or not at all.
+#   - a file is replaced by renaming a link to its blob over it, so it's always
+#     either the original file or the blob.
+#   - the dir's ref is extended (atomically) with each file before the file is
+#     replaced, so every link to a blob is covered by a ref, even after a crash
+#     halfway through a dir.
+#   - ingest holds a shared flock on the store and gc an exclusive one, so gc
+#     never deletes a blob an ingest is about to link to. gc also keeps every blob
+#     that a symlink in a ref'd dir points to.
+# blobs are made read-only, as writing to one would change every file linked to it.
+#
+# usage:
+#   modelstore.py ingest <dir> [<dir> ...] [--store DIR] [--min_mb N]
+#   modelstore.py gc [--dry-run]
+#   modelstore.py refs
+#   modelstore.py stats
+import os
+import errno
+import fcntl
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import contextlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+from filehash import HashCache
+
+DEFAULT_STORE = Path("/home/tim/models/.store")
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def _reflink(src: Path, dst: Path):
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+class ModelStore:
+    root: Path
+    min_bytes: int
+
+    def __init__(self, root: Path = DEFAULT_STORE, min_bytes: int = 1024 * 1024):
+        self.root = Path(root)
+        self.min_bytes = min_bytes
+        self.hashes = HashCache()
+        for subdir in ["blobs", "refs", "tmp"]:
+            Path(self.root, subdir).mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, sha: str) -> Path:
+        return Path(self.root, "blobs", sha[:2], sha)
+
+    def ref_path(self, model_dir: Path) -> Path:
+        realpath = os.path.realpath(model_dir)
+        return Path(self.root, "refs", hashlib.sha256(realpath.encode()).hexdigest()[:24] + ".json")
+
+    @contextlib.contextmanager
+    def locked(self, exclusive: bool):
+        fd = os.open(Path(self.root, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            os.close(fd)
+
+    # files under model_dir worth storing: regular files of at least min_bytes, and
+    # symlinks to blobs from an earlier ingest.
+    def _files(self, model_dir: Path) -> Iterable[Path]:
+        blobs_dir = os.path.realpath(Path(self.root, "blobs")) + os.sep
+        for dirpath, dirnames, filenames in os.walk(model_dir):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith("."))
+            for filename in sorted(filenames):
+                path = Path(dirpath, filename)
+                if filename.endswith(".sha256") or filename.startswith("."):
+                    continue
+                if path.is_symlink() and not os.path.realpath(path).startswith(blobs_dir):
+                    continue
+                if path.stat().st_size >= self.min_bytes:
+                    yield path
+
+    # make sure there's a blob with path's contents. returns whether it was new.
+    def _add_blob(self, path: Path, sha: str) -> bool:
+        blob = self.blob_path(sha)
+        if blob.exists():
+            return False
+        blob.parent.mkdir(exist_ok=True)
+        try:
+            os.link(path, blob)
+        except FileExistsError:
+            return False
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+            tmp = Path(self.root, "tmp", f"{sha}.{os.getpid()}")
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, blob)
+        os.chmod(blob, 0o444)
+        return True
+
+    # replace path with a link to its blob. returns how: 'same' if it already is the
+    # blob, or 'hardlink', 'reflink' or 'symlink'.
+    def _link(self, path: Path, sha: str) -> str:
+        blob = self.blob_path(sha)
+        if os.stat(path).st_ino == os.stat(blob).st_ino and os.stat(path).st_dev == os.stat(blob).st_dev:
+            return "same"
+
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.store")
+        how = "hardlink"
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                raise
+            try:
+                how = "reflink"
+                _reflink(blob, tmp)
+            except OSError:
+                if tmp.exists():
+                    tmp.unlink()
+                how = "symlink"
+                os.symlink(blob, tmp)
+        os.replace(tmp, path)
+        return how
+
+    def _write_ref(self, model_dir: Path, files: Dict[str, str]):
+        ref = {'path': os.path.realpath(model_dir), 'files': files, 'time': time.time()}
+        ref_path = self.ref_path(model_dir)
+        tmp = Path(self.root, "tmp", f"{ref_path.name}.{os.getpid()}")
+        with open(tmp, "w") as file:
+            json.dump(ref, file, indent=2)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, ref_path)
+
+    def ingest(self, model_dir: Path) -> Dict[str, int]:
+        counts = {'files': 0, 'new': 0, 'same': 0, 'hardlink': 0, 'reflink': 0, 'symlink': 0, 'bytes_saved': 0}
+        files: Dict[str, str] = dict()
+        with self.locked(exclusive=False):
+            # files of an earlier (maybe crashed) ingest stay in the ref until
+            # they're seen again.
+            ref_path = self.ref_path(model_dir)
+            if ref_path.exists():
+                try:
+                    files.update(json.load(open(ref_path, "r"))['files'])
+                except json.JSONDecodeError:
+                    pass
+            for path in self._files(model_dir):
+                sha = self.hashes.known(path) or self.hashes.sha256(path)
+                size = path.stat().st_size
+                counts['files'] += 1
+                is_new = self._add_blob(path, sha)
+                relpath = str(path.relative_to(model_dir))
+                if files.get(relpath) != sha:
+                    # the ref has to cover the file before it becomes a link.
+                    files[relpath] = sha
+                    self._write_ref(model_dir, files)
+                how = self._link(path, sha)
+                if is_new:
+                    counts['new'] += 1
+                    how = "new" if how == "same" else how
+                elif how != "same":
+                    counts['bytes_saved'] += size
+                if how != "new":
+                    counts[how] += 1
+            self.hashes.save()
+            self._write_ref(model_dir, files)
+        return counts
+
+    def refs(self) -> List[Tuple[Path, Dict]]:
+        res = list()
+        for ref_path in sorted(Path(self.root, "refs").glob("*.json")):
+            try:
+                res.append((ref_path, json.load(open(ref_path, "r"))))
+            except json.JSONDecodeError:
+                pass
+        return res
+
+    # whether the file at relpath in ref still has the blob's contents.
+    def _still_uses(self, ref: Dict, relpath: str, sha: str) -> bool:
+        path = Path(ref['path'], relpath)
+        blob = self.blob_path(sha)
+        try:
+            if path.is_symlink():
+                return os.path.realpath(path) == os.path.realpath(blob)
+            st = os.stat(path)
+            blob_st = os.stat(blob)
+        except FileNotFoundError:
+            return False
+        if (st.st_ino, st.st_dev) == (blob_st.st_ino, blob_st.st_dev):
+            return True
+        # a reflink or a copy: only trust a hash that's still valid for the file.
+        return self.hashes.known(path) == sha
+
+    # blobs that symlinks under model_dir point to.
+    def _symlinked_blobs(self, model_dir: Path) -> Set[str]:
+        blobs_dir = os.path.realpath(Path(self.root, "blobs")) + os.sep
+        res: Set[str] = set()
+        for dirpath, dirnames, filenames in os.walk(model_dir):
+            for filename in filenames:
+                path = Path(dirpath, filename)
+                if path.is_symlink():
+                    target = os.path.realpath(path)
+                    if target.startswith(blobs_dir):
+                        res.add(Path(target).name)
+        return res
+
+    def blobs(self) -> Iterable[Path]:
+        for blob_dir in sorted(Path(self.root, "blobs").iterdir()):
+            yield from sorted(blob_dir.iterdir())
+
+    # drop references that are gone, then blobs that aren't referenced. returns
+    # (blobs removed, bytes freed). a blob that's still hardlinked from somewhere
+    # else frees nothing.
+    def gc(self, dry_run: bool = False) -> Tuple[int, int]:
+        with self.locked(exclusive=True):
+            used: Set[str] = set()
+            for ref_path, ref in self.refs():
+                # a symlink to a blob is the only copy of the file, whatever the
+                # ref says.
+                used.update(self._symlinked_blobs(Path(ref['path'])))
+                files = {relpath: sha for relpath, sha in ref['files'].items() if self._still_uses(ref, relpath, sha)}
+                if len(files) == 0:
+                    print(f"drop ref {ref['path']}")
+                    if not dry_run:
+                        ref_path.unlink()
+                    continue
+                if len(files) != len(ref['files']) and not dry_run:
+                    ref['files'] = files
+                    tmp = Path(self.root, "tmp", f"{ref_path.name}.{os.getpid()}")
+                    json.dump(ref, open(tmp, "w"), indent=2)
+                    os.replace(tmp, ref_path)
+                used.update(files.values())
+
+            num_removed = 0
+            bytes_freed = 0
+            for blob in self.blobs():
+                if blob.name in used:
+                    continue
+                st = blob.stat()
+                if st.st_nlink == 1:
+                    bytes_freed += st.st_size
+                num_removed += 1
+                if not dry_run:
+                    blob.unlink()
+            for tmp in Path(self.root, "tmp").iterdir():
+                if not dry_run:
+                    tmp.unlink()
+        return num_removed, bytes_freed
+
+    def stats(self) -> Dict[str, int]:
+        blob_sizes = {blob.name: blob.stat().st_size for blob in self.blobs()}
+        referenced = 0
+        num_files = 0
+        for _ref_path, ref in self.refs():
+            for sha in ref['files'].values():
+                referenced += blob_sizes.get(sha, 0)
+                num_files += 1
+        return {'blobs': len(blob_sizes), 'stored_bytes': sum(blob_sizes.values()),
+                'files': num_files, 'referenced_bytes': referenced}
+
+def _gb(num_bytes: int) -> str:
+    return f"{num_bytes / 1024 / 1024 / 1024:.2f}Gb"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="content-addressed store for model component files")
+    parser.add_argument("command", choices=["ingest", "gc", "refs", "stats"])
+    parser.add_argument("dirs", nargs='*', help="with ingest: model or checkpoint dirs to ingest")
+    parser.add_argument("--store", type=Path, default=DEFAULT_STORE, help="store dir, on the same filesystem as the models for hardlinks")
+    parser.add_argument("--min_mb", type=float, default=1, help="with ingest: only store files at least this big")
+    parser.add_argument("--dry-run", dest="dry_run", default=False, action='store_true', help="with gc: only print what would be removed")
+    args = parser.parse_args()
+
+    store = ModelStore(args.store, int(args.min_mb * 1024 * 1024))
+    if args.command == "ingest":
+        if len(args.dirs) == 0:
+            parser.error("ingest needs at least one dir")
+        for model_dir in args.dirs:
+            counts = store.ingest(Path(model_dir))
+            print(f"{model_dir}: {counts['files']} files, {counts['new']} new blobs, "
+                  f"{counts['hardlink']} hardlinked, {counts['reflink']} reflinked, {counts['symlink']} symlinked, "
+                  f"{counts['same']} already stored, {_gb(counts['bytes_saved'])} saved")
+    elif args.command == "gc":
+        num_removed, bytes_freed = store.gc(args.dry_run)
+        print(f"{'would remove' if args.dry_run else 'removed'} {num_removed} blobs, {_gb(bytes_freed)} freed")
+    elif args.command == "refs":
+        for _ref_path, ref in store.refs():
+            print(f"{len(ref['files']):4} files  {time.ctime(ref['time'])}  {ref['path']}")
+    else:
+        stats = store.stats()
+        print(f"{stats['blobs']} blobs, {_gb(stats['stored_bytes'])} stored, "
+              f"{stats['files']} files referencing {_gb(stats['referenced_bytes'])}")
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# append-only run log for gen-many. each output dir gets a gen-many.jsonl with one
+# json object per line, one line per gen-many run that generated images there.
+#
+# appends take an exclusive flock on the log, so several gen-many processes can
+# write to the same output dirs. fsyncs are batched: every 'fsync_every' appends,
+# or 'fsync_seconds' after the last one, and when the log is closed. a line that
+# was cut short by a crash is skipped by the readers.
+#
+# older output dirs have a gen-many.json holding {"runs": [...]}. these are
+# migrated to gen-many.jsonl the first time a run is appended there, or for a whole
+# tree with "runlog.py migrate <dir>". the migrated runs are followed by a
+# {"migrated": "gen-many.json"} line, so a migration that died before the json was
+# renamed isn't done again, and readers skip the json once the log has it.
+#
+# RunIndex aggregates the logs under an output root into per-(model, sampler, steps,
+# resolution, batch size) totals, for gen-many.py --estimate. the index is kept in
+# the root's gen-many-index.json and only reads what was appended to each log since
+# the last update. the tree is only listed again where a dir's mtime changed.
+#
+# usage:
+#   runlog.py summary <dir> [<dir> ...]
+#   runlog.py migrate <dir> [<dir> ...]
+#   runlog.py index <dir> [<dir> ...]
+import sys
+import os
+import fcntl
+import json
+import time
+import atexit
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+LOG_NAME = "gen-many.jsonl"
+LEGACY_NAME = "gen-many.json"
+MIGRATED_SUFFIX = ".migrated"
+MIGRATED_MARKER = {'migrated': LEGACY_NAME}
+INDEX_NAME = "gen-many-index.json"
+# bumped when what the index stores changes, so older indexes are rebuilt.
+INDEX_VERSION = 3
+
+# (model_dir, sampler_name, sampler_steps, width, height, batch_size)
+StatsKey = Tuple[str, str, int, int, int, int]
+
+# logs are kept open between appends, but only the max_open most recently used; an
+# older one is fsynced and closed, so a plan with thousands of output dirs doesn't
+# run out of file descriptors.
+class RunLog:
+    fsync_every: int
+    fsync_seconds: float
+    max_open: int
+
+    def __init__(self, fsync_every: int = 32, fsync_seconds: float = 10.0, max_open: int = 64):
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.max_open = max_open
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.num_unsynced = 0
+        self.last_sync = time.monotonic()
+        atexit.register(self.close)
+
+    def append(self, output_dir: str, run: Dict):
+        fd = self._open(output_dir)
+        line = (json.dumps(run) + "\n").encode()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            # start a new line if a crashed writer left a partial one.
+            size = os.fstat(fd).st_size
+            if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                line = b"\n" + line
+            os.write(fd, line)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_every or time.monotonic() - self.last_sync >= self.fsync_seconds:
+            self.sync()
+
+    def sync(self):
+        for fd in self.files.values():
+            os.fsync(fd)
+        self.num_unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        for fd in self.files.values():
+            os.close(fd)
+        self.files.clear()
+        # a daemon makes a RunLog per job; don't keep them all around until exit.
+        atexit.unregister(self.close)
+
+    def _open(self, output_dir: str) -> int:
+        if output_dir in self.files:
+            self.files.move_to_end(output_dir)
+        else:
+            while len(self.files) >= self.max_open:
+                _old_dir, old_fd = self.files.popitem(last=False)
+                os.fsync(old_fd)
+                os.close(old_fd)
+            fd = os.open(Path(output_dir, LOG_NAME), os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                _migrate_locked(Path(output_dir), fd)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            self.files[output_dir] = fd
+        return self.files[output_dir]
+
+def _is_marker(run: Dict) -> bool:
+    return run.get('migrated') == LEGACY_NAME
+
+# whether the log at path has the migrated marker.
+def _has_marker(path: Path) -> bool:
+    with open(path, "rb") as file:
+        for line in file:
+            if line.startswith(b'{"migrated"'):
+                try:
+                    if _is_marker(json.loads(line)):
+                        return True
+                except json.JSONDecodeError:
+                    pass
+    return False
+
+# append the runs of a legacy gen-many.json and the marker to the (locked) log, in
+# one write, then rename the json so it isn't read or migrated again.
+def _migrate_locked(output_dir: Path, fd: int) -> int:
+    legacy_path = Path(output_dir, LEGACY_NAME)
+    if not legacy_path.exists():
+        return 0
+
+    runs = []
+    if not _has_marker(Path(output_dir, LOG_NAME)):
+        runs = json.load(open(legacy_path, "r")).get('runs', [])
+        os.write(fd, "".join(json.dumps(run) + "\n" for run in runs + [MIGRATED_MARKER]).encode())
+        os.fsync(fd)
+    os.replace(legacy_path, legacy_path.with_name(LEGACY_NAME + MIGRATED_SUFFIX))
+    return len(runs)
+
+def migrate(output_dir: Path) -> int:
+    if not Path(output_dir, LEGACY_NAME).exists():
+        return 0
+
+    fd = os.open(Path(output_dir, LOG_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return _migrate_locked(output_dir, fd)
+    finally:
+        os.close(fd)
+
+# runs recorded for one output dir, oldest first, including a not yet migrated
+# gen-many.json.
+def read_runs(output_dir: Path) -> List[Dict]:
+    runs: List[Dict] = list()
+    migrated = False
+    log_path = Path(output_dir, LOG_NAME)
+    if log_path.exists():
+        with open(log_path, "r") as file:
+            for line in file:
+                try:
+                    run = json.loads(line)
+                except json.JSONDecodeError:
+                    # partial line from a crashed writer.
+                    continue
+                if _is_marker(run):
+                    migrated = True
+                else:
+                    runs.append(run)
+
+    legacy_path = Path(output_dir, LEGACY_NAME)
+    if legacy_path.exists() and not migrated:
+        runs = json.load(open(legacy_path, "r")).get('runs', []) + runs
+    return runs
+
+def find_output_dirs(root: Path) -> Iterable[Path]:
+    for dirpath, _dirnames, filenames in os.walk(root):
+        if LOG_NAME in filenames or LEGACY_NAME in filenames:
+            yield Path(dirpath)
+
+def walk_runs(roots: List[Path]) -> Iterable[Tuple[Path, Dict]]:
+    for root in roots:
+        for output_dir in find_output_dirs(root):
+            for run in read_runs(output_dir):
+                yield output_dir, run
+
+# batch size a run was generated with, 0 for --batch auto. older runs don't record it,
+# so it's taken from their command line.
+def run_batch_size(run: Dict) -> int:
+    if 'batch_size' in run:
+        return run['batch_size']
+    args = run.get('config_args') or run.get('argv', [])
+    for arg, value in zip(args, args[1:]):
+        if arg == "--batch":
+            return 0 if value == "auto" else int(value)
+    return 1
+
+def stats_key(run: Dict) -> StatsKey:
+    image_set = run.get('image_set', {})
+    return (image_set.get('model_dir', ""), image_set.get('sampler_name', ""), int(image_set.get('sampler_steps', 0)),
+            int(image_set.get('width') or 0), int(image_set.get('height') or 0), run_batch_size(run))
+
+# totals for a list of runs, as {json key: [images, seconds, model loads, model load seconds]}.
+# model load time is kept apart from the per-image time, as it's paid once per model
+# in a plan rather than per image. a packed group's load is split across its sets,
+# so each run counts its share of a load; older runs don't record it, and count one.
+def _add_runs(stats: Dict[str, List], runs: Iterable[Dict]):
+    for run in runs:
+        num_generated = run.get('num_generated', 0)
+        if num_generated <= 0:
+            continue
+        try:
+            key = json.dumps(stats_key(run))
+        except ValueError:
+            continue
+        timing = run.get('timing', {})
+        phases = timing.get('phases', {})
+        load_seconds = phases.get('model_load', 0.0)
+        one = stats.setdefault(key, [0, 0.0, 0, 0.0])
+        one[0] += num_generated
+        one[1] += timing.get('total', 0.0) - load_seconds
+        if load_seconds > 0:
+            one[2] += phases.get('model_loads', 1)
+            one[3] += load_seconds
+
+# per output dir aggregates for all the logs under root, saved in root/gen-many-index.json.
+# a log is only read from where the last update stopped, as logs are append-only; a
+# log that shrank (or was replaced) is read again from the start. legacy gen-many.json
+# files are read whole, whenever their mtime changes.
+#
+# the subdirs of every dir under root, and whether it has a log, are kept too. a
+# dir's mtime changes when entries are added to or removed from it, so only dirs
+# whose mtime changed are listed again; the rest (mostly dirs of images) just get a
+# stat.
+class RunIndex:
+    root: Path
+    path: Path
+    num_listed: int = 0
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.path = self.root / INDEX_NAME
+        self.dirs: Dict[str, Dict] = dict()
+        # rel path -> {'mtime_ns', 'subdirs', 'has_log'}
+        self.tree: Dict[str, Dict] = dict()
+        if self.path.exists():
+            try:
+                index = json.load(open(self.path, "r"))
+                if index.get('version') == INDEX_VERSION:
+                    self.dirs = index.get('dirs', {})
+                    self.tree = index.get('tree', {})
+            except (json.JSONDecodeError, AttributeError):
+                self.dirs = dict()
+                self.tree = dict()
+
+    # bring the index up to date with the logs on disk. returns the number of output
+    # dirs that had to be read.
+    def update(self) -> int:
+        num_read = 0
+        seen = set()
+        self.num_listed = 0
+        for output_dir in self._find_output_dirs():
+            rel = str(output_dir.relative_to(self.root))
+            seen.add(rel)
+            entry = self.dirs.setdefault(rel, {'log_offset': 0, 'log_inode': 0, 'log_stats': {}, 'log_migrated': False,
+                                               'legacy_mtime_ns': 0, 'legacy_stats': {}})
+            if self._update_log(output_dir, entry) | self._update_legacy(output_dir, entry):
+                num_read += 1
+
+        removed = set(self.dirs.keys()) - seen
+        for rel in removed:
+            self.dirs.pop(rel)
+        if num_read > 0 or removed or self.num_listed > 0:
+            self._save()
+        return num_read
+
+    # like find_output_dirs, but only lists dirs whose mtime changed since the last
+    # update, counting them in num_listed.
+    def _find_output_dirs(self) -> Iterable[Path]:
+        tree: Dict[str, Dict] = dict()
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            rel = str(path.relative_to(self.root))
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            entry = self.tree.get(rel)
+            if entry is None or entry['mtime_ns'] != mtime_ns:
+                subdirs = list()
+                has_log = False
+                with os.scandir(path) as entries:
+                    for dir_entry in entries:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            subdirs.append(dir_entry.name)
+                        elif dir_entry.name in [LOG_NAME, LEGACY_NAME]:
+                            has_log = True
+                # an mtime this recent may not change again for an entry added in the
+                # same tick, on filesystems with coarse timestamps; list it again next time.
+                if time.time_ns() - mtime_ns < 2_000_000_000:
+                    mtime_ns = 0
+                entry = {'mtime_ns': mtime_ns, 'subdirs': sorted(subdirs), 'has_log': has_log}
+                self.num_listed += 1
+            tree[rel] = entry
+
+            if entry['has_log']:
+                yield path
+            stack.extend(Path(path, name) for name in reversed(entry['subdirs']))
+
+        # a removed dir's parent was listed again, so it's gone from tree.
+        self.tree = tree
+
+    # merged totals over all output dirs.
+    def stats(self) -> Dict[StatsKey, List]:
+        res: Dict[StatsKey, List] = dict()
+        for entry in self.dirs.values():
+            for stats in [entry['log_stats'], entry['legacy_stats']]:
+                for key, values in stats.items():
+                    one = res.setdefault(tuple(json.loads(key)), [0, 0.0, 0, 0.0])
+                    for idx, value in enumerate(values):
+                        one[idx] += value
+        return res
+
+    def _update_log(self, output_dir: Path, entry: Dict) -> bool:
+        log_path = Path(output_dir, LOG_NAME)
+        try:
+            st = os.stat(log_path)
+        except FileNotFoundError:
+            changed = entry['log_offset'] > 0
+            entry.update(log_offset=0, log_inode=0, log_stats={}, log_migrated=False)
+            return changed
+
+        if st.st_ino != entry['log_inode'] or st.st_size < entry['log_offset']:
+            entry.update(log_offset=0, log_inode=st.st_ino, log_stats={}, log_migrated=False)
+        if st.st_size == entry['log_offset']:
+            return False
+
+        with open(log_path, "rb") as file:
+            file.seek(entry['log_offset'])
+            data = file.read(st.st_size - entry['log_offset'])
+        # leave a trailing partial line for next time; it may still be being written.
+        end = data.rfind(b"\n") + 1
+        runs = list()
+        for line in data[:end].splitlines():
+            try:
+                run = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if _is_marker(run):
+                entry['log_migrated'] = True
+            else:
+                runs.append(run)
+        _add_runs(entry['log_stats'], runs)
+        entry['log_offset'] += end
+        return True
+
+    def _update_legacy(self, output_dir: Path, entry: Dict) -> bool:
+        legacy_path = Path(output_dir, LEGACY_NAME)
+        try:
+            mtime_ns = os.stat(legacy_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = 0
+        if entry['log_migrated']:
+            # its runs are in the log; the rename just didn't happen.
+            mtime_ns = 0
+        if mtime_ns == entry['legacy_mtime_ns']:
+            return False
+
+        entry['legacy_mtime_ns'] = mtime_ns
+        entry['legacy_stats'] = {}
+        if mtime_ns:
+            try:
+                _add_runs(entry['legacy_stats'], json.load(open(legacy_path, "r")).get('runs', []))
+            except json.JSONDecodeError:
+                pass
+        return True
+
+    def _save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({'version': INDEX_VERSION, 'dirs': self.dirs, 'tree': self.tree}, file)
+        os.replace(tmp_path, self.path)
+
+def summary(roots: List[Path]):
+    num_dirs = 0
+    num_runs = 0
+    num_images = 0
+    time_total = 0.0
+    by_model: Dict[str, List[float]] = dict()
+    last_dir = None
+    for output_dir, run in walk_runs(roots):
+        if output_dir != last_dir:
+            num_dirs += 1
+            last_dir = output_dir
+        num_runs += 1
+        num_generated = run.get('num_generated', 0)
+        total = run.get('timing', {}).get('total', 0.0)
+        num_images += num_generated
+        time_total += total
+
+        model = run.get('image_set', {}).get('model_dir', "?")
+        model_stats = by_model.setdefault(model, [0, 0.0])
+        model_stats[0] += num_generated
+        model_stats[1] += total
+
+    print(f"{num_dirs} output dirs, {num_runs} runs, {num_images} images, {time_total:.1f}s")
+    if num_images > 0:
+        print(f"  {time_total / num_images:.3f}s per image")
+    for model, (model_images, model_total) in sorted(by_model.items()):
+        per_image = model_total / model_images if model_images else 0.0
+        print(f"  {model}: {model_images} images, {model_total:.1f}s, {per_image:.3f}s per image")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ["summary", "migrate", "index"]:
+        print(f"usage: {sys.argv[0]} summary|migrate|index <dir> [<dir> ...]")
+        sys.exit(1)
+
+    roots = [Path(arg) for arg in sys.argv[2:]]
+    if sys.argv[1] == "summary":
+        summary(roots)
+    elif sys.argv[1] == "index":
+        for root in roots:
+            index = RunIndex(root)
+            num_read = index.update()
+            print(f"{root}: {len(index.dirs)} output dirs, {index.num_listed} dirs listed, {num_read} read, {len(index.stats())} keys")
+    else:
+        num_runs = 0
+        for root in roots:
+            for output_dir in find_output_dirs(root):
+                num_migrated = migrate(output_dir)
+                if num_migrated > 0:
+                    print(f"{output_dir}: migrated {num_migrated} runs")
+                num_runs += num_migrated
+        print(f"migrated {num_runs} runs")
@@ -1,26 +1,36 @@
 #!/usr/bin/python3
 
+# finds component files (unet, vae, text_encoder, ...) of models under MODEL_DIR that
+# are the same as a base model's, and writes share-model.bash to replace them with
+# symlinks.
+#
+# only files that can be duplicates are fully hashed: a file needs the same size,
+# then the same partial hash (see filehash.partial_sha256) as some base model file.
+# full hashes are computed in chunks on a thread pool, remembered in filehash's
+# cache, and written to .sha256 sidecars. a sidecar older than its file is ignored.
 from pathlib import Path
-from typing import Dict, List
-import hashlib
+from typing import Any, Dict, Iterable, List, Set
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+
+from filehash import HashCache, partial_sha256
 
 MODEL_DIR = Path("/home/tim/models")
 BASE_MODELS = ["stable-diffusion-v1-5", "stable-diffusion-v1-5+vae", "f222", "f222v", "hassanblend1.4"]
+SPECIAL_DIRS = ["feature_extractor", "safety_checker", "scheduler", "text_encoder", "tokenizer", "unet", "vae"]
 
 # key = sha, value = path relative to /home/tim/models.
 HASH: Dict[str, Path] = dict()
 
-OUT = open("share-model.bash", "w")
-SIZE_SAVED = 0
+# key = file, value = sha, for the files that might be duplicates.
+SHAS: Dict[Path, str] = dict()
 
-def walk_special_dir(special_dir: Path, record_shas: bool):
-    global SIZE_SAVED
-
-    output = ""
-    all_same = True
-    last_existing_parent = None
-    symlinks = []
+OUT = None
+SIZE_SAVED = 0
 
+def special_dir_files(special_dir: Path) -> List[Path]:
+    res: List[Path] = []
     for child in special_dir.iterdir():
         if child.name == ".git":
             continue
@@ -29,18 +39,22 @@ def walk_special_dir(special_dir: Path, record_shas: bool):
             raise Exception(f"unexpected child {child} in {special_dir.absolute()}")
         elif child.is_symlink() or child.name.endswith(".json") or child.name.endswith(".sha256"):
             continue
+        res.append(child)
+    return res
 
-        # cache the sha256 we compute for next time.
-        sha_file = Path(child.with_suffix(child.suffix + ".sha256"))
-        if sha_file.exists():
-            sha = open(sha_file, "r").read()
-        else:
-            sha = hashlib.sha256(open(child, "rb").read()).hexdigest()
-            open(sha_file, "w").write(sha)
+def walk_special_dir(special_dir: Path, record_shas: bool):
+    global SIZE_SAVED
 
+    output = ""
+    all_same = True
+    last_existing_parent = None
+    symlinks = []
+
+    for child in special_dir_files(special_dir):
+        sha = SHAS.get(child)
         filename = child.relative_to(MODEL_DIR)
 
-        if sha in HASH:
+        if sha is not None and sha in HASH:
             existing_filename = HASH[sha]
             if last_existing_parent is not None and last_existing_parent != existing_filename.parent:
                 all_same = False
@@ -50,7 +64,7 @@ def walk_special_dir(special_dir: Path, record_shas: bool):
             SIZE_SAVED += Path(MODEL_DIR, filename).stat().st_size
         else:
             all_same = False
-            if record_shas:
+            if record_shas and sha is not None:
                 HASH[sha] = filename
 
     if all_same and last_existing_parent is not None:
@@ -64,38 +78,100 @@ def walk_special_dir(special_dir: Path, record_shas: bool):
         for src, dest in symlinks:
             print(f"ln -sf {dest.absolute()} {src}", file=OUT)
 
-def walk_model_dir(model_dir: Path, record_shas: bool):
+def find_special_dirs(model_dir: Path) -> Iterable[Path]:
     for subdir in model_dir.iterdir():
         if subdir.is_symlink():
             # some subdirs are already symlinked. don't report duplicates on them.
             continue
-        
-        if subdir.name in ["feature_extractor", "safety_checker", "scheduler", "text_encoder", "tokenizer", "unet", "vae"]:
-            walk_special_dir(subdir, record_shas)
+
+        if subdir.name in SPECIAL_DIRS:
+            yield subdir
         elif subdir.name.startswith("checkpoint-") or subdir.name.startswith("save-"):
-            walk_model_dir(subdir, record_shas)
+            yield from find_special_dirs(subdir)
         elif subdir.name in ["model_index.json", "logs"] or subdir.suffix in [".pt", ".bin", ".txt", ".pkl"]:
             pass
         else:
             print(f"ignore {subdir}")
-            pass
 
-def walk_models():
-    for model_dir in MODEL_DIR.iterdir():
+def other_model_dirs() -> Iterable[Path]:
+    for model_dir in sorted(MODEL_DIR.iterdir()):
         if not model_dir.is_dir():
             continue
         if model_dir.name in BASE_MODELS or model_dir.name == "sd-vae-ft-mse":
             continue
-        walk_model_dir(model_dir, False)
+        yield model_dir
+
+# unknown files in groups (of files that might be the same) that could be the same
+# as a base file: base files with anything else in their group, and other files
+# with a base file in theirs.
+def _may_match(groups: Dict[Any, List[Path]], unknown: Set[Path], is_base: Set[Path]) -> List[Path]:
+    res: List[Path] = []
+    for paths in groups.values():
+        for path in paths:
+            if path not in unknown:
+                continue
+            others = [other for other in paths if other != path]
+            if (path in is_base and len(others) > 0) or any(other in is_base for other in others):
+                res.append(path)
+    return res
+
+# fills SHAS for the files that could be the same as a base file. files with a known
+# hash are used as is; the rest are only hashed in full if their size, and then
+# their partial hash, matches a base file's.
+def hash_files(base_files: List[Path], other_files: List[Path], cache: HashCache, num_threads: int):
+    is_base = set(base_files)
+    all_files = base_files + other_files
+    for path in all_files:
+        sha = cache.known(path)
+        if sha is not None:
+            SHAS[path] = sha
+    unknown = set(path for path in all_files if path not in SHAS)
+
+    sizes = {path: path.stat().st_size for path in all_files}
+    by_size: Dict[int, List[Path]] = dict()
+    for path in all_files:
+        by_size.setdefault(sizes[path], []).append(path)
+    same_size = set(_may_match(by_size, unknown, is_base))
+
+    # known files need partial hashes too, when unknown ones of their size are left.
+    candidate_sizes = {sizes[path] for path in same_size}
+    to_partial = [path for path in all_files if sizes[path] in candidate_sizes]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        partials = dict(zip(to_partial, pool.map(partial_sha256, to_partial)))
+    by_partial: Dict[str, List[Path]] = dict()
+    for path, partial in partials.items():
+        by_partial.setdefault(partial, []).append(path)
+    to_hash = _may_match(by_partial, same_size, is_base)
+
+    size_total = sum(sizes[path] for path in to_hash)
+    print(f"{len(SHAS)} files with known hashes, {len(unknown) - len(to_hash)} can't be duplicates, "
+          f"hashing {len(to_hash)} ({size_total / 1024 / 1024 / 1024:.1f} Gb)")
+    for path, sha in cache.sha256_files(to_hash, num_threads).items():
+        SHAS[path] = sha
+        # cache the sha256 we compute for next time.
+        open(path.with_suffix(path.suffix + ".sha256"), "w").write(sha)
+    cache.save()
 
 if __name__ == "__main__":
-    walk_special_dir(MODEL_DIR / "sd-vae-ft-mse", True)
+    parser = argparse.ArgumentParser(description="find model components that are the same as base models' and write share-model.bash to symlink them")
+    parser.add_argument("--threads", type=int, default=min(8, os.cpu_count() or 1), help="files to hash at once")
+    args = parser.parse_args()
+
+    base_dirs = [MODEL_DIR / "sd-vae-ft-mse"]
     for name in BASE_MODELS:
-        base_model_path = MODEL_DIR / name
-        walk_model_dir(base_model_path, True)
-    
+        base_dirs.extend(find_special_dirs(MODEL_DIR / name))
+    other_dirs = [special_dir for model_dir in other_model_dirs() for special_dir in find_special_dirs(model_dir)]
+
+    base_files = [path for special_dir in base_dirs for path in special_dir_files(special_dir)]
+    other_files = [path for special_dir in other_dirs for path in special_dir_files(special_dir)]
+    hash_files(base_files, other_files, HashCache(), args.threads)
+
+    OUT = open("share-model.bash", "w")
+    for special_dir in base_dirs:
+        walk_special_dir(special_dir, True)
+
     print(f"size saved so far: {SIZE_SAVED} bytes, {SIZE_SAVED/1024/1024} Mb, {SIZE_SAVED/1024/1024/1024} Gb")
-    walk_models()
-    
-    print(f"size saved at end: {SIZE_SAVED} bytes, {SIZE_SAVED/1024/1024} Mb, {SIZE_SAVED/1024/1024/1024} Gb")
+    for special_dir in other_dirs:
+        walk_special_dir(special_dir, False)
 
+    print(f"size saved at end: {SIZE_SAVED} bytes, {SIZE_SAVED/1024/1024} Mb, {SIZE_SAVED/1024/1024/1024} Gb")
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# per-tensor delta storage for checkpoint-N / epoch-N dirs against a base model.
+#
+# a fine-tuned checkpoint usually leaves most tensors exactly as they are in its
+# base model (the whole vae, often the text encoder), but one changed tensor makes
+# the whole file differ. "pack" hashes each tensor, and rewrites every component's
+# weights as a delta.safetensors holding only the tensors whose bytes, dtype or
+# shape differ from the base's. unchanged tensors are taken from the base when
+# loading, so the round trip is lossless. the dir gets a delta.json naming the base
+# model and the sha256 of each base weights file used, so a delta isn't applied to
+# a base that has changed since. with --replace, the packed dir is read back and
+# compared with the checkpoint, tensor by tensor, before the checkpoint is removed.
+#
+# loading is lazy: LazyStateDict reads tensors from the delta or the base file on
+# first access, and apply_deltas loads the base pipeline (which may already be
+# loaded, or in the model cache) and then only the changed tensors. txt2img loads
+# packed dirs this way, so they can be used as model dirs as before.
+#
+# per-tensor hashes of base files are cached in ~/.cache/sd-scripts/tensor-hashes,
+# keyed by the file's sha256.
+#
+# usage:
+#   tensordelta.py pack <base_model_dir> <checkpoint_dir> [<checkpoint_dir> ...] [--replace]
+#   tensordelta.py unpack <checkpoint_dir> <output_dir>
+#   tensordelta.py info <checkpoint_dir> [<checkpoint_dir> ...]
+import os
+import json
+import shutil
+import struct
+import hashlib
+import argparse
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+import torch
+import safetensors, safetensors.torch
+
+from filehash import HashCache, dir_bytes
+
+DELTA_NAME = "delta.json"
+DELTA_WEIGHTS_NAME = "delta.safetensors"
+HASHES_DIR = Path.home() / ".cache" / "sd-scripts" / "tensor-hashes"
+WEIGHTS_NAMES = ["diffusion_pytorch_model.safetensors", "model.safetensors",
+                 "diffusion_pytorch_model.bin", "pytorch_model.bin"]
+# safetensors' names for torch dtypes.
+DTYPE_NAMES = {torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+               torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8",
+               torch.uint8: "U8", torch.bool: "BOOL"}
+
+def tensor_sha256(tensor: torch.Tensor) -> str:
+    tensor = tensor.detach().cpu().contiguous()
+    sha = hashlib.sha256(f"{tensor.dtype}{list(tensor.shape)}".encode())
+    if tensor.numel() > 0:
+        sha.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+def weights_file(component_dir: Path) -> Path:
+    for name in WEIGHTS_NAMES:
+        if Path(component_dir, name).exists():
+            return Path(component_dir, name)
+    return None
+
+def load_weights(path: Path) -> Dict[str, torch.Tensor]:
+    if path.suffix == ".safetensors":
+        return safetensors.torch.load_file(str(path))
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except Exception:
+        # older torch, or a file in the old (non-zip) format. torch >= 2.6
+        # defaults to weights_only, so the full unpickler has to be asked for.
+        return torch.load(path, map_location="cpu", weights_only=False)
+
+# diffusers names its weights files by the library a component comes from.
+def safetensors_name(weights_name: str) -> str:
+    if weights_name.startswith("model") or weights_name.startswith("pytorch_model"):
+        return "model.safetensors"
+    return "diffusion_pytorch_model.safetensors"
+
+# the header of a safetensors file: tensor name -> {'dtype', 'shape', 'data_offsets'}.
+def read_header(path: Path) -> Dict[str, Dict]:
+    with open(path, "rb") as file:
+        size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(size))
+    header.pop("__metadata__", None)
+    return header
+
+# component name of model_dir, built from its config on the meta device, so it has
+# the names and shapes of its tensors but no weights.
+def meta_model(model_dir: str, name: str) -> torch.nn.Module:
+    import importlib
+    from accelerate import init_empty_weights
+    library, class_name = json.load(open(Path(model_dir, "model_index.json"), "r"))[name]
+    try:
+        module = importlib.import_module(library)
+    except ImportError:
+        # pipeline-specific classes, like the safety checker, are named by pipeline.
+        module = importlib.import_module(f"diffusers.pipelines.{library}")
+    model_class = getattr(module, class_name)
+    component_dir = str(Path(model_dir, name))
+    with init_empty_weights():
+        if hasattr(model_class, "load_config"):
+            return model_class.from_config(model_class.load_config(component_dir))
+        return model_class(model_class.config_class.from_pretrained(component_dir))
+
+# tensor name -> sha256 of each tensor in a (base) weights file.
+def tensor_hashes(path: Path, hashes: HashCache) -> Dict[str, str]:
+    cache_path = Path(HASHES_DIR, (hashes.known(path) or hashes.sha256(path)) + ".json")
+    if cache_path.exists():
+        return json.load(open(cache_path, "r"))
+
+    res = {key: tensor_sha256(value) for key, value in load_weights(path).items()}
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+    json.dump(res, open(tmp_path, "w"))
+    os.replace(tmp_path, cache_path)
+    return res
+
+def read_delta(model_dir: str) -> Dict:
+    path = Path(model_dir, DELTA_NAME)
+    if not path.exists():
+        return None
+    return json.load(open(path, "r"))
+
+# components whose delta has tensors; the rest are the same as the base's.
+def changed_components(delta: Dict) -> Set[str]:
+    return {name for name, component in delta['components'].items() if component['changed'] > 0}
+
+# a component's state dict, reading tensors from the delta or the base on access.
+class LazyStateDict(Mapping):
+    def __init__(self, delta_path: Path, base_path: Path, keys: List[str]):
+        self.delta_path = delta_path
+        self.base_path = base_path
+        self.key_list = keys
+        self.key_set = set(keys)
+        self.delta_file = None
+        if delta_path is not None and delta_path.exists():
+            self.delta_file = safetensors.safe_open(str(delta_path), framework="pt")
+        self.delta_keys = set(self.delta_file.keys()) if self.delta_file is not None else set()
+        self.base_file = None
+        self.base_weights: Dict[str, torch.Tensor] = None
+        self.headers: Dict[Path, Dict[str, Dict]] = dict()
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        if key in self.delta_keys:
+            return self.delta_file.get_tensor(key)
+        if key not in self.key_set:
+            raise KeyError(key)
+        if self.base_path.suffix == ".safetensors":
+            if self.base_file is None:
+                self.base_file = safetensors.safe_open(str(self.base_path), framework="pt")
+            return self.base_file.get_tensor(key)
+        if self.base_weights is None:
+            self.base_weights = load_weights(self.base_path)
+        return self.base_weights[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.key_set
+
+    # (safetensors dtype name, shape) of key, from the file's header where there is
+    # one, so the tensor isn't read.
+    def tensor_info(self, key: str) -> Tuple[str, List[int]]:
+        if key in self.delta_keys:
+            path = self.delta_path
+        elif key not in self.key_set:
+            raise KeyError(key)
+        elif self.base_path.suffix == ".safetensors":
+            path = self.base_path
+        else:
+            value = self[key]
+            return DTYPE_NAMES[value.dtype], list(value.shape)
+        if path not in self.headers:
+            self.headers[path] = read_header(path)
+        info = self.headers[path][key]
+        return info['dtype'], info['shape']
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.key_list)
+
+    def __len__(self) -> int:
+        return len(self.key_list)
+
+def _check_base(component: Dict, base_path: Path, hashes: HashCache):
+    sha = hashes.known(base_path) or hashes.sha256(base_path)
+    if sha != component['base_sha256']:
+        raise Exception(f"{base_path} has changed since the delta against it was made")
+
+def load_state_dict(model_dir: str, name: str, hashes: HashCache = None) -> LazyStateDict:
+    delta = read_delta(model_dir)
+    component = delta['components'][name]
+    base_path = Path(delta['base'], component['base_file'])
+    _check_base(component, base_path, hashes or HashCache())
+    return LazyStateDict(Path(model_dir, name, DELTA_WEIGHTS_NAME), base_path, component['keys'])
+
+# the state dict of model_dir's component name, whether model_dir is packed or not.
+# safetensors weights are read lazily, a tensor at a time.
+def component_state_dict(model_dir: str, name: str, hashes: HashCache = None) -> Mapping:
+    delta = read_delta(model_dir)
+    if delta is not None and name in delta['components']:
+        return load_state_dict(model_dir, name, hashes)
+    path = weights_file(Path(model_dir, name))
+    if path is None:
+        raise FileNotFoundError(f"no weights in {Path(model_dir, name)}")
+    if path.suffix != ".safetensors":
+        return load_weights(path)
+    with safetensors.safe_open(str(path), framework="pt") as file:
+        keys = list(file.keys())
+    return LazyStateDict(None, path, keys)
+
+# load the changed tensors of a packed model_dir into pipeline, which was loaded
+# from its base. components in skip are left alone.
+def apply_deltas(pipeline, model_dir: str, skip: Iterable[str] = ()):
+    delta = read_delta(model_dir)
+    hashes = HashCache()
+    for name in sorted(changed_components(delta) - set(skip)):
+        apply_delta(getattr(pipeline, name), model_dir, name, hashes)
+
+# load the changed tensors of model_dir's component name into module, which was
+# loaded from the base's.
+def apply_delta(module: torch.nn.Module, model_dir: str, name: str, hashes: HashCache = None):
+    delta = read_delta(model_dir)
+    component = delta['components'][name]
+    _check_base(component, Path(delta['base'], component['base_file']), hashes or HashCache())
+    with safetensors.safe_open(str(Path(model_dir, name, DELTA_WEIGHTS_NAME)), framework="pt") as file:
+        state_dict = {key: file.get_tensor(key) for key in file.keys()}
+    _missing, unexpected = module.load_state_dict(state_dict, strict=False)
+    if unexpected:
+        raise Exception(f"{model_dir}/{name}: delta has tensors {unexpected[:5]} the model doesn't")
+
+# raise unless packed out_dir has exactly checkpoint_dir's tensors, read back
+# through its deltas.
+def verify(checkpoint_dir: Path, out_dir: Path, hashes: HashCache):
+    delta = read_delta(out_dir)
+    for name in delta['components']:
+        weights = load_weights(weights_file(Path(checkpoint_dir, name)))
+        packed = load_state_dict(str(out_dir), name, hashes)
+        if set(packed.keys()) != set(weights.keys()):
+            raise Exception(f"{out_dir}/{name}: packed tensor names differ from {checkpoint_dir}'s")
+        for key, value in weights.items():
+            packed_value = packed[key]
+            if packed_value.dtype != value.dtype or not torch.equal(packed_value, value):
+                raise Exception(f"{out_dir}/{name}: {key} differs from {checkpoint_dir}'s")
+
+# rewrite checkpoint_dir's component weights as deltas against base_dir, into
+# out_dir. returns (bytes before, bytes after).
+def pack(base_dir: Path, checkpoint_dir: Path, out_dir: Path, hashes: HashCache) -> List[int]:
+    sizes = [0, 0]
+    components: Dict[str, Dict] = dict()
+    out_dir.mkdir(parents=True)
+    for child in sorted(checkpoint_dir.iterdir()):
+        if child.is_file():
+            shutil.copy2(child, Path(out_dir, child.name))
+            continue
+        weights_path = weights_file(child)
+        base_path = weights_file(Path(base_dir, child.name))
+        if weights_path is None or base_path is None:
+            # no weights, or nothing to compare them with: keep as is.
+            shutil.copytree(child, Path(out_dir, child.name), symlinks=True)
+            continue
+
+        base_hashes = tensor_hashes(base_path, hashes)
+        weights = load_weights(weights_path)
+        changed = {key: value.contiguous() for key, value in weights.items()
+                   if base_hashes.get(key) != tensor_sha256(value)}
+        component_out = Path(out_dir, child.name)
+        component_out.mkdir()
+        for other in child.iterdir():
+            if other.is_file() and other.name not in WEIGHTS_NAMES and not other.name.endswith(".sha256"):
+                shutil.copy2(other, Path(component_out, other.name))
+        safetensors.torch.save_file(changed, str(Path(component_out, DELTA_WEIGHTS_NAME)), metadata={'format': 'pt'})
+
+        components[child.name] = {
+            'base_file': str(base_path.relative_to(base_dir)),
+            'base_sha256': hashes.known(base_path) or hashes.sha256(base_path),
+            'keys': list(weights.keys()),
+            'changed': len(changed),
+        }
+        sizes[0] += weights_path.stat().st_size
+        sizes[1] += Path(component_out, DELTA_WEIGHTS_NAME).stat().st_size
+        print(f"  {child.name}: {len(changed)} of {len(weights)} tensors changed")
+
+    delta = {'base': os.path.realpath(base_dir), 'components': components}
+    json.dump(delta, open(Path(out_dir, DELTA_NAME), "w"), indent=2)
+    hashes.save()
+    return sizes
+
+# write a full model dir with the weights of a packed one.
+def unpack(model_dir: Path, out_dir: Path):
+    delta = read_delta(model_dir)
+    hashes = HashCache()
+    out_dir.mkdir(parents=True)
+    for child in sorted(model_dir.iterdir()):
+        if child.is_file():
+            if child.name != DELTA_NAME:
+                shutil.copy2(child, Path(out_dir, child.name))
+            continue
+        if child.name not in delta['components']:
+            shutil.copytree(child, Path(out_dir, child.name), symlinks=True)
+            continue
+        component_out = Path(out_dir, child.name)
+        component_out.mkdir()
+        for other in child.iterdir():
+            if other.name != DELTA_WEIGHTS_NAME:
+                shutil.copy2(other, Path(component_out, other.name))
+        state_dict = dict(load_state_dict(str(model_dir), child.name, hashes))
+        name = safetensors_name(Path(delta['components'][child.name]['base_file']).name)
+        safetensors.torch.save_file({key: value.contiguous() for key, value in state_dict.items()},
+                                    str(Path(component_out, name)), metadata={'format': 'pt'})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="store checkpoint dirs as per-tensor deltas against a base model")
+    parser.add_argument("command", choices=["pack", "unpack", "info"])
+    parser.add_argument("paths", nargs='+')
+    parser.add_argument("--replace", default=False, action='store_true', help="with pack: replace each checkpoint dir with its packed version")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        if len(args.paths) < 2:
+            parser.error("pack needs a base model dir and at least one checkpoint dir")
+        base_dir = Path(args.paths[0])
+        hashes = HashCache()
+        for arg in args.paths[1:]:
+            checkpoint_dir = Path(arg.rstrip("/"))
+            if read_delta(checkpoint_dir) is not None:
+                print(f"{checkpoint_dir}: already packed")
+                continue
+            out_dir = checkpoint_dir.with_name(checkpoint_dir.name + ".delta")
+            shutil.rmtree(out_dir, ignore_errors=True)
+            print(f"{checkpoint_dir}:")
+            before, after = pack(base_dir, checkpoint_dir, out_dir, hashes)
+            print(f"  weights {before / 1024 / 1024:.1f}Mb -> {after / 1024 / 1024:.1f}Mb")
+            if args.replace:
+                # read the packed dir back before the original is removed.
+                verify(checkpoint_dir, out_dir, hashes)
+                print("  verified")
+                # swap with renames, so checkpoint_dir is never half written.
+                old_dir = checkpoint_dir.with_name(checkpoint_dir.name + ".old")
+                os.rename(checkpoint_dir, old_dir)
+                os.rename(out_dir, checkpoint_dir)
+                shutil.rmtree(old_dir)
+    elif args.command == "unpack":
+        if len(args.paths) != 2:
+            parser.error("unpack needs a packed checkpoint dir and an output dir")
+        unpack(Path(args.paths[0]), Path(args.paths[1]))
+    else:
+        for arg in args.paths:
+            delta = read_delta(arg)
+            if delta is None:
+                print(f"{arg}: not packed")
+                continue
+            print(f"{arg}: base {delta['base']}, {dir_bytes(Path(arg)) / 1024 / 1024:.1f}Mb")
+            for name, component in delta['components'].items():
+                print(f"  {name}: {component['changed']} of {len(component['keys'])} tensors changed")
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# how a model's text encoder sees words: their token ids, the mean of their encoded
+# embeddings, and the distances between those means. for picking instance tokens
+# (like "alexhin") the model knows little about, and that aren't close to each
+# other.
+#
+# texts are tokenized and encoded in batches, padded to the longest in the batch.
+# CLIP's text encoder is causal, so padding doesn't change the outputs for the real
+# tokens, and the mean is taken over those only. distances are one cdist over all
+# the means, and nearest neighbours a topk over that.
+#
+# as a library, e.g. from a training wrapper:
+#   info = TokenInfo("/home/tim/models/f222v")
+#   info.nearest(["alexhin", "sks", "ohwx"], k=2)
+#   info.rarest(candidates, 10)
+#
+# usage:
+#   token-info.py [<model_dir>] [--file words.txt] [-k 5] [--format text|csv|json] [<text> ...]
+import sys
+import csv
+import json
+import argparse
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+import transformers
+
+import tensordelta
+
+DEFAULT_MODEL = "/home/tim/models/f222v"
+UNK_TOKEN = "<|endoftext|>"
+POSITION_IDS_KEY = "text_model.embeddings.position_ids"
+
+# the text encoder of model_dir, packed (see tensordelta.py) or not.
+def load_text_encoder(model_dir: str) -> transformers.CLIPTextModel:
+    delta = tensordelta.read_delta(model_dir)
+    if delta is None or "text_encoder" not in delta['components']:
+        return transformers.CLIPTextModel.from_pretrained(model_dir, subfolder="text_encoder")
+    config = transformers.CLIPTextConfig.from_pretrained(model_dir, subfolder="text_encoder")
+    text_encoder = transformers.CLIPTextModel(config)
+    # not strict: whether position_ids is saved depends on the transformers version.
+    # anything else missing or left over means the weights don't fit the config.
+    res = text_encoder.load_state_dict(dict(tensordelta.component_state_dict(model_dir, "text_encoder")), strict=False)
+    bad = [key for key in res.missing_keys + res.unexpected_keys if key != POSITION_IDS_KEY]
+    if len(bad) > 0:
+        raise Exception(f"{model_dir}/text_encoder doesn't match its config: missing {res.missing_keys}, unexpected {res.unexpected_keys}")
+    return text_encoder
+
+class TokenInfo:
+    tokenizer: transformers.CLIPTokenizer
+    text_encoder: transformers.CLIPTextModel
+    device: str
+    batch_size: int
+
+    def __init__(self, model_dir: str = DEFAULT_MODEL, device: str = None, batch_size: int = 256,
+                 tokenizer: transformers.CLIPTokenizer = None, text_encoder: transformers.CLIPTextModel = None):
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_size = batch_size
+        self.tokenizer = tokenizer or transformers.CLIPTokenizer.from_pretrained(model_dir, subfolder="tokenizer")
+        self.text_encoder = (text_encoder or load_text_encoder(model_dir)).to(self.device).eval()
+        # text -> mean embedding, on the cpu.
+        self.means: Dict[str, torch.Tensor] = dict()
+
+    # token ids of each text, with the start and end tokens.
+    def input_ids(self, texts: Sequence[str]) -> List[List[int]]:
+        return self.tokenizer(list(texts), truncation=True).input_ids
+
+    # mean embedding of each text, [len(texts), dim].
+    @torch.no_grad()
+    def encode(self, texts: Sequence[str]) -> torch.Tensor:
+        todo = [text for text in dict.fromkeys(texts) if text not in self.means]
+        for start in range(0, len(todo), self.batch_size):
+            batch = todo[start:start + self.batch_size]
+            tokens = self.tokenizer(batch, padding=True, truncation=True, return_tensors="pt")
+            mask = tokens.attention_mask.to(self.device)
+            hidden = self.text_encoder(tokens.input_ids.to(self.device), attention_mask=mask)[0]
+            mask = mask.unsqueeze(-1).to(hidden.dtype)
+            means = (hidden * mask).sum(dim=1) / mask.sum(dim=1)
+            for text, mean in zip(batch, means.float().cpu()):
+                self.means[text] = mean
+        if len(texts) == 0:
+            return torch.zeros((0, self.text_encoder.config.hidden_size))
+        return torch.stack([self.means[text] for text in texts])
+
+    # distance between the mean embeddings of each pair, [len(texts), len(others)].
+    def distances(self, texts: Sequence[str], others: Sequence[str] = None) -> torch.Tensor:
+        embeddings = self.encode(texts)
+        other_embeddings = embeddings if others is None else self.encode(others)
+        return torch.cdist(embeddings, other_embeddings)
+
+    # the k nearest of others (default: texts) to each text, not counting itself.
+    def nearest(self, texts: Sequence[str], k: int = 5, others: Sequence[str] = None) -> List[List[Tuple[str, float]]]:
+        others = list(texts if others is None else others)
+        dists = self.distances(texts, others)
+        other_index = {other: idx for idx, other in enumerate(others)}
+        for row, text in enumerate(texts):
+            if text in other_index:
+                dists[row, other_index[text]] = float("inf")
+        k = min(k, len(others) - (1 if set(texts) & set(others) else 0))
+        if k <= 0:
+            return [[] for _ in texts]
+        values, indices = dists.topk(k, dim=1, largest=False)
+        return [[(others[idx], value) for idx, value in zip(row_indices.tolist(), row_values.tolist())]
+                for row_indices, row_values in zip(indices, values)]
+
+    # distance of each text from the end-of-text token, which has no meaning of its
+    # own.
+    def unk_distances(self, texts: Sequence[str]) -> torch.Tensor:
+        return self.distances(texts, [UNK_TOKEN])[:, 0]
+
+    # the n texts closest to the end-of-text token: the ones the model has the least
+    # idea about.
+    def rarest(self, texts: Sequence[str], n: int) -> List[str]:
+        order = self.unk_distances(texts).argsort().tolist()
+        return [texts[idx] for idx in order[:n]]
+
+    # per text: token ids, distance from the end-of-text token and nearest others.
+    def stats(self, texts: Sequence[str], k: int = 5) -> List[Dict]:
+        texts = list(texts)
+        input_ids = self.input_ids(texts)
+        unk_dists = self.unk_distances(texts).tolist()
+        nearest = self.nearest(texts, k)
+        return [{'text': text, 'input_ids': ids, 'num_tokens': len(ids) - 2, 'dist_unk': dist,
+                 'nearest': [{'text': other, 'dist': other_dist} for other, other_dist in text_nearest]}
+                for text, ids, dist, text_nearest in zip(texts, input_ids, unk_dists, nearest)]
+
+def _print_text(info: TokenInfo, stats: List[Dict], pairs: bool):
+    print(f"unk_token {UNK_TOKEN}:")
+    print(f"  input_ids {info.input_ids([UNK_TOKEN])[0]}")
+    print()
+    special_tokens = list(info.tokenizer.all_special_tokens)
+    for token, dist in zip(special_tokens, info.unk_distances(special_tokens).tolist()):
+        print(f"special {token}:")
+        print(f"  input_ids = {info.input_ids([token])[0]}")
+        print(f"  dist from unknown: {dist:.3}")
+    print()
+
+    for entry in stats:
+        print(f"{entry['text']}:")
+        print(f"  input_ids = {entry['input_ids']}")
+        print(f"  dist from unknown: {entry['dist_unk']:.3}")
+        if entry['nearest']:
+            print("  nearest: " + ", ".join(f"{other['text']} {other['dist']:.3}" for other in entry['nearest']))
+
+    if pairs:
+        texts = [entry['text'] for entry in stats]
+        dists = info.distances(texts)
+        for i in range(len(texts)):
+            for j in range(i + 1, len(texts)):
+                print(f"{texts[i]} -> {texts[j]}: {dists[i, j].item()}")
+
+def _print_csv(stats: List[Dict], k: int):
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["text", "num_tokens", "input_ids", "dist_unk"] +
+                    [column for idx in range(1, k + 1) for column in [f"nearest_{idx}", f"dist_{idx}"]])
+    for entry in stats:
+        nearest = [value for other in entry['nearest'] for value in [other['text'], f"{other['dist']:.4f}"]]
+        writer.writerow([entry['text'], entry['num_tokens'], " ".join(map(str, entry['input_ids'])),
+                         f"{entry['dist_unk']:.4f}"] + nearest)
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="token ids and embedding distances of words, for picking instance tokens")
+    parser.add_argument("texts", nargs='*', help="words or phrases; an existing dir is taken as the model")
+    parser.add_argument("-m", "--model", default=None, help=f"default {DEFAULT_MODEL}")
+    parser.add_argument("-f", "--file", type=Path, default=None, help="read texts from this file, one per line")
+    parser.add_argument("-k", type=int, default=5, help="nearest neighbours to show for each text")
+    parser.add_argument("--format", choices=["text", "csv", "json"], default="text")
+    parser.add_argument("--pairs", default=False, action='store_true', help="with --format text: print the distance of every pair")
+    parser.add_argument("--batch", type=int, default=256, help="texts to encode at once")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args(argv)
+
+    model_dir = args.model
+    texts: List[str] = []
+    for text in args.texts:
+        if model_dir is None and Path(text).is_dir():
+            model_dir = text
+            continue
+        texts.append(text)
+    if args.file is not None:
+        texts.extend(line.strip() for line in open(args.file, "r") if line.strip())
+    texts = list(dict.fromkeys(texts))
+
+    info = TokenInfo(model_dir or DEFAULT_MODEL, device=args.device, batch_size=args.batch)
+    stats = info.stats(texts, args.k) if texts else []
+    if args.format == "text":
+        _print_text(info, stats, args.pairs)
+    elif args.format == "csv":
+        _print_csv(stats, args.k)
+    else:
+        res = {'model': model_dir or DEFAULT_MODEL, 'tokens': stats,
+               'distances': info.distances(texts).tolist() if texts else []}
+        json.dump(res, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,9 @@ class Config(argparse.Namespace):
     input_model_name: str
 
     def validate(self):
+        if self.delta and not os.path.isdir(self.input_model_name):
+            raise Exception(f"--delta needs a local base model dir, not {self.input_model_name}")
+
         if not self.noclass:
             if self.class_dir is None or self.class_prompt is None:
                 raise Exception("must pass class_dir and class_prompt, or use --noclass")
@@ -145,6 +148,12 @@ class Config(argparse.Namespace):
                 print(f"** write {subdir.absolute()}/train-cmdline.txt")
                 res = subprocess.run(copy_args)
 
+                # keep only the tensors that differ from the base model.
+                if self.delta:
+                    delta_args = [sys.executable, Path(__file__).parent.joinpath("tensordelta.py"), "pack", input_model_name, subdir.absolute(), "--replace"]
+                    print(f"** pack {subdir.absolute()} against {input_model_name}")
+                    subprocess.run(delta_args, check=True)
+
     def run(self):
         for seed in self.seeds.split(","):
             self.run_one(seed)
@@ -171,6 +180,7 @@ def parse_args() -> Config:
     parser.add_argument("--save_min_steps", type=int, default=500, help="only save checkpoints at or greater than <N> steps")
     parser.add_argument("--train_batch_size", type=int, default=1, help="train batch size")
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1, help="grad accum steps")
+    parser.add_argument("--delta", default=False, action='store_true', help="store checkpoints as deltas against the base model, with tensordelta.py")
     parser.add_argument("--dry_run", default=False, help="dry run: don't do actions", action='store_true')
 
     cfg = Config()
@@ -1,6 +1,14 @@
-from collections import namedtuple
-from typing import Callable, List
+from collections import namedtuple, OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
+from pathlib import Path
+import hashlib
+import itertools
 import os
+import atexit
+import contextlib
+import time
+import queue
+import threading
 import sys
 import torch
 import PIL, PIL.Image, PIL.ImageDraw
@@ -8,7 +16,13 @@ import json
 from PIL.PngImagePlugin import PngInfo
 import importlib, importlib_metadata
 
-from diffusers import DiffusionPipeline, StableDiffusionPipeline, StableDiffusionInpaintPipeline
+import safetensors.torch
+
+from modelcache import ModelCache, MAX_BYTES as MODEL_CACHE_BYTES
+from filehash import HashCache
+import tensordelta
+
+from diffusers import DiffusionPipeline, StableDiffusionPipeline, StableDiffusionInpaintPipeline, AutoencoderKL
 from diffusers import DDIMScheduler, EulerDiscreteScheduler # works for SD2
 from diffusers import EulerAncestralDiscreteScheduler, DPMSolverMultistepScheduler, KarrasVeScheduler, ScoreSdeVeScheduler # doesn't work for SD2
 
@@ -35,6 +49,9 @@ except importlib_metadata.PackageNotFoundError:
 # prompt = "High quality photo of an astronaut riding a horse in space"
 # image = pipe(prompt, num_inference_steps=25).images[0]
 # image.save("astronaut.png")
+from imageset import ImageSet, DirListing, DIR_LISTING, DECODE_MODES, SAMPLER_NAMES
+from imageset import image_filename, latents_filename, needed_indices, pack_key
+
 SCHEDULERS = {
        'ddim': lambda pipe: DDIMScheduler.from_config(pipe.scheduler.config),
       'euler': lambda pipe: EulerDiscreteScheduler.from_config(pipe.scheduler.config),
@@ -49,132 +66,681 @@ SCHEDULERS = {
 
 
 
-class ImageSet:
-    model_dir: str
-    model_str: str
-    # model_name: str
-    # model_steps: int
-    # model_seed: int
-    output_dir: str
-    sampler_name: str
-    sampler_steps: int
-    guidance_scale: float
-    prompt: str
-    negative_prompt: str
-    num_images: int
-    seed: int
-    width: int
-    height: int
-
-    def __init__(self,
-                 prompt: str, model_dir: str, 
-                 negative_prompt: str = None,
-                 model_str: str = "",
-                 root_output_dir: str = ".", 
-                 sampler_str: str = "dpm++1:20",
-                 guidance_scale: float = 7, num_images: int = 1, seed: int = 0,
-                 width: int = 0, height: int = 0):
-        self.model_dir = model_dir
-
-        if not model_str and model_dir:
-            path_components = model_dir.split("/")
-            last_component = path_components[-1].replace("checkpoint-", "").replace("save-", "").replace("epoch-", "")
-            if len(path_components) >= 2 and all([c.isdigit() for c in last_component]):
-                model_steps = last_component
-                model_name = path_components[-2]
-                model_str = f"{model_name}_{model_steps}"
-            else:
-                model_str = last_component
-
-        self.model_str = model_str
-        self.prompt = prompt
-        self.negative_prompt = negative_prompt
-
-        self.sampler_name, self.sampler_steps = sampler_str.split(":")
-        self.sampler_steps = int(self.sampler_steps)
-        self.guidance_scale = guidance_scale
-        self.num_images = num_images
-        self.seed = seed
-
-        self.width = width
-        self.height = height
-
-        prompt_str = self.prompt
-        if self.negative_prompt:
-            prompt_str += f" || {negative_prompt}"
-
-        self.output_dir = f"{root_output_dir}/{self.model_str}--{prompt_str}--{self.sampler_name}_{self.sampler_steps},c{self.guidance_scale:02}"
-        if self.width:
-            self.output_dir += f",width{self.width}"
-        if self.height:
-            self.output_dir += f",height{self.height}"
-
-        if self.sampler_name not in SCHEDULERS:
-            raise Exception(f"unknown scheduler '{self.sampler_name}'")
+# one image waiting to be generated, with the initial latents it'll be denoised from.
+# each image has its own generator seeded with seed + idx, so its pixels don't
+# depend on the batch size or on which other images already exist.
+Sample = namedtuple("Sample", ["image_set", "idx", "seed", "filename", "latents", "generator"])
+
+# bounded LRU cache of text encoder outputs, keyed on (model key, text). the model
+# key identifies the text encoder and tokenizer weights, see PipelinePool.text_key.
+# prompts and negative prompts are cached separately, as [1, seq_len, dim] tensors.
+class TextEmbeddingCache:
+    max_entries: int
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[Tuple[Tuple, str], torch.Tensor] = OrderedDict()
+
+    @torch.no_grad()
+    def get(self, model_key: Tuple, pipeline: StableDiffusionPipeline, text: str) -> torch.Tensor:
+        key = (model_key, text)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        # without guidance, _encode_prompt returns just the embedding for 'text'. the
+        # stock pipeline encodes negative prompts with the same tokenizer settings.
+        embeds = pipeline._encode_prompt(text, "cuda", 1, False, None)
+        if self.max_entries > 0:
+            self.entries[key] = embeds
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return embeds
+
+# components that are loaded once and shared by every pooled pipeline whose weights
+# for them are identical.
+SHARED_COMPONENTS = ["unet", "vae", "text_encoder", "tokenizer"]
+
+# identifies the weights of one component of a diffusers model directory. weight
+# files are identified by their hash when it's known without reading them (see
+# filehash.HashCache.known: a .sha256 from share-model-components.py that's newer
+# than the file, or a remembered hash of the same file), falling back to their
+# resolved path, so duplicates that have been symlinked also match. returns None
+# for models that aren't local directories.
+def component_key(model_dir: str, name: str, hashes: HashCache) -> Tuple:
+    path = Path(model_dir, name)
+    if not path.is_dir():
+        return None
+
+    parts: List[Tuple[str, str]] = []
+    for child in sorted(path.iterdir()):
+        if child.is_dir() or child.name.endswith(".sha256"):
+            continue
+
+        sha = hashes.known(child)
+        if sha is not None:
+            ident = sha
+        elif child.suffix in [".json", ".txt"]:
+            ident = hashlib.sha256(child.read_bytes()).hexdigest()
+        else:
+            ident = os.path.realpath(child)
+        parts.append((child.name, ident))
+    return (name, tuple(parts))
+
+# keeps loaded pipelines around, evicting the least recently used ones once their
+# weights take more than max_bytes. the most recently used pipeline always stays.
+# with a model_cache, models are loaded from their fp16 safetensors cache entry.
+class PipelinePool:
+    max_bytes: int
+    model_cache: ModelCache
+
+    def __init__(self, max_bytes: int = 0, model_cache: ModelCache = None):
+        self.max_bytes = max_bytes
+        self.model_cache = model_cache
+        self.pipelines: OrderedDict[str, DiffusionPipeline] = OrderedDict()
+        self.sampler_names: Dict[str, str] = dict()
+        self.component_keys: Dict[str, Dict[str, Tuple]] = dict()
+        self.components: Dict[Tuple, Any] = dict()
+        self.hashes = HashCache()
+
+    def get(self, model_dir: str, inpainting: bool) -> DiffusionPipeline:
+        if model_dir in self.pipelines:
+            self.pipelines.move_to_end(model_dir)
+            return self.pipelines[model_dir]
+
+        # dirs packed by tensordelta.py load their base, then the tensors that differ.
+        # components without changes are the base's, and can be shared with it.
+        delta = tensordelta.read_delta(model_dir)
+        base_dir = delta['base'] if delta is not None else model_dir
+        changed = tensordelta.changed_components(delta) if delta is not None else set()
+        keys = {name: component_key(model_dir if name in changed else base_dir, name, self.hashes) for name in SHARED_COMPONENTS}
+        self.hashes.save()
+        shared = {name: self.components[key] for name, key in keys.items() if key in self.components}
+        if len(shared) > 0:
+            print(f"{model_dir}: sharing {', '.join(shared.keys())}")
+
+        pipeline_class = StableDiffusionInpaintPipeline if inpainting else StableDiffusionPipeline
+        load_dir = self.model_cache.path(base_dir, pipeline_class) if self.model_cache is not None else base_dir
+        # cache entries are already fp16; hub ids aren't cached, and come from their fp16 branch.
+        revision = "fp16" if load_dir == base_dir else None
+        pipeline = pipeline_class.from_pretrained(load_dir, revision=revision, torch_dtype=torch.float16, safety_checker=None, **shared)
+        if delta is not None:
+            tensordelta.apply_deltas(pipeline, model_dir, skip=shared.keys())
+        pipeline = pipeline.to("cuda")
+
+        if _xformers_available:
+            pipeline.unet.enable_xformers_memory_efficient_attention()
+
+        for name, key in keys.items():
+            if key is not None:
+                self.components[key] = getattr(pipeline, name)
+        self.pipelines[model_dir] = pipeline
+        self.component_keys[model_dir] = keys
+        self._evict()
+        return pipeline
+
+    def text_key(self, model_dir: str) -> Tuple:
+        keys = self.component_keys.get(model_dir, {})
+        if keys.get("text_encoder") is None or keys.get("tokenizer") is None:
+            return (model_dir,)
+        return (keys["text_encoder"], keys["tokenizer"])
+
+    def num_bytes(self) -> int:
+        modules: Dict[int, torch.nn.Module] = dict()
+        for pipeline in self.pipelines.values():
+            for module in [pipeline.unet, pipeline.vae, pipeline.text_encoder]:
+                modules[id(module)] = module
+        return sum(tensor.numel() * tensor.element_size()
+                   for module in modules.values()
+                   for tensor in itertools.chain(module.parameters(), module.buffers()))
+
+    def _evict(self):
+        evicted = False
+        while len(self.pipelines) > 1 and self.num_bytes() > self.max_bytes:
+            model_dir, _pipeline = self.pipelines.popitem(last=False)
+            self.sampler_names.pop(model_dir, None)
+            self.component_keys.pop(model_dir)
+            print(f"evict {model_dir}")
+            evicted = True
+
+        if evicted:
+            used_keys = {key for keys in self.component_keys.values() for key in keys.values()}
+            self.components = {key: component for key, component in self.components.items() if key in used_keys}
+            torch.cuda.empty_cache()
+
+def png_metadata(texts: Dict[str, str]) -> PngInfo:
+    metadata = PngInfo()
+    for key, value in texts.items():
+        metadata.add_text(key, value)
+    return metadata
+
+# write to a temp file and rename, so needed_indices never sees a partial image.
+def save_png(filename: str, image: PIL.Image.Image, metadata: PngInfo):
+    temp_filename = f"{filename}.tmp"
+    image.save(temp_filename, format="PNG", pnginfo=metadata)
+    os.replace(temp_filename, filename)
+    DIR_LISTING.add(filename)
+
+def _save_image(image_set: ImageSet, idx: int, filename: str, image: PIL.Image.Image, metadata: PngInfo):
+    save_png(filename, image, metadata)
+
+# latents are saved as a [1, 4, h/8, w/8] 'latents' tensor, with the same text
+# fields as the PNG metadata.
+def _save_latents(image_set: ImageSet, idx: int, filename: str, latents: torch.Tensor, texts: Dict[str, str]):
+    filename = latents_filename(filename)
+    temp_filename = f"{filename}.tmp"
+    safetensors.torch.save_file({'latents': latents.contiguous()}, temp_filename, metadata=texts)
+    os.replace(temp_filename, filename)
+    DIR_LISTING.add(filename)
+
+# tile size and overlap for tiled decoding, in latent pixels.
+TILE_SIZE = 64
+TILE_OVERLAP = 16
+
+# rough peak memory for decoding a batch: a few full-resolution 256 channel
+# activations per sample, plus the mid-block attention over all latent pixels.
+def _decode_bytes(vae: AutoencoderKL, batch_size: int, height: int, width: int) -> int:
+    scale = 2 ** (len(vae.config.block_out_channels) - 1)
+    element_size = torch.tensor([], dtype=vae.dtype).element_size()
+    activations = 4 * 256 * (height * scale) * (width * scale)
+    attention = (height * width) ** 2
+    return batch_size * (activations + attention) * element_size
+
+def _free_bytes(device: torch.device) -> int:
+    if device.type == "cuda":
+        free, _total = torch.cuda.mem_get_info(device)
+        return free
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def choose_decode_mode(vae: AutoencoderKL, latents: torch.Tensor) -> str:
+    batch_size, _channels, height, width = latents.shape
+    budget = _free_bytes(latents.device) * 0.8
+    if _decode_bytes(vae, batch_size, height, width) < budget:
+        return "full"
+    if _decode_bytes(vae, 1, height, width) < budget:
+        return "sliced"
+    return "tiled"
+
+# weights for one decoded tile: ramps up across the overlap on every side that
+# borders another tile, so overlapping tiles fade into each other.
+def _tile_weights(height: int, width: int, overlap: int, top: bool, bottom: bool, left: bool, right: bool) -> torch.Tensor:
+    def ramp(size: int, start: bool, end: bool) -> torch.Tensor:
+        weights = torch.ones(size)
+        fade = torch.linspace(0, 1, overlap + 2)[1:-1]
+        if start:
+            weights[:overlap] = fade
+        if end:
+            weights[-overlap:] = torch.minimum(weights[-overlap:], fade.flip(0))
+        return weights
+    return ramp(height, top, bottom)[:, None] * ramp(width, left, right)[None, :]
+
+def _decode_tiled(vae: AutoencoderKL, latents: torch.Tensor) -> torch.Tensor:
+    batch_size, _channels, height, width = latents.shape
+    scale = 2 ** (len(vae.config.block_out_channels) - 1)
+    tile_height, tile_width = min(TILE_SIZE, height), min(TILE_SIZE, width)
+    stride = TILE_SIZE - TILE_OVERLAP
+
+    def starts(size: int, tile_size: int) -> List[int]:
+        res = list(range(0, size - tile_size + 1, stride))
+        if res[-1] + tile_size < size:
+            res.append(size - tile_size)
+        return res
+
+    image = torch.zeros((batch_size, 3, height * scale, width * scale), device=latents.device, dtype=torch.float32)
+    total_weights = torch.zeros((height * scale, width * scale), device=latents.device, dtype=torch.float32)
+    for y in starts(height, tile_height):
+        for x in starts(width, tile_width):
+            tile = vae.decode(latents[:, :, y:y + tile_height, x:x + tile_width]).sample.float()
+            weights = _tile_weights(tile_height * scale, tile_width * scale, TILE_OVERLAP * scale,
+                                    top=y > 0, bottom=y + tile_height < height,
+                                    left=x > 0, right=x + tile_width < width).to(latents.device)
+            ys = slice(y * scale, (y + tile_height) * scale)
+            xs = slice(x * scale, (x + tile_width) * scale)
+            image[:, :, ys, xs] += tile * weights
+            total_weights[ys, xs] += weights
+    return (image / total_weights).to(latents.dtype)
+
+def _vae_decode(vae: AutoencoderKL, latents: torch.Tensor, mode: str) -> torch.Tensor:
+    if mode == "auto":
+        mode = choose_decode_mode(vae, latents)
+    if mode == "full":
+        return vae.decode(latents).sample
+    if mode == "sliced":
+        return torch.cat([vae.decode(latents[idx:idx + 1]).sample for idx in range(latents.shape[0])])
+    if mode == "tiled":
+        return torch.cat([_decode_tiled(vae, latents[idx:idx + 1]) for idx in range(latents.shape[0])])
+    raise ValueError(f"unknown decode mode '{mode}'")
+
+# same as StableDiffusionPipeline.decode_latents + numpy_to_pil, with the VAE decode
+# done according to 'mode'.
+@torch.no_grad()
+def decode_latents(vae: AutoencoderKL, latents: torch.Tensor, mode: str = "full") -> List[PIL.Image.Image]:
+    latents = 1 / vae.config.get("scaling_factor", 0.18215) * latents
+    image = _vae_decode(vae, latents, mode)
+    image = (image / 2 + 0.5).clamp(0, 1)
+    image = image.cpu().permute(0, 2, 3, 1).float().numpy()
+    image = (image * 255).round().astype("uint8")
+    return [PIL.Image.fromarray(one) for one in image]
+
+# phases of generation that are timed. 'pipeline' is the stock pipeline call used for
+# inpainting and cfg <= 1, which can't be split further.
+PHASES = ["model_load", "scheduler", "text_encode", "unet", "vae_decode", "pipeline", "save"]
+
+# seconds spent in each phase, per ImageSet. work shared by several sets, like a model
+# load or a packed batch, is split between them by image count. also counts
+# denoising steps, for steps/sec of the batches each set was part of.
+class PhaseTimings:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds: Dict[str, Dict[str, float]] = dict()
+        self.steps: Dict[str, List[float]] = dict()
+        # each set's share of the model loads, which are shared by a packed group.
+        self.loads: Dict[str, float] = dict()
+
+    @contextlib.contextmanager
+    def timed(self, shares: List[Tuple[ImageSet, int]], phase: str, sync: bool = True):
+        time_start = time.perf_counter()
+        yield
+        # cuda work is asynchronous; wait for it so it's counted in this phase.
+        if sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.add(shares, phase, time.perf_counter() - time_start)
+
+    def add(self, shares: List[Tuple[ImageSet, int]], phase: str, seconds: float):
+        total = sum(count for _image_set, count in shares)
+        with self.lock:
+            for image_set, count in shares:
+                phases = self.seconds.setdefault(image_set.output_dir, dict.fromkeys(PHASES, 0.0))
+                phases[phase] += seconds * count / total
+                if phase == "model_load":
+                    self.loads[image_set.output_dir] = self.loads.get(image_set.output_dir, 0.0) + count / total
+
+    def add_steps(self, shares: List[Tuple[ImageSet, int]], num_steps: int, seconds: float):
+        batch_size = sum(count for _image_set, count in shares)
+        with self.lock:
+            for image_set, _count in shares:
+                steps = self.steps.setdefault(image_set.output_dir, [0, 0, 0.0])
+                steps[0] += num_steps
+                steps[1] += num_steps * batch_size
+                steps[2] += seconds
+
+    # returns and forgets the timings for image_set. 'unet_its' is denoising loop
+    # iterations/sec, 'unet_sample_its' the same times batch size, and 'model_loads'
+    # its share of the model loads.
+    def pop(self, image_set: ImageSet) -> Dict[str, float]:
+        with self.lock:
+            res = self.seconds.pop(image_set.output_dir, dict.fromkeys(PHASES, 0.0))
+            iterations, sample_steps, seconds = self.steps.pop(image_set.output_dir, [0, 0, 0.0])
+            loads = self.loads.pop(image_set.output_dir, 0.0)
+        if loads > 0:
+            res['model_loads'] = loads
+        if seconds > 0:
+            res['unet_its'] = iterations / seconds
+            res['unet_sample_its'] = sample_steps / seconds
+        return res
+
+def _shares(samples: List[Sample]) -> List[Tuple[ImageSet, int]]:
+    return [(image_set, len(list(group))) for image_set, group in itertools.groupby(samples, key=lambda sample: sample.image_set)]
+
+def _is_oom(e: Exception) -> bool:
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+# finds the largest batch size that fits, per (gpu, model, resolution, attention
+# backend, decode mode), by binary search over the batches that are actually run:
+# 'good' is the largest size known to work and 'bad' the smallest known to run out
+# of memory. results are cached on disk so later runs start at the right size.
+class BatchSizer:
+    cache_path: Path
+    max_batch: int
+
+    def __init__(self, cache_path: Path = Path.home() / ".cache" / "sd-scripts" / "batch-sizes.json", max_batch: int = 32):
+        self.cache_path = cache_path
+        self.max_batch = max_batch
+        self.sizes: Dict[str, List[int]] = dict()
+        if cache_path.exists():
+            try:
+                self.sizes = json.load(open(cache_path, "r"))
+            except json.JSONDecodeError:
+                # start over rather than fail; the sizes are found again.
+                self.sizes = dict()
+
+    def get(self, key: str) -> int:
+        good, bad = self.sizes.get(key, [0, self.max_batch + 1])
+        if bad - good <= 1:
+            return good
+        return (good + bad) // 2
+
+    def success(self, key: str, batch_size: int):
+        good, bad = self.sizes.get(key, [0, self.max_batch + 1])
+        if batch_size > good:
+            self.sizes[key] = [batch_size, max(bad, batch_size + 1)]
+            self._save()
+
+    def oom(self, key: str, batch_size: int):
+        good, bad = self.sizes.get(key, [0, self.max_batch + 1])
+        bad = min(bad, batch_size)
+        # a size that used to work can stop fitting, e.g., with other processes on the gpu.
+        good = min(good, bad - 1)
+        self.sizes[key] = [good, bad]
+        self._save()
+        print(f"\033[1;33mout of memory at batch {batch_size}, next try {self.get(key)}\033[0m")
+        if bad <= 1:
+            raise Exception(f"out of memory with batch size 1 for {key}")
+
+    def _save(self):
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # workers on the same host share the cache; each writes its own temp file.
+        temp_path = self.cache_path.with_name(f".{self.cache_path.name}.{os.getpid()}.tmp")
+        with open(temp_path, "w") as file:
+            json.dump(self.sizes, file, indent=2)
+        os.replace(temp_path, self.cache_path)
+
+# runs save_image_funs on background threads so PNG encoding overlaps with the next
+# denoising batch. the queue is bounded, so generation blocks when saving falls
+# behind. pending saves are always flushed before the process exits.
+class ImageSaver:
+    num_threads: int
+    errors: List[Exception]
+    # output_dir -> saves queued or running for it.
+    pending: Dict[str, int]
+
+    def __init__(self, num_threads: int = 2, max_pending: int = 16):
+        self.num_threads = num_threads
+        self.errors = []
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.queue: queue.Queue = queue.Queue(max_pending)
+        for _ in range(num_threads):
+            threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self.flush)
+
+    def wrap(self, save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None]) -> Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None]:
+        if self.num_threads == 0:
+            return save_image_fun
+
+        def fun(image_set: ImageSet, *args):
+            with self.lock:
+                self.pending[image_set.output_dir] = self.pending.get(image_set.output_dir, 0) + 1
+            self.queue.put((save_image_fun, (image_set, *args)))
+        return fun
+
+    # whether image_set has saves queued or running.
+    def is_saving(self, image_set: ImageSet) -> bool:
+        with self.lock:
+            return self.pending.get(image_set.output_dir, 0) > 0
+
+    def flush(self):
+        self.queue.join()
+        if len(self.errors) > 0:
+            errors, self.errors = self.errors, []
+            raise Exception(f"{len(errors)} images failed to save") from errors[0]
+
+    def _run(self):
+        while True:
+            save_image_fun, args = self.queue.get()
+            try:
+                save_image_fun(*args)
+            except Exception as e:
+                print(f"\033[1;31merror saving {args[2]}: {e}\033[0m")
+                self.errors.append(e)
+            finally:
+                with self.lock:
+                    output_dir = args[0].output_dir
+                    self.pending[output_dir] -= 1
+                    if self.pending[output_dir] == 0:
+                        del self.pending[output_dir]
+                self.queue.task_done()
 
 class ImageGenerator:
     pipeline = None
-    scheduler = None
+    pipeline_pool: PipelinePool = None
 
-    last_sampler_name: str = ""
     last_model_dir: str = ""
 
     num_parallel: int = 0
+    output_latents: bool = False
+    decode_mode: str = "auto"
+    text_cache: TextEmbeddingCache = None
+    saver: ImageSaver = None
+    timings: PhaseTimings = None
+    batch_sizer: BatchSizer = None
+    # optional filter on the indices that don't exist yet, returning the ones this
+    # process should generate. gen-many uses it to split work between workers.
+    claim_fun: Callable[[ImageSet, List[int]], List[int]] = None
 
     image_blank: PIL.Image = None
     image_mask: PIL.Image = None
 
-    def __init__(self, num_parallel: int = 1):
+    def __init__(self, num_parallel: int = 1, text_cache_size: int = 256, pool_bytes: int = 0, save_threads: int = 2,
+                 output_latents: bool = False, decode_mode: str = "auto",
+                 claim_fun: Callable[[ImageSet, List[int]], List[int]] = None,
+                 model_cache: bool = True, model_cache_bytes: int = MODEL_CACHE_BYTES):
+        self.claim_fun = claim_fun
+        self.text_cache = TextEmbeddingCache(text_cache_size)
+        self.pipeline_pool = PipelinePool(pool_bytes, ModelCache(max_bytes=model_cache_bytes) if model_cache else None)
+        self.saver = ImageSaver(save_threads)
+        self.timings = PhaseTimings()
+        self.set_options(num_parallel, output_latents, decode_mode)
+
+    # change the settings that affect generation, e.g. per job in gen-many.py --serve.
+    def set_options(self, num_parallel: int, output_latents: bool, decode_mode: str):
         self.num_parallel = num_parallel
+        self.output_latents = output_latents
+        self.decode_mode = decode_mode
+        if num_parallel == 0 and self.batch_sizer is None:
+            self.batch_sizer = BatchSizer()
 
     def gen_images(self, image_set: ImageSet, 
                     save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None] = None) -> int:
+        return self.gen_images_packed([image_set], save_image_fun)[0]
+
+    def gen_images_packed(self, image_sets: List[ImageSet],
+                          save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None] = None) -> List[int]:
+        # generate several ImageSets, packing their pending images into the same UNet
+        # batches. the sets must have the same pack_key. returns the number of images
+        # generated for each set. images keep their own seeds, so they match those
+        # generated set by set, within what batched cuda kernels change at other batch
+        # sizes; gen-many.py --check_packed measures that. in latents mode, save_image_fun is ignored and the
+        # final latents are saved instead of images.
+        if save_image_fun is None or self.output_latents:
+            save_image_fun = _save_latents if self.output_latents else _save_image
+
+        def timed_save_image_fun(image_set: ImageSet, *args):
+            with self.timings.timed([(image_set, 1)], "save", sync=False):
+                save_image_fun(image_set, *args)
+        save_image_fun = self.saver.wrap(timed_save_image_fun)
+
+        first = image_sets[0]
+        for image_set in image_sets[1:]:
+            if pack_key(image_set) != pack_key(first):
+                raise ValueError(f"can't pack {image_set.output_dir} with {first.output_dir}: model, sampler or resolution differ")
+
+        needed_by_set = [self._needed_indices(image_set) for image_set in image_sets]
+        num_generated = [len(needed) for needed in needed_by_set]
+        if sum(num_generated) == 0:
+            return num_generated
+
+        for image_set, needed in zip(image_sets, needed_by_set):
+            if len(needed) > 0:
+                DIR_LISTING.makedirs(image_set.output_dir)
+
+        shares = [(image_set, len(needed)) for image_set, needed in zip(image_sets, needed_by_set) if len(needed) > 0]
+        self._setup_pipeline(first, shares)
+
+        packed_sets: List[Tuple[ImageSet, List[int]]] = []
+        for image_set, needed in zip(image_sets, needed_by_set):
+            if len(needed) == 0:
+                continue
+            if "inpainting" in image_set.model_str or image_set.guidance_scale <= 1.0:
+                # these go through the stock pipeline.
+                self._gen_images_pipeline(image_set, needed, save_image_fun)
+            else:
+                packed_sets.append((image_set, needed))
+
+        if len(packed_sets) > 0:
+            batch: List[Sample] = []
+            for sample in self._gen_samples(packed_sets):
+                batch.append(sample)
+                if len(batch) >= self._batch_size(first):
+                    self._gen_batch_sized(batch, save_image_fun)
+                    batch = []
+            if len(batch) > 0:
+                self._gen_batch_sized(batch, save_image_fun)
+
+        print()
+        return num_generated
 
-        def _save_image(image_set: ImageSet, idx: int, filename: str, image: PIL.Image.Image, metadata: PngInfo):
-            image.save(filename, pnginfo=metadata)
-        
+    # wait for background saves to finish.
+    def flush(self):
+        self.saver.flush()
+
+    # num_parallel == 0 means the batch size is picked by the BatchSizer.
+    def _batch_size(self, image_set: ImageSet) -> int:
+        if self.num_parallel > 0:
+            return self.num_parallel
+        return self.batch_sizer.get(self._batch_key(image_set))
+
+    def _batch_key(self, image_set: ImageSet) -> str:
+        attention = "xformers" if _xformers_available else "default"
+        decode = "latents" if self.output_latents else self.decode_mode
+        return "|".join([torch.cuda.get_device_name(), image_set.model_dir, str(image_set.width), str(image_set.height), attention, decode])
+
+    # runs a batch, and with automatic batch sizes, splits it up and retries when it
+    # runs out of memory. a failed batch hasn't saved anything, and generator states
+    # are restored before retrying, so no image is skipped, duplicated or changed.
+    def _gen_batch_sized(self, samples: List[Sample], save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None]):
+        if self.num_parallel > 0:
+            self._gen_batch(samples, save_image_fun)
+            return
+
+        key = self._batch_key(samples[0].image_set)
+        states = [sample.generator.get_state() for sample in samples]
+        oom = False
+        try:
+            self._gen_batch(samples, save_image_fun)
+        except RuntimeError as e:
+            if not _is_oom(e):
+                raise
+            self.batch_sizer.oom(key, len(samples))
+            oom = True
+        if not oom:
+            self.batch_sizer.success(key, len(samples))
+            return
+
+        # only once the except block is left: until then, the exception's traceback
+        # keeps the failed batch's frames, and the memory they hold, alive.
+        torch.cuda.empty_cache()
+        for sample, state in zip(samples, states):
+            sample.generator.set_state(state)
+        batch_size = self.batch_sizer.get(key)
+        for start in range(0, len(samples), batch_size):
+            self._gen_batch_sized(samples[start:start + batch_size], save_image_fun)
+
+    def _needed_indices(self, image_set: ImageSet) -> List[int]:
+        needed = needed_indices(image_set, latents=self.output_latents)
+        if self.claim_fun is not None and len(needed) > 0:
+            needed = self.claim_fun(image_set, needed)
+        print(f"\033[1;32m{image_set.output_dir}\033[0m: {len(needed)} to generate")
+        return needed
+
+    def _setup_pipeline(self, image_set: ImageSet, shares: List[Tuple[ImageSet, int]]):
         inpainting = "inpainting" in image_set.model_str
         if inpainting and self.image_blank is None:
             self.image_blank = PIL.Image.new(mode="RGB", size=(512, 512))
             self.image_mask = PIL.Image.new(mode="RGB", size=(512, 512), color="white")
 
-        if save_image_fun is None:
-            save_image_fun = _save_image
-
-        # figure out what output directories we need
-        os.makedirs(image_set.output_dir, exist_ok=True)
-        filenames = [f"{image_set.output_dir}/{idx + 1:02}.{image_set.seed + idx:010}.png"
-                     for idx in range(image_set.num_images)]
-        needed_filenames = [filename for filename in filenames if filename is None or not os.path.exists(filename)]
-        print(f"\033[1;32m{image_set.output_dir}\033[0m: {len(needed_filenames)} to generate")
-        if len(needed_filenames) == 0:
-            return 0
-        
-        # re-create scheduler/pipeline only when the sampler or model changes.
+        # re-create scheduler only when the sampler changes. pipelines come from the pool.
         if image_set.model_dir != self.last_model_dir:
-            if inpainting:
-                self.pipeline = StableDiffusionInpaintPipeline.from_pretrained(image_set.model_dir, revision="fp16", torch_dtype=torch.float16, safety_checker=None)
-            else:
-                self.pipeline = StableDiffusionPipeline.from_pretrained(image_set.model_dir, revision="fp16", torch_dtype=torch.float16, safety_checker=None)
-
-            self.pipeline = self.pipeline.to("cuda")
+            with self.timings.timed(shares, "model_load"):
+                self.pipeline = self.pipeline_pool.get(image_set.model_dir, inpainting)
             self.last_model_dir = image_set.model_dir
 
-            if _xformers_available:
-                self.pipeline.unet.enable_xformers_memory_efficient_attention()
-
-
-        if image_set.sampler_name != self.last_sampler_name or self.pipeline.scheduler is None:
-            scheduler_fun = SCHEDULERS[image_set.sampler_name]
-            self.pipeline.scheduler = scheduler_fun(self.pipeline)
-            self.last_sampler_name = image_set.sampler_name
-
-        num_generated = len(needed_filenames)
-        while len(needed_filenames) > 0:
-            num_needed = len(needed_filenames)
-            num_batch = min(num_needed, self.num_parallel)
-            num_existing = image_set.num_images - num_needed
-            print(f"{num_existing + 1}/{image_set.num_images}: {needed_filenames[0]}")
+        sampler_names = self.pipeline_pool.sampler_names
+        if image_set.sampler_name != sampler_names.get(image_set.model_dir) or self.pipeline.scheduler is None:
+            with self.timings.timed(shares, "scheduler"):
+                scheduler_fun = SCHEDULERS[image_set.sampler_name]
+                self.pipeline.scheduler = scheduler_fun(self.pipeline)
+            sampler_names[image_set.model_dir] = image_set.sampler_name
+
+    def _gen_samples(self, packed_sets: List[Tuple[ImageSet, List[int]]]) -> Iterable[Sample]:
+        pipeline = self.pipeline
+        for image_set, needed in packed_sets:
+            width = image_set.width or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+            height = image_set.height or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+            shape = (1, pipeline.unet.config.in_channels, height // pipeline.vae_scale_factor, width // pipeline.vae_scale_factor)
+            pipeline.scheduler.set_timesteps(image_set.sampler_steps, device="cuda")
+
+            for idx in needed:
+                filename = image_filename(image_set, idx)
+                print(f"{idx + 1}/{image_set.num_images}: {filename}")
+
+                seed = image_set.seed + idx
+                generator = torch.Generator("cuda").manual_seed(seed)
+                latents = torch.randn(shape, generator=generator, device="cuda", dtype=pipeline.unet.dtype)
+                latents = latents * pipeline.scheduler.init_noise_sigma
+                yield Sample(image_set, idx, seed, filename, latents, generator)
+
+    @torch.no_grad()
+    def _gen_batch(self, samples: List[Sample], save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None]):
+        # same steps as StableDiffusionPipeline.__call__, but every sample keeps its own
+        # prompt, negative prompt and guidance scale.
+        pipeline = self.pipeline
+        first = samples[0].image_set
+        shares = _shares(samples)
+
+        uncond_embeds: List[torch.Tensor] = []
+        text_embeds: List[torch.Tensor] = []
+        guidance: List[Tuple[int, int, float]] = []
+        start = 0
+        with self.timings.timed(shares, "text_encode"):
+            for image_set, num_images in shares:
+                uncond, text = self._encode(image_set)
+                uncond_embeds.append(uncond.repeat(num_images, 1, 1))
+                text_embeds.append(text.repeat(num_images, 1, 1))
+                guidance.append((start, start + num_images, image_set.guidance_scale))
+                start += num_images
+            prompt_embeds = torch.cat(uncond_embeds + text_embeds)
+
+        time_start = time.perf_counter()
+        with self.timings.timed(shares, "unet"):
+            latents = torch.cat([sample.latents for sample in samples])
+            scheduler = pipeline.scheduler
+            scheduler.set_timesteps(first.sampler_steps, device="cuda")
+            # ancestral samplers draw step noise from each sample's own generator.
+            extra_step_kwargs = pipeline.prepare_extra_step_kwargs([sample.generator for sample in samples], 0.0)
+
+            for t in scheduler.timesteps:
+                latent_model_input = torch.cat([latents] * 2)
+                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
+                noise_pred = pipeline.unet(latent_model_input, t, encoder_hidden_states=prompt_embeds).sample
+
+                # apply guidance per ImageSet, with a python float scale like the stock pipeline.
+                noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                noise_pred = torch.cat([noise_pred_uncond[start:end] + guidance_scale * (noise_pred_text[start:end] - noise_pred_uncond[start:end])
+                                        for start, end, guidance_scale in guidance])
+                latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+        self.timings.add_steps(shares, len(scheduler.timesteps), time.perf_counter() - time_start)
+
+        if self.output_latents:
+            for idx, sample in enumerate(samples):
+                save_image_fun(sample.image_set, idx, sample.filename, latents[idx:idx + 1].cpu(), self._texts(sample.image_set, sample.seed))
+            return
+
+        with self.timings.timed(shares, "vae_decode"):
+            images = decode_latents(pipeline.vae, latents, self.decode_mode)
+        for idx, (sample, image) in enumerate(zip(samples, images)):
+            save_image_fun(sample.image_set, idx, sample.filename, image, self._metadata(sample.image_set, sample.seed))
+
+    def _gen_images_pipeline(self, image_set: ImageSet, needed: List[int],
+                             save_image_fun: Callable[[ImageSet, int, str, PIL.Image.Image, PngInfo], None]):
+        inpainting = "inpainting" in image_set.model_str
+        while len(needed) > 0:
+            batch_idxs = needed[:self._batch_size(image_set)]
+            print(f"{batch_idxs[0] + 1}/{image_set.num_images}: {image_filename(image_set, batch_idxs[0])}")
 
             kwargs = {}
             if image_set.width != 0:
@@ -186,49 +752,81 @@ class ImageGenerator:
                 kwargs['image'] = self.image_blank
                 kwargs['mask_image'] = self.image_mask
 
-            seed = image_set.seed + num_existing
-            generator = torch.Generator("cuda").manual_seed(seed)
-            images: List[PIL.Image.Image] = \
-                self.pipeline(image_set.prompt, 
-                              negative_prompt=image_set.negative_prompt,
-                              generator=generator,
-                              guidance_scale=image_set.guidance_scale, 
-                              num_inference_steps=image_set.sampler_steps,
-                              num_images_per_prompt=num_batch,
-                              **kwargs).images
-
-            for idx in range(num_batch):
-                info = {
-                    'model_dir': image_set.model_dir,
-                    'model_str': image_set.model_str,
-                    'prompt': image_set.prompt,
-                    'sampler_name': image_set.sampler_name,
-                    'sampler_steps': str(image_set.sampler_steps),
-                    'guidance_scale': str(image_set.guidance_scale),
-                    'seed': str(image_set.seed + num_existing + idx)
-                }
-
-                # TODO: this is a bit of hack. these arguments are from gen-many, which
-                # breaks the composition of 'gen-many uses txt2img' (but not vice-versa)
-                cmdline = (f"-m {image_set.model_dir} "
-                           f"--prompt '{image_set.prompt}' "
-                           f"-s {image_set.sampler_name}:{image_set.sampler_steps} "
-                           f"--cfg {image_set.guidance_scale} "
-                           f"--seed {image_set.seed + num_existing + idx}")
-
-                if image_set.negative_prompt:
-                    info['negative_prompt'] = image_set.negative_prompt
-                    cmdline += f" --negative_prompt '{image_set.negative_prompt}'"
-
-                metadata = PngInfo()
-                metadata.add_text('json', json.dumps(info))
-                metadata.add_text('cmdline', cmdline)
-                save_image_fun(image_set, idx, needed_filenames[idx], images[idx], metadata)
+            if self.output_latents:
+                kwargs['output_type'] = "latent"
+
+            shares = [(image_set, len(batch_idxs))]
+            generators = [torch.Generator("cuda").manual_seed(image_set.seed + idx) for idx in batch_idxs]
+            with self.timings.timed(shares, "text_encode"):
+                negative_prompt_embeds, prompt_embeds = self._encode(image_set)
+            oom = False
+            try:
+                with self.timings.timed(shares, "pipeline"):
+                    images: List[PIL.Image.Image] = \
+                        self.pipeline(prompt_embeds=prompt_embeds,
+                                      negative_prompt_embeds=negative_prompt_embeds,
+                                      generator=generators,
+                                      guidance_scale=image_set.guidance_scale, 
+                                      num_inference_steps=image_set.sampler_steps,
+                                      num_images_per_prompt=len(batch_idxs),
+                                      **kwargs).images
+            except RuntimeError as e:
+                if self.num_parallel > 0 or not _is_oom(e):
+                    raise
+                self.batch_sizer.oom(self._batch_key(image_set), len(batch_idxs))
+                oom = True
+            if oom:
+                # nothing was saved yet; retry these images with a smaller batch,
+                # after the exception (and the memory its traceback holds) is gone.
+                torch.cuda.empty_cache()
+                continue
+            if self.num_parallel == 0:
+                self.batch_sizer.success(self._batch_key(image_set), len(batch_idxs))
+
+            for batch_idx, idx in enumerate(batch_idxs):
+                if self.output_latents:
+                    texts = self._texts(image_set, image_set.seed + idx)
+                    save_image_fun(image_set, batch_idx, image_filename(image_set, idx), images[batch_idx:batch_idx + 1].cpu(), texts)
+                    continue
+                metadata = self._metadata(image_set, image_set.seed + idx)
+                save_image_fun(image_set, batch_idx, image_filename(image_set, idx), images[batch_idx], metadata)
             
-            needed_filenames = needed_filenames[num_batch:]
-
-        print()
-        return num_generated
+            needed = needed[len(batch_idxs):]
+
+    def _encode(self, image_set: ImageSet) -> Tuple[torch.Tensor, torch.Tensor]:
+        # returns (negative_prompt_embeds, prompt_embeds) for one image.
+        model_key = self.pipeline_pool.text_key(image_set.model_dir)
+        negative_embeds = self.text_cache.get(model_key, self.pipeline, image_set.negative_prompt or "")
+        embeds = self.text_cache.get(model_key, self.pipeline, image_set.prompt)
+        return negative_embeds, embeds
+
+    def _texts(self, image_set: ImageSet, seed: int) -> Dict[str, str]:
+        info = {
+            'model_dir': image_set.model_dir,
+            'model_str': image_set.model_str,
+            'prompt': image_set.prompt,
+            'sampler_name': image_set.sampler_name,
+            'sampler_steps': str(image_set.sampler_steps),
+            'guidance_scale': str(image_set.guidance_scale),
+            'seed': str(seed)
+        }
+
+        # TODO: this is a bit of hack. these arguments are from gen-many, which
+        # breaks the composition of 'gen-many uses txt2img' (but not vice-versa)
+        cmdline = (f"-m {image_set.model_dir} "
+                   f"--prompt '{image_set.prompt}' "
+                   f"-s {image_set.sampler_name}:{image_set.sampler_steps} "
+                   f"--cfg {image_set.guidance_scale} "
+                   f"--seed {seed}")
+
+        if image_set.negative_prompt:
+            info['negative_prompt'] = image_set.negative_prompt
+            cmdline += f" --negative_prompt '{image_set.negative_prompt}'"
+
+        return {'json': json.dumps(info), 'cmdline': cmdline}
+
+    def _metadata(self, image_set: ImageSet, seed: int) -> PngInfo:
+        return png_metadata(self._texts(image_set, seed))
 
 if __name__ == "__main__":
     image_sets = []
@@ -249,3 +847,4 @@ if __name__ == "__main__":
     gen = ImageGenerator()
     for image_set in image_sets:
         gen.gen_images(image_set, save_image_fun=lambda iset, idx, filename, img, metadata: img.save(f"{idx}-{iset.model_str}.png", pnginfo=metadata))
+    gen.flush()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+# an index of the text encoder's embedding of every entry in a model's tokenizer
+# vocabulary (~49k), for finding the tokens closest to, or farthest from, a word
+# when picking instance tokens like "alexhin".
+#
+# "build" encodes each entry as <start> entry <end>, in batches, and keeps the mean
+# of the outputs, like tokeninfo.py does for words. the embeddings go in an .npy
+# file under ~/.cache/sd-scripts/vocab-index/<hash>, where hash covers the model's
+# text encoder and tokenizer files, so models that share a text encoder share an
+# index. queries load the file with mmap and only need numpy: a word that is a
+# vocabulary entry is looked up, and the distance from it to every entry is one
+# matrix-vector product with the embeddings' squared norms, which are stored too.
+#
+# a word that isn't a single entry is split by the tokenizer, and its embedding
+# taken as the mean of its tokens' embeddings. that's only an approximation of
+# what the text encoder would make of it; tokeninfo.py encodes it properly.
+#
+# usage:
+#   vocabindex.py build <model_dir> [<model_dir> ...]
+#   vocabindex.py near <model_dir> <word> [<word> ...] [-k 20] [--far]
+#   vocabindex.py range <model_dir> <word> [<word> ...] --radius R
+#   vocabindex.py list
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from filehash import HashCache
+
+INDEX_DIR = Path.home() / ".cache" / "sd-scripts" / "vocab-index"
+EMBEDDINGS_NAME = "embeddings.npy"
+NORMS_NAME = "norms.npy"
+TOKENS_NAME = "tokens.json"
+INFO_NAME = "info.json"
+# tensordelta.DELTA_NAME; tensordelta imports torch, which queries don't need.
+DELTA_NAME = "delta.json"
+WORD_END = "</w>"
+
+# hash of the files of model_dir's text encoder and tokenizer. a packed text
+# encoder also depends on its base's weights.
+def encoder_hash(model_dir: str, hashes: HashCache) -> str:
+    sha = hashlib.sha256()
+    for name in ["text_encoder", "tokenizer"]:
+        component_dir = Path(model_dir, name)
+        for path in sorted(component_dir.iterdir()):
+            if path.is_file() and not path.name.endswith(".sha256") and not path.name.startswith("."):
+                sha.update(f"{name}/{path.name}\0{hashes.known(path) or hashes.sha256(path)}\n".encode())
+    delta_path = Path(model_dir, DELTA_NAME)
+    if delta_path.exists():
+        component = json.load(open(delta_path, "r"))['components'].get("text_encoder")
+        if component is not None:
+            sha.update(f"base\0{component['base_sha256']}\n".encode())
+    hashes.save()
+    return sha.hexdigest()
+
+def build(model_dir: str, out_dir: Path, batch_size: int = 1024, device: str = None):
+    import torch
+    import transformers
+    import tokeninfo
+
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = transformers.CLIPTokenizer.from_pretrained(model_dir, subfolder="tokenizer")
+    text_encoder = tokeninfo.load_text_encoder(model_dir).to(device).eval()
+    vocab = tokenizer.get_vocab()
+    tokens = [None] * len(vocab)
+    for token, token_id in vocab.items():
+        tokens[token_id] = token
+    dim = text_encoder.config.hidden_size
+
+    time_start = time.perf_counter()
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = out_dir.with_name(f".{out_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    try:
+        embeddings = np.lib.format.open_memmap(Path(tmp_dir, EMBEDDINGS_NAME), mode="w+", dtype=np.float32, shape=(len(tokens), dim))
+        with torch.no_grad():
+            for start in range(0, len(tokens), batch_size):
+                token_ids = torch.arange(start, min(start + batch_size, len(tokens)))
+                # every input is three tokens long, so no padding is needed.
+                input_ids = torch.stack([torch.full_like(token_ids, tokenizer.bos_token_id), token_ids,
+                                         torch.full_like(token_ids, tokenizer.eos_token_id)], dim=1)
+                hidden = text_encoder(input_ids.to(device))[0]
+                embeddings[start:start + len(token_ids)] = hidden.mean(dim=1).float().cpu().numpy()
+                print(f"\r  {start + len(token_ids)}/{len(tokens)}", end="")
+        print()
+        embeddings.flush()
+        # squared norms, for the distances.
+        np.save(Path(tmp_dir, NORMS_NAME), np.einsum("ij,ij->i", embeddings, embeddings))
+        del embeddings
+
+        json.dump(tokens, open(Path(tmp_dir, TOKENS_NAME), "w"))
+        info = {'model_dir': os.path.realpath(model_dir), 'count': len(tokens), 'dim': dim, 'created': time.time()}
+        json.dump(info, open(Path(tmp_dir, INFO_NAME), "w"), indent=2)
+        # another process may have built the same index meanwhile; keep theirs.
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            if not out_dir.exists():
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    print(f"  {len(tokens)} entries in {time.perf_counter() - time_start:.1f}s, {out_dir}")
+
+class VocabIndex:
+    path: Path
+    tokens: List[str]
+    embeddings: np.ndarray
+
+    # model_dir is the model to load the tokenizer from, for words that aren't an
+    # entry; by default, the one the index was built from.
+    def __init__(self, path: Path, model_dir: str = None):
+        self.path = path
+        self.info = json.load(open(Path(path, INFO_NAME), "r"))
+        self.tokens = json.load(open(Path(path, TOKENS_NAME), "r"))
+        self.ids = {token: token_id for token_id, token in enumerate(self.tokens)}
+        self.embeddings = np.load(Path(path, EMBEDDINGS_NAME), mmap_mode="r")
+        self.norms = np.load(Path(path, NORMS_NAME))
+        self.model_dir = model_dir or self.info['model_dir']
+        self.tokenizer = None
+
+    # the index for model_dir's text encoder, built first if it's missing and
+    # build_missing is set.
+    @staticmethod
+    def for_model(model_dir: str, root: Path = INDEX_DIR, build_missing: bool = False) -> "VocabIndex":
+        path = Path(root, encoder_hash(model_dir, HashCache()))
+        if not path.exists():
+            if not build_missing:
+                raise FileNotFoundError(f"no vocabulary index for {model_dir}; run vocabindex.py build {model_dir}")
+            build(model_dir, path)
+        # the model that built the index may be gone; this one has the same tokenizer.
+        return VocabIndex(path, model_dir)
+
+    # ids of the entries text is made of: the entry for the whole word, if there is
+    # one, otherwise the tokenizer's split.
+    def token_ids(self, text: str) -> List[int]:
+        text = text.lower()
+        for token in [text + WORD_END, text]:
+            if token in self.ids:
+                return [self.ids[token]]
+        if self.tokenizer is None:
+            import transformers
+            self.tokenizer = transformers.CLIPTokenizer.from_pretrained(self.model_dir, subfolder="tokenizer")
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def vector(self, text: str) -> np.ndarray:
+        return np.asarray(self.embeddings[self.token_ids(text)], dtype=np.float32).mean(axis=0)
+
+    # distance from query (a word or an embedding) to every entry.
+    def distances(self, query: Union[str, np.ndarray]) -> np.ndarray:
+        vector = self.vector(query) if isinstance(query, str) else np.asarray(query, dtype=np.float32)
+        squared = self.norms - 2 * (self.embeddings @ vector) + vector @ vector
+        return np.sqrt(np.maximum(squared, 0))
+
+    def _results(self, dists: np.ndarray, indices: np.ndarray, exclude: List[int]) -> List[Tuple[str, float]]:
+        return [(self.tokens[idx], float(dists[idx])) for idx in indices if idx not in exclude]
+
+    # the k entries nearest to query (or with far, farthest from it), not counting
+    # the ones query is made of.
+    def nearest(self, query: Union[str, np.ndarray], k: int = 20, far: bool = False) -> List[Tuple[str, float]]:
+        dists = self.distances(query)
+        exclude = self.token_ids(query) if isinstance(query, str) else []
+        num = min(k + len(exclude), len(dists))
+        keys = -dists if far else dists
+        indices = np.argpartition(keys, num - 1)[:num]
+        indices = indices[np.argsort(keys[indices])]
+        return self._results(dists, indices, exclude)[:k]
+
+    # entries within radius of query, nearest first.
+    def within(self, query: Union[str, np.ndarray], radius: float, limit: int = None) -> List[Tuple[str, float]]:
+        dists = self.distances(query)
+        exclude = self.token_ids(query) if isinstance(query, str) else []
+        indices = np.nonzero(dists <= radius)[0]
+        indices = indices[np.argsort(dists[indices])]
+        return self._results(dists, indices, exclude)[:limit]
+
+def indexes(root: Path = INDEX_DIR) -> List[Path]:
+    if not root.exists():
+        return []
+    return sorted(path for path in root.iterdir() if path.is_dir() and not path.name.startswith("."))
+
+def _print_results(word: str, results: List[Tuple[str, float]], seconds: float):
+    print(f"{word}: ({seconds * 1000:.1f}ms)")
+    for token, dist in results:
+        print(f"  {dist:8.4f}  {token}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="index of text encoder embeddings of a tokenizer's vocabulary, for rare-token search")
+    parser.add_argument("command", choices=["build", "near", "range", "list"])
+    parser.add_argument("args", nargs='*', help="build: model dirs; near, range: model dir and words")
+    parser.add_argument("-k", type=int, default=20, help="with near: entries to show")
+    parser.add_argument("--far", default=False, action='store_true', help="with near: show the farthest entries instead")
+    parser.add_argument("--radius", type=float, default=None, help="with range: distance to show entries within")
+    parser.add_argument("--limit", type=int, default=None, help="with range: most entries to show")
+    parser.add_argument("--batch", type=int, default=1024, help="with build: entries to encode at once")
+    parser.add_argument("--device", default=None, help="with build")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if len(args.args) == 0:
+            parser.error("build needs at least one model dir")
+        hashes = HashCache()
+        for model_dir in args.args:
+            path = Path(INDEX_DIR, encoder_hash(model_dir, hashes))
+            if path.exists():
+                print(f"{model_dir}: already indexed, {path}")
+                continue
+            print(f"{model_dir}:")
+            build(model_dir, path, args.batch, args.device)
+    elif args.command in ["near", "range"]:
+        if len(args.args) < 2:
+            parser.error(f"{args.command} needs a model dir and at least one word")
+        if args.command == "range" and args.radius is None:
+            parser.error("range needs --radius")
+        index = VocabIndex.for_model(args.args[0])
+        for word in args.args[1:]:
+            time_start = time.perf_counter()
+            if args.command == "near":
+                results = index.nearest(word, args.k, args.far)
+            else:
+                results = index.within(word, args.radius, args.limit)
+            _print_results(word, results, time.perf_counter() - time_start)
+    else:
+        for path in indexes():
+            info = json.load(open(Path(path, INFO_NAME), "r"))
+            print(f"{path.name[:16]}  {info['count']:6} x {info['dim']}  {time.ctime(info['created'])}  {info['model_dir']}")
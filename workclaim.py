@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# lock-file claims, so several gen-many.py processes (on different GPUs, or on hosts
+# sharing an NFS output dir) can work through the same plan without generating the
+# same images twice.
+#
+# a claim is a file created with O_CREAT|O_EXCL, holding the claiming worker's id.
+# while a worker holds claims, a heartbeat thread touches them; a claim that hasn't
+# been touched for 'timeout' seconds belongs to a crashed worker and is broken by
+# the next worker that wants it. breaking is itself guarded by a second O_EXCL file,
+# so two workers can't both break a claim and then both take it.
+#
+# claims only decide who generates what. whether an image still needs generating is
+# decided after claiming, by looking on disk for it, so an image finished by a worker
+# whose claim was broken (because it was slow, not dead) isn't redone.
+#
+# mtimes on NFS are set by the server, so the timeout should be well above any clock
+# skew between hosts.
+#
+# usage:
+#   workclaim.py selftest [--workers N] [--items N] [--timeout S]
+import sys
+import os
+import json
+import time
+import socket
+import atexit
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from typing import List, Set
+
+from imageset import ImageSet, image_filename, latents_filename
+
+SET_CLAIM_NAME = "gen-many.claim"
+CLAIM_SUFFIX = ".claim"
+BREAK_SUFFIX = ".break"
+
+class Claims:
+    worker: str
+    timeout: float
+    heartbeat: float
+
+    def __init__(self, worker: str = None, timeout: float = 120.0, heartbeat: float = None):
+        self.worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+        self.timeout = timeout
+        self.heartbeat = heartbeat or timeout / 4
+        self.held: Set[str] = set()
+        self.lock = threading.Lock()
+        self.thread: threading.Thread = None
+        self.stopped = threading.Event()
+        atexit.register(self.close)
+
+    # try to take the claim at path. returns False if a live worker holds it.
+    def claim(self, path: str) -> bool:
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_stale(path):
+                    return False
+                continue
+            try:
+                os.write(fd, json.dumps({'worker': self.worker, 'time': time.time()}).encode())
+            finally:
+                os.close(fd)
+            with self.lock:
+                self.held.add(path)
+            self._start_heartbeat()
+            return True
+        return False
+
+    def release(self, path: str):
+        with self.lock:
+            self.held.discard(path)
+        if self.owner(path) == self.worker:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def release_all(self):
+        with self.lock:
+            held = list(self.held)
+        for path in held:
+            self.release(path)
+
+    def close(self):
+        self.stopped.set()
+        self.release_all()
+
+    # worker id in the claim at path, or None if it's unclaimed. a claim that's just
+    # been created may not have its id written yet, and reads as "".
+    @staticmethod
+    def owner(path: str) -> str:
+        try:
+            with open(path, "r") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            return json.loads(data).get('worker', "")
+        except json.JSONDecodeError:
+            return ""
+
+    def _age(self, path: str) -> float:
+        return time.time() - os.stat(path).st_mtime
+
+    def _break_stale(self, path: str) -> bool:
+        try:
+            if self._age(path) < self.timeout:
+                return False
+        except FileNotFoundError:
+            return True
+
+        break_path = path + BREAK_SUFFIX
+        try:
+            os.close(os.open(break_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            # left behind by a worker that crashed while breaking this claim.
+            try:
+                if self._age(break_path) >= self.timeout:
+                    os.unlink(break_path)
+            except FileNotFoundError:
+                pass
+            return False
+
+        try:
+            # check again: the claim may have been broken and taken by someone else
+            # between the first check and getting the break lock.
+            if self._age(path) < self.timeout:
+                return False
+            print(f"\033[1;33mreclaiming {path} from {self.owner(path) or '?'}\033[0m")
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        finally:
+            os.unlink(break_path)
+        return True
+
+    def _start_heartbeat(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run_heartbeat, daemon=True)
+                self.thread.start()
+
+    def _run_heartbeat(self):
+        while not self.stopped.wait(self.heartbeat):
+            with self.lock:
+                held = list(self.held)
+            for path in held:
+                if self.owner(path) != self.worker:
+                    # broken by another worker, which thought we were dead.
+                    print(f"\033[1;31mlost claim {path}\033[0m")
+                    with self.lock:
+                        self.held.discard(path)
+                    continue
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+# for ImageGenerator's claim_fun: claims what's needed of image_set, and returns the
+# indices that are claimed and still missing on disk. per_set claims the whole set,
+# otherwise up to 'chunk' images are claimed one by one, so several workers can share
+# a big set.
+def claim_indices(claims: Claims, image_set: ImageSet, needed: List[int], per_set: bool = True,
+                  chunk: int = 0, latents: bool = False) -> List[int]:
+    os.makedirs(image_set.output_dir, exist_ok=True)
+    if per_set and not claims.claim(os.path.join(image_set.output_dir, SET_CLAIM_NAME)):
+        return []
+
+    res: List[int] = []
+    for idx in needed:
+        if chunk > 0 and len(res) >= chunk:
+            break
+        filename = image_filename(image_set, idx)
+        claim_path = filename + CLAIM_SUFFIX
+        if not per_set and not claims.claim(claim_path):
+            continue
+        # the directory listing cache doesn't see other workers' images.
+        if os.path.exists(filename) or (latents and os.path.exists(latents_filename(filename))):
+            if not per_set:
+                claims.release(claim_path)
+            continue
+        res.append(idx)
+    return res
+
+# several processes work through the same items, sharing one directory. each item is
+# claimed, "generated" by creating its output file with O_EXCL (so a duplicate is
+# caught), and released. the first worker dies while holding a claim, which another
+# worker has to reclaim.
+def _selftest_worker(work_dir: str, num_items: int, timeout: float, crash: bool) -> int:
+    claims = Claims(timeout=timeout)
+    num_done = 0
+    while True:
+        remaining = [idx for idx in range(num_items) if not os.path.exists(f"{work_dir}/{idx:04}.done")]
+        if len(remaining) == 0:
+            break
+        for idx in remaining:
+            claim_path = f"{work_dir}/{idx:04}{CLAIM_SUFFIX}"
+            if not claims.claim(claim_path):
+                continue
+            done_path = f"{work_dir}/{idx:04}.done"
+            if os.path.exists(done_path):
+                claims.release(claim_path)
+                continue
+            if crash:
+                # die holding the claim, without releasing it or running atexit.
+                os._exit(0)
+            time.sleep(0.01)
+            fd = os.open(done_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            os.write(fd, claims.worker.encode())
+            os.close(fd)
+            num_done += 1
+            claims.release(claim_path)
+        time.sleep(timeout / 4)
+    claims.close()
+    return num_done
+
+def selftest(num_workers: int, num_items: int, timeout: float) -> bool:
+    with tempfile.TemporaryDirectory() as work_dir:
+        ctx = multiprocessing.get_context("spawn")
+        crashed = ctx.Process(target=_selftest_worker, args=(work_dir, num_items, timeout, True))
+        crashed.start()
+        crashed.join()
+        with ctx.Pool(num_workers) as pool:
+            results = [pool.apply_async(_selftest_worker, (work_dir, num_items, timeout, False)) for _ in range(num_workers)]
+            try:
+                counts = [result.get() for result in results]
+            except FileExistsError as e:
+                print(f"duplicate: {e}")
+                return False
+
+        done = sorted(name for name in os.listdir(work_dir) if name.endswith(".done"))
+        leftover = sorted(name for name in os.listdir(work_dir) if name.endswith(CLAIM_SUFFIX) or name.endswith(BREAK_SUFFIX))
+        print(f"{num_workers} workers did {counts} items, {len(done)}/{num_items} done, {len(leftover)} claims left")
+        return len(done) == num_items and sum(counts) == num_items and len(leftover) == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check that work claims split work between processes without duplicates")
+    parser.add_argument("command", choices=["selftest"])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds before a crashed worker's claim is reclaimed")
+    args = parser.parse_args()
+
+    ok = selftest(args.workers, args.items, args.timeout)
+    print("ok" if ok else "\033[1;31mfailed\033[0m")
+    sys.exit(0 if ok else 1)